@@ -1,69 +1,14 @@
-import os
-from tkinter import Tk, filedialog, Button, Label, messagebox, ttk
-from PIL import Image, ImageChops, ImageOps
+import queue
+import threading
+import time
+from PIL import Image
+from mask_pipeline import (
+    BLEND_MODES, DEFAULT_ENCODER, ENCODER_PRESETS, PairIndex, ProxyCache, load_proxy, process_images, render_preview,
+)
 
-def apply_mask_and_cutout(image_main, image_mask):
-    """
-    Apply a mask to the main image to cut out areas based on the mask.
-    White areas in the mask remain visible, and black areas become transparent.
-    """
-    image_main = image_main.convert("RGBA")
-    image_mask = image_mask.convert("L")  # Convert mask to grayscale (L mode)
-    image_main.putalpha(image_mask)
-    return image_main
-
-def apply_darken_layer(image_main, image_mask):
-    """
-    Apply darken blending to combine mask onto the main image with no transparency.
-    """
-    return ImageChops.darker(image_main, image_mask)
-
-def extract_base_name(filename, marker):
-    """Extract the base name of the file by removing the marker ('main' or 'mask') and file extension."""
-    base_name = filename.replace(f"_{marker}.png", "")
-    return base_name
-
-def process_images(input_dir, output_dir, mode):
-    """Find pairs of images and process them based on the selected mode."""
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    files = os.listdir(input_dir)
-    main_files = [f for f in files if f.endswith("_main.png")]
-    mask_files = [f for f in files if f.endswith("_mask.png")]
-
-    if not main_files or not mask_files:
-        print(f"No 'main' or 'mask' files found in {input_dir}.")
-        return
-
-    for main_file in main_files:
-        base_name = extract_base_name(main_file, "main")
-        corresponding_mask = next(
-            (m for m in mask_files if extract_base_name(m, "mask") == base_name), None
-        )
-
-        if corresponding_mask:
-            main_path = os.path.join(input_dir, main_file)
-            mask_path = os.path.join(input_dir, corresponding_mask)
-            output_path = os.path.join(output_dir, f"{base_name}_{mode}.png")
-
-            print(f"Processing pair: {main_file} + {corresponding_mask} in mode: {mode}")
-            try:
-                main_image = Image.open(main_path).convert("RGBA")
-                mask_image = Image.open(mask_path).convert("RGBA")
-                mask_image = mask_image.resize(main_image.size)
-
-                if mode == "cutout":
-                    result_image = apply_mask_and_cutout(main_image, mask_image)
-                elif mode == "darken":
-                    result_image = apply_darken_layer(main_image, mask_image)
-
-                result_image.save(output_path, "PNG")
-                print(f"Saved: {output_path}")
-            except Exception as e:
-                print(f"Error processing {main_file} and {corresponding_mask}: {e}")
-        else:
-            print(f"No matching mask found for {main_file}")
+POLL_INTERVAL_MS = 100  # how often the GUI drains the progress queue
+PREVIEW_CACHE_MB = 128  # decoded proxies kept for the preview window
+CHECKER_SQUARE = 8  # size of the squares shown behind transparent preview pixels
 
 def select_input_folder():
     """Prompt user to select the input folder."""
@@ -81,48 +26,373 @@ def select_output_folder():
         global output_folder
         output_folder = folder_selected
 
+def open_preview():
+    """
+    Open (or refresh) the preview window for the pairs of the input folder.
+    The folder is scanned by the preview thread, so a large one does not
+    freeze the window; poll_preview shows the first pair once it is done.
+    """
+    global preview_pairs, preview_token
+    if not input_folder:
+        print("Please select an input folder.")
+        return
+    preview_pairs = []
+    if preview_window is None or not preview_window.winfo_exists():
+        build_preview_window()
+    preview_window.lift()
+    preview_title.config(text=input_folder)
+    preview_info.config(text="Looking for pairs...")
+    preview_image_label.config(image="")
+    preview_token += 1
+    send_preview_request(("scan", preview_token, input_folder))
+
+def build_preview_window():
+    """Create the preview window: the rendered pair, its details and the navigation."""
+    global preview_window, preview_title, preview_image_label, preview_info, preview_mode
+    preview_window = Toplevel(root)
+    preview_window.title("Preview")
+    preview_window.geometry("700x600")
+    preview_window.configure(bg="#2b2b2b")
+
+    preview_title = Label(preview_window, text="", bg="#2b2b2b", fg="#ffffff")
+    preview_title.pack(pady=5)
+    preview_image_label = Label(preview_window, bg="#2b2b2b")
+    preview_image_label.pack(expand=True)
+    preview_info = Label(preview_window, text="", bg="#2b2b2b", fg="#ffffff")
+    preview_info.pack(pady=5)
+
+    navigation = Frame(preview_window, bg="#2b2b2b")
+    navigation.pack(pady=10)
+    ttk.Button(navigation, text="< Previous", command=lambda: step_preview(-1)).pack(side="left", padx=5)
+    preview_mode = StringVar(value="cutout")
+    mode_box = ttk.Combobox(navigation, textvariable=preview_mode, values=list(BLEND_MODES), state="readonly", width=10)
+    mode_box.pack(side="left", padx=5)
+    mode_box.bind("<<ComboboxSelected>>", lambda event: request_preview())
+    ttk.Button(navigation, text="Next >", command=lambda: step_preview(1)).pack(side="left", padx=5)
+
+    preview_window.bind("<Left>", lambda event: step_preview(-1))
+    preview_window.bind("<Right>", lambda event: step_preview(1))
+    preview_window.bind("<MouseWheel>", lambda event: step_preview(-1 if event.delta > 0 else 1))
+    preview_window.bind("<Button-4>", lambda event: step_preview(-1))
+    preview_window.bind("<Button-5>", lambda event: step_preview(1))
+
+def step_preview(offset):
+    """Show the previous (-1) or next (1) pair."""
+    global preview_index
+    if not preview_pairs:
+        return  # still scanning
+    preview_index = (preview_index + offset) % len(preview_pairs)
+    request_preview()
+
+def request_preview():
+    """Ask the preview thread to render the current pair; older requests still queued are dropped."""
+    global preview_token
+    if not preview_pairs:
+        return  # still scanning
+    preview_token += 1
+    base_name = preview_pairs[preview_index][0]
+    preview_title.config(text=f"{base_name} ({preview_index + 1} / {len(preview_pairs)})")
+    preview_info.config(text="Rendering...")
+    neighbours = [preview_pairs[(preview_index + offset) % len(preview_pairs)] for offset in (1, -1)]
+    send_preview_request(("render", preview_token, preview_pairs[preview_index], preview_mode.get(), neighbours))
+
+def send_preview_request(request):
+    """Queue a request for the preview thread, starting it and the polling of its results if needed."""
+    global preview_thread, preview_polling
+    preview_requests.put(request)
+    if preview_thread is None:
+        preview_thread = threading.Thread(target=preview_worker, daemon=True)
+        preview_thread.start()
+    if not preview_polling:
+        preview_polling = True
+        root.after(POLL_INTERVAL_MS, poll_preview)
+
+def preview_worker():
+    """
+    Handle preview requests on a background thread, skipping to the newest
+    one: ("scan", ...) lists and sorts the pairs of a folder, ("render", ...)
+    renders a pair and then loads the proxies of the neighbouring pairs while
+    idle, so stepping through the folder shows them without waiting.
+    """
+    while True:
+        request = preview_requests.get()
+        while not preview_requests.empty():
+            request = preview_requests.get()
+        if request[0] == "scan":
+            _, token, folder = request
+            try:
+                preview_results.put(("pairs", token, sorted(PairIndex(folder)), None))
+            except Exception as e:
+                preview_results.put(("pairs", token, [], str(e)))
+            continue
+        _, token, (base_name, main_path, mask_path), mode, neighbours = request
+        started = time.perf_counter()
+        try:
+            preview, info = render_preview(main_path, mask_path, mode, cache=proxy_cache)
+        except Exception as e:
+            preview_results.put(("render", token, None, str(e)))
+            continue
+        info["seconds"] = time.perf_counter() - started
+        preview_results.put(("render", token, preview, info))
+        for _, neighbour_main, neighbour_mask in neighbours:
+            if not preview_requests.empty():
+                break
+            try:
+                load_proxy(neighbour_main, cache=proxy_cache)
+                load_proxy(neighbour_mask, cache=proxy_cache)
+            except Exception:
+                pass  # reported when the pair itself is shown
+
+def poll_preview():
+    """
+    Take the preview thread's answer to the latest request on the Tk thread:
+    the pairs of a scanned folder, whose first pair is then rendered, or the
+    rendered preview of the current pair.
+    """
+    global preview_polling, preview_pairs, preview_index
+    latest = None
+    while True:
+        try:
+            latest = preview_results.get_nowait()
+        except queue.Empty:
+            break
+    if latest is None or latest[1] != preview_token:
+        root.after(POLL_INTERVAL_MS, poll_preview)
+        return
+    preview_polling = False
+    if not preview_window.winfo_exists():
+        return
+
+    if latest[0] == "pairs":
+        _, _, pairs, error = latest
+        if error is not None or not pairs:
+            message = error or f"No 'main' or 'mask' files found in {input_folder}."
+            print(message)
+            preview_info.config(text=message)
+            return
+        preview_pairs, preview_index = pairs, 0
+        request_preview()
+        return
+
+    _, _, preview, info = latest
+    if preview is None:
+        preview_image_label.config(image="")
+        preview_info.config(text=f"Cannot preview this pair: {info}")
+        return
+    photo = ImageTk.PhotoImage(on_checkerboard(preview))
+    preview_image_label.config(image=photo)
+    preview_image_label.image = photo  # Tk does not keep a reference
+    (main_width, main_height), (mask_width, mask_height) = info["main_size"], info["mask_size"]
+    mask_text = f", mask {mask_width}x{mask_height} (resized)" if info["mask_size"] != info["main_size"] else ""
+    preview_info.config(text=(
+        f"{main_width}x{main_height}{mask_text}, shown at {info['scale'] * 100:.0f}%, "
+        f"rendered in {info['seconds'] * 1000:.0f} ms"
+    ))
+
+def on_checkerboard(image):
+    """Composite an RGBA preview over a grey checkerboard so transparent areas are visible."""
+    tile = Image.new("RGBA", (2 * CHECKER_SQUARE, 2 * CHECKER_SQUARE), "#999999")
+    tile.paste("#cccccc", (0, 0, CHECKER_SQUARE, CHECKER_SQUARE))
+    tile.paste("#cccccc", (CHECKER_SQUARE, CHECKER_SQUARE, 2 * CHECKER_SQUARE, 2 * CHECKER_SQUARE))
+    board = Image.new("RGBA", image.size)
+    for y in range(0, image.height, tile.height):
+        for x in range(0, image.width, tile.width):
+            board.paste(tile, (x, y))
+    return Image.alpha_composite(board, image.convert("RGBA"))
+
 def start_processing(mode):
-    """Start processing images in the selected mode."""
+    """
+    Start processing images on a background thread. mode is a mode name or a
+    tuple of them, which makes every output from a single read of each pair.
+    """
     if not input_folder or not output_folder:
         print("Please select both input and output folders.")
         return
+    if worker_thread is not None and worker_thread.is_alive():
+        return
+
+    print(f"Processing images in {mode_label(mode)} mode from {input_folder} to {output_folder}...")
+    start_worker(mode)
+
+def start_worker(mode):
+    """Run process_images in a worker thread that reports back through progress_queue."""
+    global worker_thread, run_started
+    cancel_event.clear()
+    run_started = time.monotonic()
+    progress_bar.config(value=0, maximum=1)
+    status_label.config(text="Scanning input folder...")
+    for button in mode_buttons:
+        button.state(["disabled"])
+    cancel_button.state(["!disabled"])
+
+    def run():
+        try:
+            result = process_images(
+                input_folder, output_folder, mode,
+                encoder=encoder_choice.get(),
+                trim=trim_choice.get(),
+                progress=lambda *state: progress_queue.put(("progress", state)),
+                cancel=cancel_event,
+            )
+            progress_queue.put(("finished", (mode, result)))
+        except Exception as e:
+            progress_queue.put(("error", str(e)))
+
+    worker_thread = threading.Thread(target=run, daemon=True)
+    worker_thread.start()
+    root.after(POLL_INTERVAL_MS, poll_progress)
+
+def cancel_processing():
+    """Ask the worker to stop after the pairs that are currently being processed."""
+    cancel_event.set()
+    cancel_button.state(["disabled"])
+    status_label.config(text="Cancelling after the current pair...")
+
+def poll_progress():
+    """Drain progress_queue on the Tk thread and update the widgets."""
+    latest = None
+    finished = None
+    while True:
+        try:
+            kind, payload = progress_queue.get_nowait()
+        except queue.Empty:
+            break
+        if kind == "progress":
+            latest = payload
+        else:
+            finished = (kind, payload)
+
+    if latest is not None:
+        show_progress(*latest)
+    if finished is None:
+        root.after(POLL_INTERVAL_MS, poll_progress)
+        return
+
+    for button in mode_buttons:
+        button.state(["!disabled"])
+    cancel_button.state(["disabled"])
+    kind, payload = finished
+    if kind == "error":
+        print(f"Processing failed: {payload}")
+        status_label.config(text=f"Processing failed: {payload}")
+        return
+
+    mode, result = payload
+    summary = (
+        f"{result['saved']} saved, {result['skipped']} unchanged, {result['failed']} failed, "
+        f"{result['unmatched']} without a mask, {result['orphans']} masks without a main image."
+    )
+    if result["cancelled"]:
+        print(f"{mode_label(mode).capitalize()} processing cancelled: {summary}")
+        status_label.config(text=f"Cancelled: {result['saved']} saved, {result['failed']} failed.")
+    else:
+        print(f"{mode_label(mode).capitalize()} processing complete: {summary}")
+        status_label.config(text=f"Done: {summary}")
+
+def mode_label(mode):
+    """Name a mode or a tuple of modes in messages."""
+    return mode if isinstance(mode, str) else " + ".join(mode)
+
+def show_progress(done, found, scan_complete):
+    """Update the progress bar and the outputs/sec and ETA text."""
+    elapsed = max(time.monotonic() - run_started, 1e-6)
+    rate = done / elapsed
+    progress_bar.config(maximum=max(found, 1), value=done)
+
+    total_text = f"{found}" if scan_complete else f"{found}+"
+    if rate > 0:
+        eta = int((found - done) / rate)
+        eta_text = f"ETA {eta // 60:02d}:{eta % 60:02d}" + ("" if scan_complete else " (still scanning)")
+    else:
+        eta_text = "ETA --:--"
+    status_label.config(text=f"{done} / {total_text} outputs  |  {rate:.1f} outputs/s  |  {eta_text}")
+
+# Worker processes re-import this script, so the GUI (and Tkinter itself)
+# must only be loaded in the parent.
+if __name__ == "__main__":
+    from tkinter import BooleanVar, Frame, Tk, Toplevel, filedialog, Label, StringVar, ttk
+    from PIL import ImageTk
+
+    # Create the GUI
+    root = Tk()
+    root.title("Photo Mask Application")
+    root.geometry("500x720")
+    root.configure(bg="#2b2b2b")
+
+    input_folder = ""
+    output_folder = ""
+    worker_thread = None
+    run_started = 0.0
+    progress_queue = queue.Queue()
+    cancel_event = threading.Event()
+    preview_window = None
+    preview_pairs = []
+    preview_index = 0
+    preview_token = 0
+    preview_thread = None
+    preview_polling = False
+    preview_requests = queue.Queue()
+    preview_results = queue.Queue()
+    proxy_cache = ProxyCache(PREVIEW_CACHE_MB << 20)
+
+    # Styling
+    style = ttk.Style()
+    style.configure("TButton", font=("Arial", 10), padding=5)
+    style.configure("TLabel", font=("Arial", 12), background="#2b2b2b", foreground="#ffffff")
+
+    # Widgets
+    input_label = Label(root, text="Input Folder: Not Selected", anchor="w", width=50, bg="#2b2b2b", fg="#ffffff")
+    input_label.pack(pady=5, padx=10)
+    select_input_button = ttk.Button(root, text="Select Input Folder", command=select_input_folder)
+    select_input_button.pack(pady=5)
+
+    output_label = Label(root, text="Output Folder: Not Selected", anchor="w", width=50, bg="#2b2b2b", fg="#ffffff")
+    output_label.pack(pady=5, padx=10)
+    select_output_button = ttk.Button(root, text="Select Output Folder", command=select_output_folder)
+    select_output_button.pack(pady=5)
 
-    # Show a warning message
-    messagebox.showwarning("Processing Warning", "Пожалуйста не трогайте данное окно, пока не завершится процесс, иначе оно залагает.")
+    encoder_label = Label(root, text="Output encoding:", bg="#2b2b2b", fg="#ffffff")
+    encoder_label.pack(pady=(5, 0))
+    encoder_choice = StringVar(value=DEFAULT_ENCODER)
+    encoder_box = ttk.Combobox(root, textvariable=encoder_choice, values=list(ENCODER_PRESETS), state="readonly")
+    encoder_box.pack(pady=5)
 
-    print(f"Processing images in {mode} mode from {input_folder} to {output_folder}...")
-    process_images(input_folder, output_folder, mode)
-    print(f"{mode.capitalize()} processing complete.")
+    trim_choice = BooleanVar(value=False)
+    trim_check = ttk.Checkbutton(root, text="Trim transparent borders (cutout)", variable=trim_choice)
+    trim_check.pack(pady=5)
 
-# Create the GUI
-root = Tk()
-root.title("Photo Mask Application")
-root.geometry("500x350")
-root.configure(bg="#2b2b2b")
+    preview_button = ttk.Button(root, text="Preview pairs", command=open_preview)
+    preview_button.pack(pady=5)
 
-input_folder = ""
-output_folder = ""
+    cutout_button = ttk.Button(root, text="Process with PNG Cutout", command=lambda: start_processing("cutout"))
+    cutout_button.pack(pady=10)
 
-# Styling
-style = ttk.Style()
-style.configure("TButton", font=("Arial", 10), padding=5)
-style.configure("TLabel", font=("Arial", 12), background="#2b2b2b", foreground="#ffffff")
+    darken_button = ttk.Button(root, text="Process with Black Screen", command=lambda: start_processing("darken"))
+    darken_button.pack(pady=10)
 
-# Widgets
-input_label = Label(root, text="Input Folder: Not Selected", anchor="w", width=50, bg="#2b2b2b", fg="#ffffff")
-input_label.pack(pady=5, padx=10)
-select_input_button = ttk.Button(root, text="Select Input Folder", command=select_input_folder)
-select_input_button.pack(pady=5)
+    both_button = ttk.Button(
+        root, text="Process with Both (one pass)", command=lambda: start_processing(("cutout", "darken"))
+    )
+    both_button.pack(pady=10)
 
-output_label = Label(root, text="Output Folder: Not Selected", anchor="w", width=50, bg="#2b2b2b", fg="#ffffff")
-output_label.pack(pady=5, padx=10)
-select_output_button = ttk.Button(root, text="Select Output Folder", command=select_output_folder)
-select_output_button.pack(pady=5)
+    blend_row = Frame(root, bg="#2b2b2b")
+    blend_row.pack(pady=10)
+    blend_choice = StringVar(value="multiply")
+    blend_box = ttk.Combobox(blend_row, textvariable=blend_choice, values=list(BLEND_MODES), state="readonly", width=10)
+    blend_box.pack(side="left", padx=5)
+    blend_button = ttk.Button(
+        blend_row, text="Process with selected mode", command=lambda: start_processing(blend_choice.get())
+    )
+    blend_button.pack(side="left", padx=5)
+    mode_buttons = (cutout_button, darken_button, both_button, blend_button)
 
-cutout_button = ttk.Button(root, text="Process with PNG Cutout", command=lambda: start_processing("cutout"))
-cutout_button.pack(pady=10)
+    progress_bar = ttk.Progressbar(root, orient="horizontal", length=400, mode="determinate")
+    progress_bar.pack(pady=5)
+    status_label = Label(root, text="Idle", anchor="w", width=60, bg="#2b2b2b", fg="#ffffff")
+    status_label.pack(pady=5, padx=10)
 
-darken_button = ttk.Button(root, text="Process with Black Screen", command=lambda: start_processing("darken"))
-darken_button.pack(pady=10)
+    cancel_button = ttk.Button(root, text="Cancel", command=cancel_processing)
+    cancel_button.state(["disabled"])
+    cancel_button.pack(pady=5)
 
-root.mainloop()
+    root.mainloop()
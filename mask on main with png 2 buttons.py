@@ -1,5 +1,4 @@
 import os
-from tkinter import Tk, filedialog, Button, Label
 from PIL import Image, ImageChops, ImageOps
 
 def apply_mask_and_cutout(image_main, image_mask):
@@ -109,27 +108,30 @@ def start_darken_processing():
     process_images(input_folder, output_folder, mode="darken")
     print("Darken processing complete.")
 
-# Create the GUI
-root = Tk()
-root.title("Photo Mask Application")
+if __name__ == "__main__":
+    from tkinter import Tk, filedialog, Button, Label
 
-input_folder = ""
-output_folder = ""
+    # Create the GUI
+    root = Tk()
+    root.title("Photo Mask Application")
 
-input_label = Label(root, text="Input Folder: Not Selected", width=50, anchor="w")
-input_label.pack(pady=5)
-select_input_button = Button(root, text="Select Input Folder", command=select_input_folder)
-select_input_button.pack(pady=5)
+    input_folder = ""
+    output_folder = ""
 
-output_label = Label(root, text="Output Folder: Not Selected", width=50, anchor="w")
-output_label.pack(pady=5)
-select_output_button = Button(root, text="Select Output Folder", command=select_output_folder)
-select_output_button.pack(pady=5)
+    input_label = Label(root, text="Input Folder: Not Selected", width=50, anchor="w")
+    input_label.pack(pady=5)
+    select_input_button = Button(root, text="Select Input Folder", command=select_input_folder)
+    select_input_button.pack(pady=5)
 
-cutout_button = Button(root, text="Process with PNG Cutout", command=start_cutout_processing)
-cutout_button.pack(pady=10)
+    output_label = Label(root, text="Output Folder: Not Selected", width=50, anchor="w")
+    output_label.pack(pady=5)
+    select_output_button = Button(root, text="Select Output Folder", command=select_output_folder)
+    select_output_button.pack(pady=5)
 
-darken_button = Button(root, text="Process with Black Screen", command=start_darken_processing)
-darken_button.pack(pady=10)
+    cutout_button = Button(root, text="Process with PNG Cutout", command=start_cutout_processing)
+    cutout_button.pack(pady=10)
 
-root.mainloop()
+    darken_button = Button(root, text="Process with Black Screen", command=start_darken_processing)
+    darken_button.pack(pady=10)
+
+    root.mainloop()
@@ -1,5 +1,4 @@
 import os
-from tkinter import Tk, filedialog, Button, Label
 from PIL import Image
 
 def apply_mask_and_cutout(image_main, image_mask):
@@ -87,71 +86,27 @@ def start_processing():
     process_images(input_folder, output_folder)
     print("Processing complete.")
 
-import os
-import cv2
-from PIL import Image
-
-def split_objects_by_mask(image_path, mask_path, output_dir):
-    """
-    Разделяет объекты из основного изображения по маске и сохраняет их отдельно.
-    """
-    # Убедитесь, что выходная папка существует
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    # Загрузите основное изображение и маску
-    image_main = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)  # Загружается с каналом RGBA
-    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)  # Загружается в оттенках серого
-
-    # Найти контуры объектов на маске
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    print(f"Найдено {len(contours)} объектов.")
-    for idx, contour in enumerate(contours):
-        # Определить ограничивающую рамку контура
-        x, y, w, h = cv2.boundingRect(contour)
-
-        # Вырезать объект из основного изображения и маски
-        cropped_main = image_main[y:y+h, x:x+w]
-        cropped_mask = mask[y:y+h, x:x+w]
-
-        # Преобразовать обрезанный объект в RGBA с прозрачностью
-        cropped_pil = Image.fromarray(cropped_main).convert("RGBA")
-        mask_pil = Image.fromarray(cropped_mask).convert("L")
-        cropped_pil.putalpha(mask_pil)
-
-        # Сохранить обрезанный объект
-        output_path = os.path.join(output_dir, f"object_{idx + 1}.png")
-        cropped_pil.save(output_path, "PNG")
-        print(f"Сохранено: {output_path}")
-
-# Пример использования
-image_path = "path/to/your/image_main.png"  # Основное изображение
-mask_path = "path/to/your/image_mask.png"  # Маска
-output_dir = "path/to/output/directory"    # Папка для сохранения объектов
-
-split_objects_by_mask(image_path, mask_path, output_dir)
-
-
+if __name__ == "__main__":
+    from tkinter import Tk, filedialog, Button, Label
 
-# Create the GUI
-root = Tk()
-root.title("Photo Mask Application")
+    # Create the GUI
+    root = Tk()
+    root.title("Photo Mask Application")
 
-input_folder = ""
-output_folder = ""
+    input_folder = ""
+    output_folder = ""
 
-input_label = Label(root, text="Input Folder: Not Selected", width=50, anchor="w")
-input_label.pack(pady=5)
-select_input_button = Button(root, text="Select Input Folder", command=select_input_folder)
-select_input_button.pack(pady=5)
+    input_label = Label(root, text="Input Folder: Not Selected", width=50, anchor="w")
+    input_label.pack(pady=5)
+    select_input_button = Button(root, text="Select Input Folder", command=select_input_folder)
+    select_input_button.pack(pady=5)
 
-output_label = Label(root, text="Output Folder: Not Selected", width=50, anchor="w")
-output_label.pack(pady=5)
-select_output_button = Button(root, text="Select Output Folder", command=select_output_folder)
-select_output_button.pack(pady=5)
+    output_label = Label(root, text="Output Folder: Not Selected", width=50, anchor="w")
+    output_label.pack(pady=5)
+    select_output_button = Button(root, text="Select Output Folder", command=select_output_folder)
+    select_output_button.pack(pady=5)
 
-process_button = Button(root, text="Start Processing", command=start_processing)
-process_button.pack(pady=20)
+    process_button = Button(root, text="Start Processing", command=start_processing)
+    process_button.pack(pady=20)
 
-root.mainloop()
+    root.mainloop()
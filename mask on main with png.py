@@ -1,5 +1,4 @@
 import os
-from tkinter import Tk, filedialog, Button, Label
 from PIL import Image
 
 def apply_mask_and_cutout(image_main, image_mask):
@@ -87,24 +86,27 @@ def start_processing():
     process_images(input_folder, output_folder)
     print("Processing complete.")
 
-# Create the GUI
-root = Tk()
-root.title("Photo Mask Application")
+if __name__ == "__main__":
+    from tkinter import Tk, filedialog, Button, Label
 
-input_folder = ""
-output_folder = ""
+    # Create the GUI
+    root = Tk()
+    root.title("Photo Mask Application")
 
-input_label = Label(root, text="Input Folder: Not Selected", width=50, anchor="w")
-input_label.pack(pady=5)
-select_input_button = Button(root, text="Select Input Folder", command=select_input_folder)
-select_input_button.pack(pady=5)
+    input_folder = ""
+    output_folder = ""
 
-output_label = Label(root, text="Output Folder: Not Selected", width=50, anchor="w")
-output_label.pack(pady=5)
-select_output_button = Button(root, text="Select Output Folder", command=select_output_folder)
-select_output_button.pack(pady=5)
+    input_label = Label(root, text="Input Folder: Not Selected", width=50, anchor="w")
+    input_label.pack(pady=5)
+    select_input_button = Button(root, text="Select Input Folder", command=select_input_folder)
+    select_input_button.pack(pady=5)
 
-process_button = Button(root, text="Start Processing", command=start_processing)
-process_button.pack(pady=20)
+    output_label = Label(root, text="Output Folder: Not Selected", width=50, anchor="w")
+    output_label.pack(pady=5)
+    select_output_button = Button(root, text="Select Output Folder", command=select_output_folder)
+    select_output_button.pack(pady=5)
 
-root.mainloop()
+    process_button = Button(root, text="Start Processing", command=start_processing)
+    process_button.pack(pady=20)
+
+    root.mainloop()
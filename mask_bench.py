@@ -0,0 +1,462 @@
+"""
+Reproducible benchmark for the mask pipeline.
+
+    python mask_bench.py run --pairs 20 --size 1920x1080 --mask-scale 1 0.5 --output new.json
+    python mask_bench.py compare old.json new.json
+
+'run' generates a synthetic, seeded dataset of _main/_mask pairs (mask scales
+other than 1 exercise the resize path, RGB and palette masks the colour
+conversions), times cutout, darken and split_objects_by_mask end to end,
+times each stage of the compositing and splitting paths separately, times
+resizing a mask in each resize_mask case against the old RGBA bicubic
+resize, and writes everything to a JSON file together with the commit and
+library versions. 'compare' prints the ratio between two such files.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFilter
+
+import mask_pipeline
+
+def generate_dataset(folder, pairs, size, mask_scales, seed=0, mask_modes=("L", "RGB", "P")):
+    """
+    Write `pairs` synthetic main/mask pairs into folder. Mains are gradients
+    with random shapes, masks are blurred white blobs on black; pair i gets
+    mask_scales[i % len(mask_scales)] times the main size and is saved in
+    mask_modes[i // len(mask_scales) % len(mask_modes)], so every mode meets
+    every scale. RGB and P masks are tinted, so they are not plain gray.
+    """
+    rng = random.Random(seed)
+    width, height = size
+    os.makedirs(folder, exist_ok=True)
+    gradient = Image.linear_gradient("L").resize(size)
+    for index in range(pairs):
+        main_image = Image.merge("RGB", (gradient, gradient.rotate(90).resize(size), gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+        draw = ImageDraw.Draw(main_image)
+        for _ in range(20):
+            x, y = rng.randrange(width), rng.randrange(height)
+            radius = rng.randrange(8, max(9, width // 6))
+            color = tuple(rng.randrange(256) for _ in range(3))
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=color)
+
+        scale = mask_scales[index % len(mask_scales)]
+        mask_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        mask_image = Image.new("L", mask_size, 0)
+        draw = ImageDraw.Draw(mask_image)
+        for _ in range(rng.randrange(3, 12)):
+            x, y = rng.randrange(mask_size[0]), rng.randrange(mask_size[1])
+            radius = rng.randrange(4, max(5, mask_size[0] // 8))
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=255)
+        mask_image = mask_image.filter(ImageFilter.GaussianBlur(2))
+        mask_mode = mask_modes[index // len(mask_scales) % len(mask_modes)]
+        if mask_mode != "L":
+            tinted = Image.merge("RGB", (mask_image, mask_image.point(lambda value: value * 3 // 4),
+                                         mask_image.point(lambda value: value // 2)))
+            mask_image = tinted.convert(mask_mode, palette=Image.ADAPTIVE) if mask_mode == "P" else tinted
+
+        main_image.save(os.path.join(folder, f"bench{index:05d}_main.png"), compress_level=1)
+        mask_image.save(os.path.join(folder, f"bench{index:05d}_mask.png"), compress_level=1)
+
+@contextlib.contextmanager
+def quiet():
+    """Silence stdout at the file-descriptor level, including pool workers."""
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(devnull)
+        os.close(saved_stdout)
+
+def time_repeated(function, repeat):
+    """Run function `repeat` times and return the list of wall-clock durations."""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+def summarize(name, durations, pairs, **extra):
+    """Build one result row from a list of durations."""
+    best = min(durations)
+    row = {
+        "case": name,
+        "best_seconds": best,
+        "median_seconds": statistics.median(durations),
+        "pairs_per_second": pairs / best if best else None,
+    }
+    row.update(extra)
+    return row
+
+def list_pairs(folder):
+    """Return the (main_path, mask_path) pairs of a dataset folder."""
+    return [(main_path, mask_path) for _, main_path, mask_path in mask_pipeline.PairIndex(folder)]
+
+def bench_end_to_end(folder, scratch, modes, backends, args, pairs):
+    """
+    Time process_images for every mode and backend; check backends agree pixel
+    for pixel, and with the default mask filter that they match the original
+    Pillow path (reference_composite).
+    """
+    rows = []
+    for mode in modes:
+        outputs = {}
+        for backend in backends:
+            output_dir = os.path.join(scratch, f"{mode}-{backend}")
+
+            def run():
+                with quiet():
+                    mask_pipeline.process_images(
+                        folder, output_dir, mode, workers=args.workers, force=True,
+                        backend=backend, encoder=args.encoder, strip_height=args.strip_height,
+                        io_threads=args.io_threads, resize_filter=args.mask_filter,
+                    )
+
+            rows.append(summarize(f"e2e/{mode}/{backend}", time_repeated(run, args.repeat), len(pairs)))
+            outputs[backend] = output_dir
+
+        reference = outputs[backends[0]]
+        for backend in backends[1:]:
+            identical = all(
+                outputs_identical(os.path.join(reference, name), os.path.join(outputs[backend], name))
+                for name in os.listdir(reference)
+                if name not in (mask_pipeline.MANIFEST_NAME, mask_pipeline.RUN_REPORT_NAME)
+            )
+            rows.append({"case": f"check/{mode}/{backend}", "identical_to": backends[0], "identical": identical})
+        if args.mask_filter == mask_pipeline.DEFAULT_RESIZE_FILTER:
+            extension = mask_pipeline.ENCODER_PRESETS[args.encoder]["extension"]
+            expected = {
+                main_path: reference_composite(main_path, mask_path, mode) for main_path, mask_path in pairs
+            }
+            for backend in backends:
+                identical = all(
+                    output_matches(
+                        os.path.join(outputs[backend], mask_pipeline.extract_base_name(
+                            os.path.basename(main_path), "main") + f"_{mode}{extension}"),
+                        image,
+                    )
+                    for main_path, image in expected.items()
+                )
+                rows.append({
+                    "case": f"check/{mode}/{backend}/original", "identical_to": "original", "identical": identical,
+                })
+    return rows
+
+def reference_composite(main_path, mask_path, mode):
+    """The original Pillow path: both images in RGBA, the whole RGBA mask resized with bicubic."""
+    main_image = Image.open(main_path).convert("RGBA")
+    mask_image = Image.open(mask_path).convert("RGBA").resize(main_image.size)
+    return mask_pipeline.blend_pil(main_image, mask_image, mode)
+
+def output_matches(path, image):
+    """Compare an output image with an image in memory pixel for pixel."""
+    with Image.open(path) as output_image:
+        return (
+            output_image.mode == image.mode and output_image.size == image.size
+            and output_image.tobytes() == image.tobytes()
+        )
+
+def outputs_identical(path_a, path_b):
+    """Compare two output images pixel for pixel."""
+    with Image.open(path_a) as image_a, Image.open(path_b) as image_b:
+        return image_a.mode == image_b.mode and image_a.size == image_b.size and image_a.tobytes() == image_b.tobytes()
+
+def bench_stages(pairs, modes, encoder, repeat, resize_filter=mask_pipeline.DEFAULT_RESIZE_FILTER):
+    """
+    Time each stage of the PIL compositing path separately, in this process:
+    main decode, mask decode, mask resize, composite, encode and write.
+    """
+    stage_names = ("decode_main", "decode_mask", "resize_mask", "composite", "encode", "write")
+    rows = []
+    for mode in modes:
+        samples = {stage: [] for stage in stage_names}
+        scratch = tempfile.mkdtemp(prefix="mask-bench-stage-")
+        try:
+            for _ in range(repeat):
+                for main_path, mask_path in pairs:
+                    marks = [time.perf_counter()]
+                    main_image = Image.open(main_path).convert("RGBA")
+                    marks.append(time.perf_counter())
+                    mask_image = Image.open(mask_path)
+                    resize = mask_image.size != main_image.size
+                    mask_image = mask_image.convert(mask_pipeline.mask_working_mode(mask_image, mode, resize))
+                    marks.append(time.perf_counter())
+                    mask_image = mask_pipeline.resize_mask(mask_image, main_image.size, resize_filter)
+                    if mask_pipeline.blend_mode(mode)["operation"] != "alpha":
+                        mask_image = mask_image.convert("RGBA")
+                    marks.append(time.perf_counter())
+                    result_image = mask_pipeline.blend_pil(main_image, mask_image, mode)
+                    marks.append(time.perf_counter())
+                    buffer = io.BytesIO()
+                    mask_pipeline.encode_image(result_image, buffer, encoder)
+                    marks.append(time.perf_counter())
+                    with open(os.path.join(scratch, "out"), "wb") as output_file:
+                        output_file.write(buffer.getbuffer())
+                    marks.append(time.perf_counter())
+                    for stage, started, finished in zip(stage_names, marks, marks[1:]):
+                        samples[stage].append(finished - started)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        for stage in stage_names:
+            rows.append({
+                "case": f"stage/{mode}/{stage}",
+                "mean_ms": 1000 * statistics.mean(samples[stage]),
+                "median_ms": 1000 * statistics.median(samples[stage]),
+            })
+    return rows
+
+def bench_resize(size, repeat, seed=0):
+    """
+    Time bringing a mask to size in each case resize_mask tells apart (same
+    size, whole-factor downscale, other scales, hard matte) with several
+    filters, against the RGBA bicubic resize every mask used to get. Each
+    row carries its speedup over that baseline.
+    """
+    width, height = size
+    rng = random.Random(seed)
+    cases = (("same", 1.0, False), ("down2", 2.0, False), ("down1.5", 1.5, False), ("up2", 0.5, False),
+             ("hard-up2", 0.5, True))
+    rows = []
+    for case, scale, hard in cases:
+        mask_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        mask_image = Image.new("L", mask_size, 0)
+        draw = ImageDraw.Draw(mask_image)
+        for _ in range(8):
+            x, y = rng.randrange(mask_size[0]), rng.randrange(mask_size[1])
+            radius = rng.randrange(4, max(5, mask_size[0] // 6))
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=255)
+        if not hard:
+            mask_image = mask_image.filter(ImageFilter.GaussianBlur(4))
+
+        baseline = statistics.mean(time_repeated(lambda: mask_image.convert("RGBA").resize(size), repeat))
+        rows.append({"case": f"resize/{case}/rgba-bicubic", "mean_ms": 1000 * baseline, "median_ms": 1000 * baseline,
+                     "speedup": 1.0})
+        for resize_filter in ("bicubic", "bilinear", "nearest", "auto"):
+            durations = time_repeated(lambda: mask_pipeline.resize_mask(mask_image, size, resize_filter), repeat)
+            rows.append({
+                "case": f"resize/{case}/{resize_filter}",
+                "mean_ms": 1000 * statistics.mean(durations),
+                "median_ms": 1000 * statistics.median(durations),
+                "speedup": baseline / statistics.mean(durations) if statistics.mean(durations) else None,
+                "chosen": "none" if mask_image.size == size else
+                mask_pipeline.choose_resize_filter(mask_image, size, resize_filter),
+            })
+    return rows
+
+def bench_split(pairs, scratch, repeat, stage_pairs, encoder):
+    """
+    Time split_objects_by_mask over every pair end to end, then each of its
+    stages separately over the first stage_pairs pairs, in this process:
+    main decode, mask decode and resize, labelling, cropping, encode and
+    write. Skipped when cv2 is missing.
+    """
+    try:
+        import cv2
+        import numpy as np
+    except ImportError:
+        return [{"case": "e2e/split", "skipped": "cv2 is not installed"}]
+
+    def run():
+        with quiet():
+            for index, (main_path, mask_path) in enumerate(pairs):
+                mask_pipeline.split_objects_by_mask(main_path, mask_path, os.path.join(scratch, "split", str(index)))
+
+    rows = [summarize("e2e/split", time_repeated(run, repeat), len(pairs))]
+
+    stage_names = ("decode_main", "decode_mask", "label", "crop", "encode", "write")
+    samples = {stage: [] for stage in stage_names}
+    for _ in range(repeat):
+        for main_path, mask_path in pairs[:stage_pairs]:
+            seconds = dict.fromkeys(stage_names, 0.0)
+            started = time.perf_counter()
+            main_image = Image.open(main_path).convert("RGBA")
+            seconds["decode_main"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            mask_image = Image.open(mask_path)
+            if mask_image.size != main_image.size:
+                working_mode = mask_pipeline.mask_working_mode(mask_image, "cutout", True)
+                mask_image = mask_pipeline.resize_mask(mask_image.convert(working_mode), main_image.size)
+            mask = np.asarray(mask_image.convert("L"))
+            seconds["decode_mask"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+            seconds["label"] = time.perf_counter() - started
+
+            for label in range(1, count):
+                x, y, w, h, _ = (int(value) for value in stats[label])
+                started = time.perf_counter()
+                cropped = mask_pipeline.crop_object(main_image, mask, labels, label, (x, y, x + w, y + h))
+                marks = [started, time.perf_counter()]
+                buffer = io.BytesIO()
+                mask_pipeline.encode_image(cropped, buffer, encoder)
+                marks.append(time.perf_counter())
+                with open(os.path.join(scratch, "split-object"), "wb") as output_file:
+                    output_file.write(buffer.getbuffer())
+                marks.append(time.perf_counter())
+                for stage, begun, finished in zip(("crop", "encode", "write"), marks, marks[1:]):
+                    seconds[stage] += finished - begun
+            for stage in stage_names:
+                samples[stage].append(seconds[stage])
+    for stage in stage_names:
+        rows.append({
+            "case": f"stage/split/{stage}",
+            "mean_ms": 1000 * statistics.mean(samples[stage]),
+            "median_ms": 1000 * statistics.median(samples[stage]),
+        })
+    return rows
+
+def environment():
+    """Describe the code and machine the numbers were measured on."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "numpy": numpy_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def run_benchmark(args):
+    """Generate the dataset, run every case and return the report dict."""
+    width, height = (int(value) for value in args.size.lower().split("x"))
+    scratch = tempfile.mkdtemp(prefix="mask-bench-")
+    try:
+        folder = args.dataset or os.path.join(scratch, "dataset")
+        if not os.path.isdir(folder) or not os.listdir(folder):
+            print(f"Generating {args.pairs} pairs of {width}x{height} in {folder}...")
+            generate_dataset(folder, args.pairs, (width, height), args.mask_scale, args.seed, args.mask_modes)
+        pairs = list_pairs(folder)
+
+        rows = []
+        print("Timing end-to-end runs...")
+        rows += bench_end_to_end(folder, scratch, args.modes, args.backends, args, pairs)
+        print("Timing individual stages...")
+        rows += bench_stages(pairs[:args.stage_pairs], args.modes, args.encoder, args.repeat, args.mask_filter)
+        print("Timing mask resizing...")
+        rows += bench_resize((width, height), args.repeat, args.seed)
+        if not args.skip_split:
+            print("Timing split_objects_by_mask...")
+            rows += bench_split(pairs, scratch, args.repeat, args.stage_pairs, args.encoder)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    config = {
+        key: getattr(args, key)
+        for key in (
+            "pairs", "size", "mask_scale", "mask_modes", "seed", "repeat", "workers", "io_threads",
+            "encoder", "strip_height", "modes", "backends", "mask_filter",
+        )
+    }
+    return {"environment": environment(), "config": config, "results": rows}
+
+def print_report(report):
+    """Print the result rows of a report as a table."""
+    for row in report["results"]:
+        if "best_seconds" in row:
+            print(f"{row['case']:<32} {row['best_seconds']:9.3f} s  {row['pairs_per_second']:9.2f} pairs/s")
+        elif "speedup" in row:
+            chosen = f"  ({row['chosen']})" if row.get("chosen") else ""
+            print(f"{row['case']:<32} {row['mean_ms']:9.2f} ms mean  {row['speedup']:9.2f}x{chosen}")
+        elif "mean_ms" in row:
+            print(f"{row['case']:<32} {row['mean_ms']:9.2f} ms mean  {row['median_ms']:9.2f} ms median")
+        elif "identical" in row:
+            print(f"{row['case']:<32} {'identical' if row['identical'] else 'DIFFERENT'} to {row['identical_to']}")
+        else:
+            print(f"{row['case']:<32} skipped: {row['skipped']}")
+
+def compare_reports(old_path, new_path):
+    """Print how every timed case changed between two report files."""
+    with open(old_path, encoding="utf-8") as old_file:
+        old = json.load(old_file)
+    with open(new_path, encoding="utf-8") as new_file:
+        new = json.load(new_file)
+    print(f"old: {old['environment'].get('commit')}  new: {new['environment'].get('commit')}")
+    old_rows = {row["case"]: row for row in old["results"]}
+    for row in new["results"]:
+        previous = old_rows.get(row["case"])
+        for key in ("best_seconds", "mean_ms"):
+            if key in row and previous and key in previous and row[key]:
+                speedup = previous[key] / row[key]
+                print(f"{row['case']:<32} {previous[key]:10.3f} -> {row[key]:10.3f}  ({speedup:5.2f}x)")
+
+def build_parser():
+    """Create the benchmark's argument parser."""
+    parser = argparse.ArgumentParser(description="Benchmark the mask pipeline.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="generate a dataset and time the pipeline")
+    run.add_argument("--pairs", type=int, default=20)
+    run.add_argument("--size", default="1920x1080", help="main image size, WIDTHxHEIGHT")
+    run.add_argument("--mask-scale", type=float, nargs="+", default=[1.0, 0.5],
+                     help="mask size relative to the main image, cycled over the pairs")
+    run.add_argument("--mask-modes", nargs="+", default=["L", "RGB", "P"], choices=("L", "RGB", "P"),
+                     help="mask image modes, each combined with every --mask-scale")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--repeat", type=int, default=3, help="runs per case; the best one is reported")
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--io-threads", type=int, default=2, help="pipeline threads when --workers is 1")
+    run.add_argument("--encoder", default="balanced")
+    run.add_argument("--strip-height", type=int, default=None)
+    run.add_argument("--mask-filter", choices=mask_pipeline.MASK_FILTERS, default=mask_pipeline.DEFAULT_RESIZE_FILTER,
+                     help="filter for masks of another size in the end-to-end and stage timings")
+    run.add_argument("--modes", nargs="+", default=["cutout", "darken"], help="any blend modes, e.g. multiply gamma")
+    run.add_argument("--backends", nargs="+", default=["pil", "numpy"])
+    run.add_argument("--skip-split", action="store_true", help="do not time split_objects_by_mask")
+    run.add_argument("--stage-pairs", type=int, default=5, help="pairs used for per-stage timing")
+    run.add_argument("--dataset", help="reuse (or create) the dataset in this folder")
+    run.add_argument("--output", help="write the JSON report here")
+
+    compare = commands.add_parser("compare", help="compare two JSON reports")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    return parser
+
+def main(argv=None):
+    """Entry point."""
+    args = build_parser().parse_args(argv)
+    if args.command == "compare":
+        compare_reports(args.old, args.new)
+        return 0
+
+    report = run_benchmark(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+        print(f"Report written to {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
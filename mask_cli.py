@@ -0,0 +1,267 @@
+"""
+Command-line entry point for the mask pipeline, for cron jobs, containers and
+servers without a display. Tkinter is never imported, and mask_pipeline is
+only imported after the arguments are parsed, so --help answers immediately.
+
+    python mask_cli.py process INPUT OUTPUT --mode cutout --workers 8
+    python mask_cli.py watch INPUT OUTPUT --mode cutout
+    python mask_cli.py process INPUT OUTPUT --shard 3/16
+    python mask_cli.py merge OUTPUT
+    python mask_cli.py plan INPUT
+    python mask_cli.py stack INPUT OUTPUT --mode cutout
+    python mask_cli.py split MAIN MASK OUTPUT
+    python mask_cli.py split-folder INPUT OUTPUT --min-area 50
+    python mask_cli.py encoders MAIN MASK --mode cutout
+"""
+import argparse
+import os
+import sys
+
+# Options checked against these mask_pipeline registries once it is imported (see check_choices),
+# so that parsing never imports it and modes added with register_blend_mode are accepted
+REGISTRIES = {
+    "mode": "BLEND_MODES", "backend": "BACKENDS", "encoder": "ENCODER_PRESETS", "mask_filter": "MASK_FILTERS",
+}
+
+def build_parser():
+    """Create the argument parser with one subcommand per pipeline operation."""
+    parser = argparse.ArgumentParser(description="Apply masks to images without the GUI.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    process = commands.add_parser("process", help="process every _main/_mask pair in a folder")
+    process.add_argument("--io-threads", type=int, default=2,
+                         help="decode and write threads when --workers is 1, 0 = one pair at a time")
+    process.add_argument("--recursive", action="store_true", help="also process subfolders")
+    process.add_argument("--output-archive", default=None,
+                         help="store the results in this .zip instead of OUTPUT (which keeps the manifest and report)")
+    process.add_argument("--plan", action="store_true",
+                         help="read every image header first and process the largest pairs first")
+    process.add_argument("--memory-budget-mb", type=int, default=None,
+                         help="limit the estimated memory of pairs processed at once (implies --plan)")
+    process.add_argument("--dedupe", choices=("hardlink", "reflink", "copy"), default=None,
+                         help="make outputs of byte-identical pairs once and link the copies by this method")
+    process.add_argument("--shard", default=None,
+                         help="K/N: process only the K-th of N disjoint sets of pairs, e.g. one per machine")
+
+    watch = commands.add_parser("watch", help="keep processing pairs as they arrive in a folder, until Ctrl+C")
+    watch.add_argument("--settle", type=float, default=1.0,
+                       help="seconds a file must stay unchanged before it is read")
+    watch.add_argument("--poll", action="store_true",
+                       help="scan the folder instead of using inotify (e.g. for network shares)")
+    watch.add_argument("--poll-interval", type=float, default=2.0, help="seconds between scans with --poll")
+
+    pairs_help = "folder with *_main.png and *_mask.png files"
+    for command, input_help in ((process, pairs_help + ", or a .zip/.tar archive of them"), (watch, pairs_help)):
+        command.add_argument("input", help=input_help)
+        command.add_argument("output", help="folder for the results")
+        command.add_argument("--mode", nargs="+", default=["cutout"],
+                             help="one or more blend modes of mask_pipeline.BLEND_MODES, e.g. cutout or darken; "
+                                  "several are made from a single read of each pair")
+        command.add_argument("--workers", type=int, default=None,
+                             help="worker processes (default: CPU count, 1 = no pool)")
+        command.add_argument("--force", action="store_true",
+                             help="reprocess pairs the manifest says are unchanged")
+        command.add_argument("--backend", default="pil", help="pil or numpy")
+        command.add_argument("--strip-height", type=int, default=None,
+                             help="stream images in strips of this many rows")
+        command.add_argument("--encoder", default="balanced", help="encoder preset, e.g. fast, balanced or smallest")
+        command.add_argument("--trim", action="store_true",
+                             help="crop cutout results to their visible pixels; offsets go to <output>.json")
+        command.add_argument("--trim-padding", type=int, default=0, help="pixels kept around a trimmed cutout")
+        command.add_argument("--mask-filter", default="bicubic",
+                             help="how masks of another size are resized: nearest for hard mattes, "
+                                  "bilinear or lanczos for soft ones, auto to choose per mask")
+        command.add_argument("--mask-cache-mb", type=int, default=256,
+                             help="decoded mask cache per process, 0 to disable")
+        command.add_argument("--report", default=None,
+                             help="JSON run report path (default: mask_run_report.json in OUTPUT)")
+        command.add_argument("--prometheus", default=None,
+                             help="also write run metrics to this Prometheus textfile")
+
+    plan = commands.add_parser("plan", help="estimate the size of a job from image headers only")
+    plan.add_argument("input", help=pairs_help + ", or a .zip/.tar archive of them")
+    plan.add_argument("--mode", nargs="+", default=["cutout"], help="blend modes, as for process")
+    plan.add_argument("--recursive", action="store_true", help="also look in subfolders")
+    plan.add_argument("--strip-height", type=int, default=None, help="estimate memory for streaming in strips")
+    plan.add_argument("--top", type=int, default=10, help="list this many of the largest pairs")
+    plan.add_argument("--shard", default=None, help="K/N: plan only the K-th of N shards")
+
+    merge = commands.add_parser("merge", help="combine the run reports of the shards of a run")
+    merge.add_argument("reports", nargs="+",
+                       help="shard run reports, or output folders to take mask_run_report.K-of-N.json files from")
+    merge.add_argument("--output", default=None,
+                       help="merged report path (default: mask_run_report.json next to the first report)")
+
+    stack = commands.add_parser("stack", help="write the results into memory-mapped .npy arrays, one per image size")
+    stack.add_argument("input", help=pairs_help + ", or a .zip/.tar archive of them")
+    stack.add_argument("output", help="folder for the .npy stacks and stack_index.json")
+    stack.add_argument("--mode", nargs="+", default=["cutout"], help="blend modes, one stack per mode and size")
+    stack.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count, 1 = no pool)")
+    stack.add_argument("--recursive", action="store_true", help="also process subfolders")
+    stack.add_argument("--backend", default="numpy",
+                       help="numpy composites straight into the stack, pil copies its result in")
+    stack.add_argument("--mask-cache-mb", type=int, default=256, help="decoded mask cache per process, 0 to disable")
+    stack.add_argument("--mask-filter", default="bicubic",
+                       help="how masks of another size are resized, as for process")
+
+    split = commands.add_parser("split", help="save every object of a mask as a separate PNG")
+    split.add_argument("main", help="main image")
+    split.add_argument("mask", help="mask image")
+    split.add_argument("output", help="folder for the objects")
+
+    split_folder = commands.add_parser("split-folder", help="split every _main/_mask pair in a folder")
+    split_folder.add_argument("input", help="folder with *_main.png and *_mask.png files, or a .zip/.tar archive of them")
+    split_folder.add_argument("output", help="folder for the objects, one subfolder per pair")
+    split_folder.add_argument("--recursive", action="store_true", help="also process subfolders")
+    for command in (split, split_folder):
+        command.add_argument("--min-area", type=int, default=0, help="skip objects with fewer pixels than this")
+        command.add_argument("--threads", type=int, default=None,
+                             help="threads encoding and writing objects (default: CPU count)")
+        command.add_argument("--encoder", default="balanced", help="encoder preset, e.g. fast, balanced or smallest")
+        command.add_argument("--atlas", action="store_true",
+                             help="pack the objects into atlas_N images indexed by atlas.json instead of object_N files")
+        command.add_argument("--atlas-size", type=int, default=4096, help="largest side of an atlas image")
+
+    encoders = commands.add_parser("encoders", help="time and size every encoder preset on one pair")
+    encoders.add_argument("main", help="main image of a typical pair")
+    encoders.add_argument("mask", help="its mask")
+    encoders.add_argument("--mode", default="cutout", help="blend mode, as for process")
+    encoders.add_argument("--backend", default="pil", help="pil or numpy")
+    encoders.add_argument("--encoder", nargs="+", default=None,
+                          help="presets to compare (default: all)")
+    return parser
+
+def check_choices(parser, args):
+    """
+    Exit with a usage error, like argparse's own choices, when an option
+    names something the mask_pipeline registries (REGISTRIES) do not hold.
+    """
+    import mask_pipeline
+
+    for option, registry_name in REGISTRIES.items():
+        registry = getattr(mask_pipeline, registry_name)
+        values = getattr(args, option, None)
+        for value in values if isinstance(values, list) else [values]:
+            if value is not None and value not in registry:
+                parser.error(
+                    f"argument --{option.replace('_', '-')}: invalid choice: {value!r} "
+                    f"(choose from {', '.join(map(repr, registry))})"
+                )
+
+def main(argv=None):
+    """Run the CLI and return the process exit code."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    import mask_pipeline
+
+    check_choices(parser, args)
+    if args.command == "split":
+        mask_pipeline.split_objects_by_mask(
+            args.main, args.mask, args.output, min_area=args.min_area, threads=args.threads, encoder=args.encoder,
+            atlas_size=args.atlas_size if args.atlas else None,
+        )
+        return 0
+    if args.command == "encoders":
+        mask_pipeline.compare_encoders(args.main, args.mask, args.mode, args.backend, args.encoder)
+        return 0
+    if args.command == "plan":
+        entries, _ = mask_pipeline.plan_images(
+            args.input, args.mode, recursive=args.recursive, strip_height=args.strip_height, shard=args.shard,
+        )
+        for entry in entries[:args.top]:
+            if entry["main"] is None:
+                continue
+            mask_width, mask_height = entry["mask"]["size"]
+            mask_note = f" (mask {mask_width}x{mask_height}, resized)" if entry["resize"] else ""
+            print(
+                f"{entry['base_name']}: {entry['main']['size'][0]}x{entry['main']['size'][1]} "
+                f"{entry['main']['mode']}{mask_note}, about {entry['memory'] / 2 ** 20:.0f} MiB"
+            )
+        return 0
+    if args.command == "merge":
+        paths = []
+        for path in args.reports:
+            paths.extend(mask_pipeline.shard_report_paths(path) if os.path.isdir(path) else [path])
+        if not paths:
+            print("No shard run reports found.")
+            return 1
+        report = mask_pipeline.merge_run_reports(paths)
+        output = args.output or os.path.join(os.path.dirname(paths[0]), mask_pipeline.RUN_REPORT_NAME)
+        mask_pipeline.write_run_report(output, report)
+        counts = report["counts"]
+        print(
+            f"Merged {len(report['shards'])} shard reports: {counts['saved']} saved, {counts['skipped']} unchanged, "
+            f"{counts['failed']} failed, {counts['unmatched']} without a mask, "
+            f"{counts['orphans']} masks without a main image, in {report['wall_seconds']:.1f} s. Report: {output}"
+        )
+        for failure in report["failures"]:
+            print(f"Failed: {failure['output']}: {failure['error']}")
+        if report["missing_shards"]:
+            shard_count = report["shards"][0]["shard"][1]
+            print("No report for shards " + ", ".join(
+                f"{index}/{shard_count}" for index in report["missing_shards"]
+            ) + ".")
+        return 1 if counts["failed"] or report["missing_shards"] else 0
+    if args.command == "stack":
+        result = mask_pipeline.stack_images(
+            args.input, args.output, args.mode, workers=args.workers, recursive=args.recursive,
+            backend=args.backend, mask_cache_mb=args.mask_cache_mb, resize_filter=args.mask_filter,
+        )
+        print(
+            f"Stacking complete: {result['pairs']} pairs in {result['stacks']} stacks, {result['failed']} failed, "
+            f"{result['unmatched']} without a mask, {result['orphans']} masks without a main image. "
+            f"Index: {result['index_path']}"
+        )
+        return 1 if result["failed"] else 0
+    if args.command == "split-folder":
+        result = mask_pipeline.split_images(
+            args.input, args.output, min_area=args.min_area, recursive=args.recursive,
+            threads=args.threads, encoder=args.encoder, atlas_size=args.atlas_size if args.atlas else None,
+        )
+        print(
+            f"Split complete: {result['objects']} objects from {result['pairs']} pairs, "
+            f"{result['dropped']} below --min-area, {result['failed']} failed, "
+            f"{result['unmatched']} without a mask, {result['orphans']} masks without a main image."
+        )
+        return 1 if result["failed"] else 0
+
+    options = dict(
+        workers=args.workers,
+        force=args.force,
+        backend=args.backend,
+        strip_height=args.strip_height,
+        encoder=args.encoder,
+        mask_cache_mb=args.mask_cache_mb,
+        trim=args.trim,
+        trim_padding=args.trim_padding,
+        resize_filter=args.mask_filter,
+        report_path=args.report,
+        prometheus_path=args.prometheus,
+    )
+    if args.command == "watch":
+        result = mask_pipeline.watch_folder(
+            args.input, args.output, args.mode,
+            settle_seconds=args.settle, poll=args.poll, poll_interval=args.poll_interval, **options,
+        )
+        return 1 if result["failed"] else 0
+
+    result = mask_pipeline.process_images(
+        args.input, args.output, args.mode,
+        io_threads=args.io_threads,
+        recursive=args.recursive,
+        output_archive=args.output_archive,
+        plan=args.plan,
+        memory_budget_mb=args.memory_budget_mb,
+        shard=args.shard,
+        dedupe=args.dedupe,
+        **options,
+    )
+    print(
+        f"{' + '.join(args.mode).capitalize()} processing complete: {result['saved']} saved, "
+        f"{result['skipped']} unchanged, {result['failed']} failed, "
+        f"{result['unmatched']} without a mask, {result['orphans']} masks without a main image."
+    )
+    return 1 if result["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
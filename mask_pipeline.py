@@ -0,0 +1,3130 @@
+"""
+Image/mask compositing pipeline used by the Photo Mask Application.
+Everything here can be imported without a display: Tkinter is only used by
+the GUI scripts, and numpy and cv2 are imported by the functions that need them.
+"""
+import glob
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import struct
+import tarfile
+import threading
+import time
+import warnings
+import zipfile
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageChops
+
+BLEND_OPERATIONS = ("alpha", "darker", "multiply", "screen")  # see register_blend_mode
+MATTE_THRESHOLD = 128  # mask level from which the 'threshold' mode keeps a pixel
+MATTE_GAMMA = 2.2  # exponent of the 'gamma' mode's mask curve; above 1 narrows soft edges
+BACKENDS = ("pil", "numpy")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}  # PNG colour type -> samples per pixel
+PNG_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}  # PNG colour type -> closest Pillow mode
+PNG_READ_SIZE = 1 << 20  # compressed bytes fed to zlib at a time when streaming
+PNG_IDAT_SIZE = 1 << 16  # size of the IDAT chunks written when streaming
+PNG_FILTER_BLOCK_ROWS = 16  # rows filtered together, bounds filter_png_rows' scratch memory
+PNG_IEND = b"\x00\x00\x00\x00IEND\xaeB`\x82"  # the chunk every complete PNG file ends with
+# Output encoders: Pillow format name, file extension and save() options.
+# "balanced" matches Pillow's defaults and is what earlier versions wrote.
+ENCODER_PRESETS = {
+    "fast": {"format": "PNG", "extension": ".png",
+             "options": {"compress_level": 1, "optimize": False, "compress_type": zlib.Z_RLE}},
+    "balanced": {"format": "PNG", "extension": ".png", "options": {}},
+    "smallest": {"format": "PNG", "extension": ".png",
+                 "options": {"compress_level": 9, "optimize": True}},
+    "webp-lossless": {"format": "WEBP", "extension": ".webp",
+                      "options": {"lossless": True, "exact": True, "quality": 50, "method": 2}},
+    "tiff": {"format": "TIFF", "extension": ".tiff", "options": {"compression": "raw"}},
+}
+DEFAULT_ENCODER = "balanced"
+DEFAULT_MASK_CACHE_MB = 256  # per process, see MaskCache
+MANIFEST_NAME = "mask_manifest.jsonl"
+MANIFEST_FIELDS = ("output", "main_path", "mask_path", "main", "mask", "settings")
+STAGES = ("decode", "resize", "composite", "encode", "write")  # see StageTimer
+PERCENTILES = (0.5, 0.9, 0.99)
+RUN_REPORT_NAME = "mask_run_report.json"
+DEFAULT_IO_THREADS = 2  # decode and encode/write threads of PairPipeline
+DEFAULT_ATLAS_SIZE = 4096  # largest side of a sprite atlas page, see pack_shelves
+ATLAS_PADDING = 1  # transparent pixels between packed objects
+ATLAS_INDEX_NAME = "atlas.json"
+DEFAULT_SETTLE_SECONDS = 1.0  # watch_folder: how long a file must stay unchanged before it is read
+DEFAULT_POLL_INTERVAL = 2.0  # watch_folder: seconds between folder scans without inotify
+WATCH_REPORT_INTERVAL = 30.0  # watch_folder: seconds between run report refreshes
+ARCHIVE_EXTENSIONS = (".zip", ".tar")  # archives whose members are read in place, see ArchiveIndex
+COMPRESSED_TAR_EXTENSIONS = (".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+ARCHIVE_SEPARATOR = "!/"  # between the archive and the member in archive_member_path
+SHARD_SEPARATOR = "/"  # process_images(shard="3/16")
+DEFAULT_PREVIEW_SIZE = (640, 480)  # largest preview rendered by render_preview
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA")  # modes Image.reduce accepts among those of our inputs
+STACK_INDEX_NAME = "stack_index.json"  # written by stack_images next to its .npy stacks
+DEDUPE_LINKS = ("hardlink", "reflink", "copy")  # how OutputDeduper materialises a repeated output
+FICLONE = 0x40049409  # Linux ioctl cloning a file's extents (reflink) on btrfs, XFS and similar
+HASH_CHUNK_SIZE = 1 << 20  # bytes hashed at a time by OutputDeduper
+RESIZE_FILTERS = {  # mask resampling filters by name, see resize_mask
+    "nearest": Image.NEAREST, "box": Image.BOX, "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC, "lanczos": Image.LANCZOS,
+}
+MASK_FILTERS = ("auto",) + tuple(RESIZE_FILTERS)  # accepted resize_filter values, see choose_resize_filter
+DEFAULT_RESIZE_FILTER = "bicubic"  # Image.resize's own default, so outputs match earlier versions
+RESAMPLE_SUPPORTS = {"box": 0.5, "bilinear": 1.0, "bicubic": 2.0, "lanczos": 3.0}  # as in Pillow's Resample.c
+RESAMPLE_PRECISION_BITS = 22  # fractional bits of Pillow's 8-bit resampling weights
+
+def apply_mask_and_cutout(image_main, image_mask):
+    """
+    Apply a mask to the main image to cut out areas based on the mask.
+    White areas in the mask remain visible, and black areas become transparent.
+    """
+    image_main = image_main.convert("RGBA")
+    image_mask = image_mask.convert("L")  # Convert mask to grayscale (L mode)
+    image_main.putalpha(image_mask)
+    return image_main
+
+def apply_darken_layer(image_main, image_mask):
+    """
+    Apply darken blending to combine mask onto the main image with no transparency.
+    """
+    return ImageChops.darker(image_main, image_mask)
+
+BLEND_CHOPS = {"darker": ImageChops.darker, "multiply": ImageChops.multiply, "screen": ImageChops.screen}
+BLEND_MODES = {}
+
+def register_blend_mode(name, operation, mask_lut=None):
+    """
+    Add a blend mode (or replace one) under name, which then works wherever
+    a mode is accepted and names its outputs (base_<name>.png). operation
+    is one of BLEND_OPERATIONS: 'alpha' makes the grayscale mask the alpha
+    channel (cutout); 'darker', 'multiply' and 'screen' combine the mask
+    with the image channel by channel, alpha included, like ImageChops.
+    mask_lut is an optional 256-entry table applied to the mask's colour
+    channels after resizing (threshold_lut, invert_lut, gamma_lut, ...),
+    with Image.point or array indexing. Worker processes only know modes
+    registered when mask_pipeline or the calling module is imported.
+    """
+    if operation not in BLEND_OPERATIONS:
+        raise ValueError(f"Unknown blend operation: {operation} (expected one of {', '.join(BLEND_OPERATIONS)})")
+    if mask_lut is not None:
+        mask_lut = [int(level) for level in mask_lut]
+        if len(mask_lut) != 256 or not all(0 <= level <= 255 for level in mask_lut):
+            raise ValueError(f"mask_lut must have 256 levels from 0 to 255, got {len(mask_lut)} entries")
+    BLEND_MODES[name] = {"operation": operation, "mask_lut": mask_lut}
+
+def blend_mode(name):
+    """Return the BLEND_MODES entry of a mode, or raise ValueError."""
+    entry = BLEND_MODES.get(name)
+    if entry is None:
+        raise ValueError(f"Unknown mode: {name} (expected one of {', '.join(BLEND_MODES)})")
+    return entry
+
+def threshold_lut(level=MATTE_THRESHOLD):
+    """Mask table for a hard matte: opaque from level up, transparent below."""
+    return [255 if value >= level else 0 for value in range(256)]
+
+def invert_lut():
+    """Mask table that swaps kept and removed areas."""
+    return [255 - value for value in range(256)]
+
+def gamma_lut(gamma=MATTE_GAMMA):
+    """Mask table raising the normalised mask to gamma, to narrow (> 1) or widen (< 1) soft edges."""
+    return [round(255 * (value / 255) ** gamma) for value in range(256)]
+
+register_blend_mode("cutout", "alpha")
+register_blend_mode("darken", "darker")
+register_blend_mode("multiply", "multiply")
+register_blend_mode("screen", "screen")
+register_blend_mode("threshold", "alpha", threshold_lut())
+register_blend_mode("invert", "alpha", invert_lut())
+register_blend_mode("gamma", "alpha", gamma_lut())
+MODES = tuple(BLEND_MODES)  # the built-in modes
+
+class StageTimer:
+    """
+    Wall-clock time one pair spends in each of STAGES. Every call to
+    mark(stage) charges the time since the previous mark to that stage, so
+    the stages add up to the time spent on the pair.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        """Charge the time since the previous mark to stage."""
+        now = time.perf_counter()
+        self.seconds[stage] += now - self._last
+        self._last = now
+
+    def resume(self):
+        """Restart the clock without charging the time since the last mark, e.g. time spent queued."""
+        self._last = time.perf_counter()
+
+class MaskCache:
+    """
+    Least-recently-used cache of decoded, converted and resized masks with a
+    byte budget. Entries are keyed by the mask file's content hash, the target
+    size and the form a compositing path needs, so many main images pointing
+    at copies of the same matte decode it only once per process. It can be
+    shared by the decode threads of a PairPipeline.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._used_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached mask for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, mask, size_bytes):
+        """Store a mask, evicting the least recently used ones to stay within budget."""
+        if size_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:  # another thread decoded the same mask meanwhile
+                return
+            self._entries[key] = (mask, size_bytes)
+            self._used_bytes += size_bytes
+            while self._used_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._used_bytes -= evicted_bytes
+
+mask_cache = MaskCache(DEFAULT_MASK_CACHE_MB << 20)
+pool_cancel = None  # multiprocessing.Event of the run a pool worker serves, see configure_pool_worker
+
+class ProxyCache(MaskCache):
+    """
+    MaskCache holding the downsampled proxies of load_proxy, keyed by path,
+    file_signature and proxy size, so stepping back and forth through pairs
+    in a preview decodes each file once.
+    """
+
+def configure_mask_cache(max_bytes):
+    """Replace this process's mask cache; also used as the worker pool initializer."""
+    global mask_cache
+    mask_cache = MaskCache(max_bytes)
+
+def configure_pool_worker(max_bytes, cancel=None):
+    """
+    Worker pool initializer of process_images: configure_mask_cache, and
+    keep the run's multiprocessing.Event so that pairs the pool had already
+    taken from its queue are skipped once the run is cancelled (process_pair).
+    """
+    global pool_cancel
+    configure_mask_cache(max_bytes)
+    pool_cancel = cancel
+
+def load_mask(mask_path, size, form, prepare, timer=None):
+    """
+    Return prepare(mask_image) for the mask at mask_path, where prepare turns
+    the decoded mask into what a compositing path needs at the given size.
+    Results are shared through mask_cache by content hash, size and form.
+    Reading and hashing the file is charged to the timer's decode stage.
+    """
+    return load_masks(mask_path, size, (form,), lambda mask_image, _: prepare(mask_image), timer)[form]
+
+def load_masks(mask_path, size, forms, prepare, timer=None):
+    """
+    Multi-form load_mask: return {form: prepare(mask_image, form)} for every
+    form. The file is read, hashed and decoded at most once for all of them;
+    prepare must not modify the decoded image it is given.
+    """
+    decoded = []
+
+    def decode(source):
+        if not decoded:
+            decoded.append(Image.open(source))
+        return decoded[0]
+
+    if mask_cache.max_bytes <= 0:
+        return {form: prepare(decode(input_source(mask_path)), form) for form in forms}
+
+    with open_input(mask_path) as mask_file:
+        data = mask_file.read()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    if timer is not None:
+        timer.mark("decode")
+    masks = {}
+    for form in forms:
+        key = (digest, size, form)
+        mask = mask_cache.get(key)
+        if mask is None:
+            mask = prepare(decode(io.BytesIO(data)), form)
+            if isinstance(mask, Image.Image):
+                size_bytes = mask.width * mask.height * len(mask.getbands())
+            else:
+                size_bytes = mask.nbytes
+            mask_cache.put(key, mask, size_bytes)
+        masks[form] = mask
+    return masks
+
+def mask_working_mode(mask_image, mode, resize):
+    """
+    Return the mode a mask is converted to before it is (optionally) resized,
+    so that the NumPy paths reproduce what composite_pil does with an RGBA mask.
+    """
+    if blend_mode(mode)["operation"] == "alpha":
+        if not resize or mask_image.mode in ("L", "1"):
+            return "L"
+        if mask_image.mode in ("RGBA", "LA", "PA") or "transparency" in mask_image.info:
+            # Pillow resizes RGBA with premultiplied alpha, which changes the
+            # colours the grayscale conversion sees, so keep that order here.
+            return "RGBA"
+        # Colour masks are resized before the grayscale conversion, as
+        # composite_pil does; converting first rounds differently.
+        return "RGB" if mask_image.mode in ("RGB", "P", "CMYK", "YCbCr") else "RGBA"
+    # Grayscale and RGB masks are combined channel by channel as they are;
+    # only a mask with its own alpha can change the alpha of the result.
+    if mask_image.mode in ("L", "RGB", "RGBA"):
+        return mask_image.mode
+    return "RGBA"
+
+def whole_factor(source_size, size):
+    """Return the (x, y) factors when size divides source_size exactly and is smaller, else None."""
+    (source_width, source_height), (width, height) = source_size, size
+    if source_width % width or source_height % height:
+        return None
+    factors = (source_width // width, source_height // height)
+    return factors if factors != (1, 1) else None
+
+def is_binary_mask(mask_image):
+    """Whether every band of a mask holds only 0 and 255, i.e. it is a hard matte."""
+    histogram = mask_image.histogram()
+    return not any(any(histogram[start + 1:start + 255]) for start in range(0, len(histogram), 256))
+
+def choose_resize_filter(mask_image, size, resize_filter):
+    """
+    Resolve resize_filter (one of MASK_FILTERS) for bringing mask_image,
+    already in its working mode, to size. 'auto' picks 'nearest' for hard
+    mattes (is_binary_mask), which keeps their edges hard and is the fastest,
+    'box' for downscales by whole factors (Image.reduce, see resize_mask) and
+    'bilinear' for everything else. Other names are returned as they are.
+    """
+    if resize_filter != "auto":
+        if resize_filter not in RESIZE_FILTERS:
+            raise ValueError(f"Unknown mask filter: {resize_filter} (expected one of {', '.join(MASK_FILTERS)})")
+        return resize_filter
+    if is_binary_mask(mask_image):
+        return "nearest"
+    if whole_factor(mask_image.size, size):
+        return "box"
+    return "bilinear"
+
+def resize_mask(mask_image, size, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Resample mask_image to size with a MASK_FILTERS filter. A mask already
+    at size is returned as it is, and a 'box' downscale by whole factors goes
+    through Image.reduce, which is several times faster than the box filter
+    and within one level of it.
+    """
+    if mask_image.size == size:
+        return mask_image
+    resize_filter = choose_resize_filter(mask_image, size, resize_filter)
+    factors = whole_factor(mask_image.size, size) if resize_filter == "box" else None
+    if factors:
+        return mask_image.reduce(factors)
+    return mask_image.resize(size, RESIZE_FILTERS[resize_filter])
+
+def resample_kernel(resize_filter, x):
+    """Pillow's weight for a source pixel x (scaled) pixels from the centre of a resampled one."""
+    if resize_filter == "box":
+        return 1.0 if -0.5 < x <= 0.5 else 0.0
+    x = abs(x)
+    if resize_filter == "bilinear":
+        return 1.0 - x if x < 1.0 else 0.0
+    if resize_filter == "bicubic":  # a = -0.5
+        if x < 1.0:
+            return (1.5 * x - 2.5) * x * x + 1
+        return (((x - 5) * x + 8) * x - 4) * -0.5 if x < 2.0 else 0.0
+    if x >= 3.0:  # lanczos
+        return 0.0
+    sinc = [1.0 if value == 0.0 else math.sin(value * math.pi) / (value * math.pi) for value in (x, x / 3)]
+    return sinc[0] * sinc[1]
+
+def resample_weights(source_length, length, resize_filter):
+    """
+    The fixed-point weights Pillow resamples 8-bit images with when it
+    brings source_length rows to length (precompute_coeffs and
+    normalize_coeffs_8bpc in Resample.c): a (length, taps) array of source
+    rows and one of their weights, zero past each row's own window.
+    """
+    import numpy as np
+
+    scale = source_length / length
+    filter_scale = max(scale, 1.0)
+    support = RESAMPLE_SUPPORTS[resize_filter] * filter_scale
+    taps = int(math.ceil(support)) * 2 + 1
+    rows = np.zeros((length, taps), dtype=np.intp)
+    weights = np.zeros((length, taps), dtype=np.int64)
+    for index in range(length):
+        center = (index + 0.5) * scale
+        first = max(int(center - support + 0.5), 0)
+        window = range(first, min(int(center + support + 0.5), source_length))
+        kernel = [resample_kernel(resize_filter, (row - center + 0.5) * (1.0 / filter_scale)) for row in window]
+        total = sum(kernel)
+        rows[index] = first
+        rows[index, :len(window)] = window
+        for tap, weight in enumerate(kernel):
+            weight = weight / total if total != 0.0 else weight
+            weights[index, tap] = int((0.5 if weight >= 0 else -0.5) + weight * (1 << RESAMPLE_PRECISION_BITS))
+    return rows, weights
+
+def resample_rows(image, rows, weights):
+    """
+    Pillow's vertical resampling pass over an 8-bit image: row i of the
+    result weighs the image rows in rows[i] by weights[i] (see
+    resample_weights).
+    """
+    import numpy as np
+
+    array = np.frombuffer(image.tobytes(), dtype=np.uint8).reshape(image.height, image.width, -1)
+    total = np.full((len(rows),) + array.shape[1:], 1 << (RESAMPLE_PRECISION_BITS - 1), dtype=np.int64)
+    for tap in range(rows.shape[1]):
+        total += array[rows[:, tap]] * weights[:, tap, None, None]
+    total >>= RESAMPLE_PRECISION_BITS
+    return Image.frombytes(image.mode, (image.width, len(rows)), np.clip(total, 0, 255).astype(np.uint8).tobytes())
+
+def nearest_indices(source_length, length):
+    """The source index Image.resize picks with NEAREST for each of length pixels."""
+    import numpy as np
+
+    indices = Image.fromarray(np.arange(source_length, dtype=np.int32)[:, None])
+    return np.asarray(indices.resize((1, length), Image.NEAREST))[:, 0]
+
+def iter_resized_strips(mask_image, size, strip_height, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Yield resize_mask(mask_image, size, resize_filter) for a mask in an L,
+    RGB or RGBA working mode, strip_height rows at a time and pixel for
+    pixel, working only on the source rows each strip needs. Resizing each
+    strip's own box would round Pillow's filter weights differently, so
+    'nearest' takes the rows and columns Pillow picks, and the other filters
+    run Pillow's horizontal pass on those rows and repeat its vertical pass
+    with resample_rows, in the order Image.resize runs them.
+    """
+    import numpy as np
+
+    (mask_width, mask_height), (width, height) = mask_image.size, size
+    resize_filter = choose_resize_filter(mask_image, size, resize_filter)
+    factors = whole_factor(mask_image.size, size) if resize_filter == "box" else None
+    if resize_filter == "nearest":
+        rows, columns = nearest_indices(mask_height, height)[:, None], nearest_indices(mask_width, width)
+        weights = None
+    elif height != mask_height and not factors:
+        rows, weights = resample_weights(mask_height, height, resize_filter)
+    else:
+        rows, weights = np.arange(height)[:, None] * (factors or (1, 1))[1], None
+    # Image.resize shrinks masks over 100 times taller than wide vertically first
+    vertical_first = mask_height > mask_width * 100 and height < mask_height
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        strip_rows = rows[top:bottom]
+        first, last = int(strip_rows.min()), int(strip_rows.max()) + 1
+        if factors:
+            yield mask_image.reduce(factors, (0, first, mask_width, last + factors[1] - 1))
+            continue
+        source = mask_image.crop((0, first, mask_width, last))
+        if resize_filter == "nearest":
+            yield Image.fromarray(np.asarray(source)[strip_rows[:, 0] - first][:, columns], mask_image.mode)
+            continue
+        if source.mode == "RGBA":
+            source = source.convert("RGBa")  # Pillow resizes RGBA with premultiplied alpha
+        if not vertical_first:
+            source = source.resize((width, source.height), RESIZE_FILTERS[resize_filter])
+        if weights is not None:
+            source = resample_rows(source, strip_rows - first, weights[top:bottom])
+        if vertical_first:
+            source = source.resize((width, source.height), RESIZE_FILTERS[resize_filter])
+        yield source.convert("RGBA") if source.mode == "RGBa" else source
+
+def mask_to_array(mask_image, mode):
+    """
+    Turn a converted and resized mask into an (h, w, channels) array for
+    composite_arrays, with the mode's mask_lut applied to its colour channels.
+    """
+    import numpy as np
+
+    entry = blend_mode(mode)
+    if entry["operation"] == "alpha" and mask_image.mode != "L":
+        mask_image = mask_image.convert("L")
+    mask = np.asarray(mask_image)
+    if mask.ndim == 2:
+        mask = mask[..., None]  # broadcast a single channel over R, G and B
+    if entry["mask_lut"] is not None:
+        mask = mask.copy()
+        colours = mask[..., :3]
+        colours[...] = np.asarray(entry["mask_lut"], dtype=np.uint8)[colours]
+    return mask
+
+def combine_channels(operation, source, mask, out):
+    """Write ImageChops' darker, multiply or screen of two uint8 arrays (or levels) into out."""
+    import numpy as np
+
+    if operation == "darker":
+        np.minimum(source, mask, out=out)
+    elif operation == "multiply":
+        out[...] = np.multiply(source, mask, dtype=np.uint16) // 255
+    else:
+        out[...] = 255 - np.multiply(255 - np.uint16(source), 255 - np.uint16(mask)) // 255
+
+def composite_arrays(source, mask, mode, out=None):
+    """
+    Fused kernel of every blend mode: combine an RGB or RGBA source array
+    with a mask array from mask_to_array of the same height and width into
+    a new RGBA array, or into out (an (h, w, 4) uint8 array such as a slot
+    of a stack_images stack). Sources and masks without alpha count as opaque.
+    """
+    import numpy as np
+
+    height, width = source.shape[:2]
+    pixels = np.empty((height, width, 4), dtype=np.uint8) if out is None else out
+    operation = blend_mode(mode)["operation"]
+    if operation == "alpha":
+        pixels[..., :3] = source[..., :3]
+        pixels[..., 3] = mask[..., 0]
+    else:
+        combine_channels(operation, source[..., :3], mask[..., :3], pixels[..., :3])
+        source_alpha = source[..., 3] if source.shape[2] == 4 else np.uint8(255)
+        mask_alpha = mask[..., 3] if mask.shape[2] == 4 else np.uint8(255)
+        combine_channels(operation, source_alpha, mask_alpha, pixels[..., 3])
+    return pixels
+
+def composite_numpy(main_path, mask_path, mode, timer=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    NumPy compositing backend for every blend mode (BLEND_MODES).
+    The mask is decoded straight to the channels the mode needs (a single
+    channel for cutout-like modes), only those channels are resized, and the result is
+    written once into a fresh RGBA array; neither image is converted to RGBA
+    first. Output is identical to composite_pil.
+    """
+    timer = timer or StageTimer()
+    main_image, masks = decode_numpy(main_path, mask_path, (mode,), timer, resize_filter)
+    return blend_numpy(main_image, masks[mode], mode, timer)
+
+def decode_numpy(main_path, mask_path, modes, timer=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Decoding half of composite_numpy: return the main image in RGB or RGBA and
+    a dict with the mask array at its size for each of modes. The mask is
+    decoded once for all modes and resized with resize_mask.
+    """
+    timer = timer or StageTimer()
+    main_image = Image.open(input_source(main_path))
+    if main_image.mode not in ("RGB", "RGBA"):
+        main_image = main_image.convert("RGBA")
+    main_image.load()
+    timer.mark("decode")
+
+    def prepare(mask_image, form):
+        mode = form[1]
+        mask_image.load()
+        timer.mark("decode")
+        resize = mask_image.size != main_image.size
+        working_mode = mask_working_mode(mask_image, mode, resize)
+        if mask_image.mode != working_mode:
+            mask_image = mask_image.convert(working_mode)
+        mask = mask_to_array(resize_mask(mask_image, main_image.size, resize_filter), mode)
+        timer.mark("resize")
+        return mask
+
+    forms = [("numpy", mode, resize_filter) for mode in modes]
+    masks = load_masks(mask_path, main_image.size, forms, prepare, timer)
+    timer.mark("resize")
+    return main_image, {form[1]: mask for form, mask in masks.items()}
+
+def blend_numpy(main_image, mask, mode, timer=None):
+    """Blending half of composite_numpy."""
+    import numpy as np  # only needed by this backend
+
+    timer = timer or StageTimer()
+    result_image = Image.fromarray(composite_arrays(np.asarray(main_image), mask, mode))
+    timer.mark("composite")
+    return result_image
+
+def pad_box(box, size, padding):
+    """Grow a (left, top, right, bottom) box by padding pixels on every side, within an image of the given size."""
+    left, top, right, bottom = box
+    width, height = size
+    return (max(left - padding, 0), max(top - padding, 0), min(right + padding, width), min(bottom + padding, height))
+
+def trim_box(image, padding=0):
+    """
+    Return the box around the pixels of an RGBA image that are not fully
+    transparent, grown by padding, or None if the whole image is transparent.
+    """
+    box = image.getchannel("A").getbbox()
+    if box is None:
+        return None
+    return pad_box(box, image.size, padding)
+
+def trim_image(image, padding=0):
+    """
+    Crop an RGBA image to its trim_box. Returns the cropped image and the box;
+    a fully transparent image becomes a single transparent pixel and None.
+    """
+    box = trim_box(image, padding)
+    if box is None:
+        return Image.new("RGBA", (1, 1)), None
+    return image.crop(box), box
+
+def trim_record(canvas, box):
+    """
+    Describe where a trimmed output goes on the original canvas: its offset
+    and size ([0, 0] for an empty cutout) and the canvas size.
+    """
+    if box is None:
+        return {"canvas": list(canvas), "offset": [0, 0], "size": [0, 0]}
+    return {"canvas": list(canvas), "offset": list(box[:2]), "size": [box[2] - box[0], box[3] - box[1]]}
+
+def trim_sidecar_text(output_path, record):
+    """Return the JSON text of the sidecar of a trimmed output: its trim_record and image name."""
+    return json.dumps(dict(record, image=os.path.basename(output_path))) + "\n"
+
+def write_trim_sidecar(output_path, record):
+    """Save a trim_record next to its output as <output name>.json."""
+    write_text_atomically(os.path.splitext(output_path)[0] + ".json", trim_sidecar_text(output_path, record))
+
+def png_chunk(chunk_type, data):
+    """Serialize one PNG chunk."""
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+def iter_image_strips(path, strip_height):
+    """
+    Yield an image as consecutive horizontal strips of at most strip_height
+    rows. Non-interlaced 8-bit PNGs are streamed with iter_png_strips so only
+    one strip is decoded at a time; anything else is decoded whole and sliced.
+    """
+    with open_input(path) as image_file:
+        header = image_file.read(33)
+    if (
+        len(header) == 33
+        and header[:8] == PNG_SIGNATURE
+        and header[12:16] == b"IHDR"
+        and header[24] == 8  # bit depth
+        and header[28] == 0  # interlace method
+    ):
+        yield from iter_png_strips(path, strip_height)
+        return
+
+    image = Image.open(input_source(path))
+    width, height = image.size
+    for top in range(0, height, strip_height):
+        yield image.crop((0, top, width, min(top + strip_height, height)))
+
+def iter_png_strips(path, strip_height):
+    """
+    Decode a non-interlaced 8-bit PNG strip by strip. The IDAT stream is
+    inflated incrementally and each strip's filtered rows are wrapped in a
+    small stand-alone PNG for Pillow to unfilter. That PNG starts with the
+    previous strip's last row stored unfiltered, so Up/Average/Paeth rows
+    still see the row above them.
+    """
+    with open_input(path) as png_file:
+        png_file.seek(8)
+        header_chunks = []
+        while True:
+            length, chunk_type = struct.unpack(">I4s", png_file.read(8))
+            if chunk_type == b"IDAT":
+                break
+            data = png_file.read(length)
+            png_file.seek(4, os.SEEK_CUR)  # CRC
+            if chunk_type == b"IHDR":
+                width, height, bit_depth, color_type = struct.unpack(">IIBB", data[:10])
+            elif chunk_type in (b"PLTE", b"tRNS"):
+                header_chunks.append(png_chunk(chunk_type, data))
+
+        row_bytes = width * PNG_CHANNELS[color_type]
+        strip_bytes = strip_height * (row_bytes + 1)
+        decompressor = zlib.decompressobj()
+        buffer = bytearray()
+        previous_row = None
+        rows_left = height
+
+        def decode_strip(filtered_rows):
+            """Unfilter one strip with Pillow and remember its last row."""
+            nonlocal previous_row
+            rows = len(filtered_rows) // (row_bytes + 1)
+            context = 0 if previous_row is None else 1
+            ihdr = struct.pack(">IIBBBBB", width, rows + context, bit_depth, color_type, 0, 0, 0)
+            stream = b"\x00" + previous_row + filtered_rows if context else bytes(filtered_rows)
+            strip_png = (
+                PNG_SIGNATURE + png_chunk(b"IHDR", ihdr) + b"".join(header_chunks)
+                + png_chunk(b"IDAT", zlib.compress(stream, 0)) + png_chunk(b"IEND", b"")
+            )
+            strip = Image.open(io.BytesIO(strip_png))
+            strip.load()
+            previous_row = strip.crop((0, rows + context - 1, width, rows + context)).tobytes()
+            if context:
+                strip = strip.crop((0, 1, width, rows + 1))
+            return strip
+
+        while rows_left:
+            # Feed the current IDAT chunk in pieces, never inflating more than a strip at a time
+            while length:
+                data = png_file.read(min(length, PNG_READ_SIZE))
+                if not data:
+                    raise ValueError(f"Truncated PNG data in {path}")
+                length -= len(data)
+                while data:
+                    buffer += decompressor.decompress(data, strip_bytes)
+                    data = decompressor.unconsumed_tail
+                    while len(buffer) >= strip_bytes and rows_left:
+                        strip = decode_strip(buffer[:strip_bytes])
+                        del buffer[:strip_bytes]
+                        rows_left -= strip.height
+                        yield strip
+            if not rows_left:
+                break
+            png_file.seek(4, os.SEEK_CUR)  # CRC
+            length, chunk_type = struct.unpack(">I4s", png_file.read(8))
+            if chunk_type != b"IDAT":
+                buffer += decompressor.flush()
+                if len(buffer) != rows_left * (row_bytes + 1):
+                    raise ValueError(f"Truncated PNG data in {path}")
+                strip = decode_strip(buffer)
+                rows_left -= strip.height
+                yield strip
+
+def filter_png_rows(rows, previous_row, bytes_per_pixel):
+    """
+    Filter raw PNG rows (a 2-D uint8 array) and return the filtered scanlines,
+    each prefixed with its filter type. Like Pillow's encoder, every row gets
+    whichever of the five PNG filters has the smallest sum of absolute
+    residuals.
+    """
+    import numpy as np
+
+    raw = rows.astype(np.int16)
+    up = np.vstack([previous_row[None].astype(np.int16), raw[:-1]])
+    left = np.zeros_like(raw)
+    left[:, bytes_per_pixel:] = raw[:, :-bytes_per_pixel]
+    upper_left = np.zeros_like(raw)
+    upper_left[:, bytes_per_pixel:] = up[:, :-bytes_per_pixel]
+
+    estimate = left + up - upper_left
+    distance_left = np.abs(estimate - left)
+    distance_up = np.abs(estimate - up)
+    distance_upper_left = np.abs(estimate - upper_left)
+    paeth = np.where(
+        (distance_left <= distance_up) & (distance_left <= distance_upper_left),
+        left,
+        np.where(distance_up <= distance_upper_left, up, upper_left),
+    )
+    candidates = np.stack([raw, raw - left, raw - up, raw - ((left + up) >> 1), raw - paeth])
+    candidates = (candidates & 0xFF).astype(np.uint8)
+    cost = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    choice = cost.argmin(axis=0)
+
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = choice
+    filtered[:, 1:] = candidates[choice, np.arange(rows.shape[0])]
+    return filtered
+
+class PngStripWriter:
+    """
+    Write an 8-bit RGBA PNG strip by strip: rows are filtered with
+    filter_png_rows and deflated incrementally, so only the strip being
+    written is held in memory. path may also be a binary file object, which
+    is left open.
+    """
+
+    def __init__(self, path, width, height, compress_level=6, compress_type=zlib.Z_DEFAULT_STRATEGY, timer=None):
+        import numpy as np
+
+        self._owns_file = isinstance(path, str)
+        self._file = open_output(path) if self._owns_file else path
+        self._file.write(PNG_SIGNATURE)
+        self._file.write(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        self._compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 8, compress_type)
+        self._previous_row = np.zeros(width * 4, dtype=np.uint8)
+        self._pending = bytearray()
+        self._timer = timer or StageTimer()
+
+    def write(self, pixels):
+        """Append an (rows, width, 4) uint8 array below the rows written so far."""
+        rows = pixels.reshape(pixels.shape[0], -1)
+        for top in range(0, rows.shape[0], PNG_FILTER_BLOCK_ROWS):
+            block = rows[top:top + PNG_FILTER_BLOCK_ROWS]
+            filtered = filter_png_rows(block, self._previous_row, 4)
+            self._previous_row = block[-1]
+            self._pending += self._compressor.compress(filtered.tobytes())
+            if len(self._pending) >= PNG_IDAT_SIZE:
+                self._timer.mark("encode")
+                self._file.write(png_chunk(b"IDAT", bytes(self._pending)))
+                self._pending.clear()
+                self._timer.mark("write")
+        self._timer.mark("encode")
+
+    def close(self):
+        """Flush the compressed stream and finish the file."""
+        self._pending += self._compressor.flush()
+        self._timer.mark("encode")
+        self._file.write(png_chunk(b"IDAT", bytes(self._pending)))
+        self._file.write(png_chunk(b"IEND", b""))
+        if self._owns_file:
+            self._file.close()
+        self._timer.mark("write")
+
+    def abort(self):
+        """Close and delete a partially written file."""
+        if self._owns_file:
+            self._file.close()
+            os.remove(self._file.name)
+
+def iter_mask_strips(mask_path, size, modes, strip_height, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Yield {mode: mask array} for consecutive strips of strip_height rows of an
+    image of the given size, ready for composite_arrays. The mask is decoded
+    once for all modes; a mask of another size is decoded whole (as a single
+    channel where the modes allow) and resized one strip at a time with
+    iter_resized_strips, which gives the pixels of resize_mask.
+    """
+    height = size[1]
+    mask_image = Image.open(input_source(mask_path))
+    if mask_image.size == size:
+        for mask_strip in iter_image_strips(mask_path, strip_height):
+            masks = {}
+            for mode in modes:
+                working_mode = mask_working_mode(mask_strip, mode, False)
+                mode_strip = mask_strip if mask_strip.mode == working_mode else mask_strip.convert(working_mode)
+                masks[mode] = mask_to_array(mode_strip, mode)
+            yield masks
+        return
+
+    strips = {}
+    for mode in modes:
+        working_mode = mask_working_mode(mask_image, mode, True)
+        if working_mode not in strips:
+            working_mask = mask_image if mask_image.mode == working_mode else mask_image.convert(working_mode)
+            strips[working_mode] = iter_resized_strips(working_mask, size, strip_height, resize_filter)
+    for top in range(0, height, strip_height):
+        resized = {working_mode: next(working_strips) for working_mode, working_strips in strips.items()}
+        yield {mode: mask_to_array(resized[mask_working_mode(mask_image, mode, True)], mode) for mode in modes}
+
+def streaming_trim_box(mask_path, size, strip_height, padding=0, mode="cutout",
+                       resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    trim_box for the output of an 'alpha' blend mode for an image of the
+    given size with the mask at mask_path, found from the mask one strip at
+    a time. Returns None when the output would be fully transparent.
+    """
+    import numpy as np
+
+    width, height = size
+    columns = np.zeros(width, dtype=bool)
+    top = bottom = None
+    row = 0
+    for masks in iter_mask_strips(mask_path, size, (mode,), strip_height, resize_filter):
+        alpha = masks[mode][..., 0]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if rows.size:
+            if top is None:
+                top = row + int(rows[0])
+            bottom = row + int(rows[-1]) + 1
+            columns |= alpha.any(axis=0)
+        row += alpha.shape[0]
+    if top is None:
+        return None
+    used = np.flatnonzero(columns)
+    return pad_box((int(used[0]), top, int(used[-1]) + 1, bottom), size, padding)
+
+def composite_streaming(main_path, mask_path, outputs, strip_height, encoder=DEFAULT_ENCODER, timers=None,
+                        trims=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Strip-streaming variant of composite_numpy for images too large to hold in
+    memory. outputs maps each mode to its output path. Main and mask are
+    decoded strip by strip, once for all modes (see iter_mask_strips), and each
+    composited strip is written to every output as it is produced, so peak
+    memory depends on strip_height and the image width, not the image height.
+    trims optionally maps modes to a trim padding: those outputs are cropped
+    to streaming_trim_box, which costs one more pass over the mask.
+    timers optionally maps modes to StageTimers; decoding is charged to the
+    first mode's. resize_filter is passed on to resize_mask. Only PNG
+    encoder presets can be streamed. Returns the canvas (width, height) and
+    a dict with the box of every trimmed mode.
+    """
+    import numpy as np
+
+    modes = list(outputs)
+    timers = {mode: (timers or {}).get(mode) or StageTimer() for mode in modes}
+    decode_timer = timers[modes[0]]
+    with Image.open(input_source(main_path)) as main_image, Image.open(input_source(mask_path)) as mask_image:
+        size = main_image.size
+        resize = mask_image.size != size
+    width, height = size
+    boxes = {
+        mode: streaming_trim_box(mask_path, size, strip_height, padding, mode, resize_filter)
+        for mode, padding in (trims or {}).items()
+    }
+    decode_timer.mark("resize" if resize else "decode")
+
+    preset = ENCODER_PRESETS[encoder]
+    if preset["format"] != "PNG":
+        raise ValueError(f"The '{encoder}' encoder cannot be streamed, use a PNG preset")
+    options = preset["options"]
+    writers = {}
+    try:
+        for mode in modes:
+            box = boxes.get(mode, (0, 0, width, height)) or (0, 0, 1, 1)
+            writers[mode] = PngStripWriter(
+                outputs[mode], box[2] - box[0], box[3] - box[1],
+                compress_level=9 if options.get("optimize") else options.get("compress_level", 6),
+                compress_type=options.get("compress_type", zlib.Z_DEFAULT_STRATEGY),
+                timer=timers[mode],
+            )
+        top = 0
+        main_strips = iter_image_strips(main_path, strip_height)
+        mask_strips = iter_mask_strips(mask_path, size, modes, strip_height, resize_filter)
+        while True:
+            decode_timer.resume()
+            main_strip = next(main_strips, None)
+            if main_strip is None:
+                break
+            if main_strip.mode not in ("RGB", "RGBA"):
+                main_strip = main_strip.convert("RGBA")
+            source = np.asarray(main_strip)
+            decode_timer.mark("decode")
+            masks = next(mask_strips)
+            decode_timer.mark("resize" if resize else "decode")
+            bottom = top + main_strip.height
+
+            for mode in modes:
+                box = boxes.get(mode, (0, 0, width, height))
+                if box is None or box[1] >= bottom or box[3] <= top:
+                    continue  # nothing of this strip is kept in the trimmed output
+                timer = timers[mode]
+                timer.resume()
+                rows = slice(max(box[1] - top, 0), min(box[3], bottom) - top)
+                columns = slice(box[0], box[2])
+                pixels = composite_arrays(source[rows, columns], masks[mode][rows, columns], mode)
+                timer.mark("composite")
+                writers[mode].write(pixels)
+            top = bottom
+
+        for mode in modes:
+            if mode in boxes and boxes[mode] is None:
+                writers[mode].write(np.zeros((1, 1, 4), dtype=np.uint8))
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    for writer in writers.values():
+        writer.close()
+    return size, boxes
+
+def extract_base_name(filename, marker):
+    """Extract the base name of the file by removing the marker ('main' or 'mask') and file extension."""
+    base_name = filename.replace(f"_{marker}.png", "")
+    return base_name
+
+def is_archive(path):
+    """Tell whether path is a zip or tar file (see ArchiveIndex) rather than a folder."""
+    return path.lower().endswith(ARCHIVE_EXTENSIONS + COMPRESSED_TAR_EXTENSIONS) and os.path.isfile(path)
+
+def archive_member_path(archive, member):
+    """Return the path used for a member of an archive, e.g. 'shots.zip!/set1/frame_main.png'."""
+    return f"{archive}{ARCHIVE_SEPARATOR}{member}"
+
+def split_archive_path(path):
+    """Return (archive, member) for an archive_member_path, or None for the path of a plain file."""
+    archive, separator, member = path.partition(ARCHIVE_SEPARATOR)
+    if separator and archive.lower().endswith(ARCHIVE_EXTENSIONS):
+        return archive, member
+    return None
+
+archive_directories = {}  # (process id, archive path) -> archive_directory result
+archive_lock = threading.Lock()
+
+def archive_directory(archive):
+    """
+    Return the directory of an archive, read once per process: the ZipFile
+    of a zip archive, or {member: (data offset, size, mtime_ns)} for a tar
+    archive, whose members are then read with plain seeks. Keyed by process
+    id, as a forked worker must not share its parent's file position.
+    """
+    key = (os.getpid(), archive)
+    with archive_lock:
+        directory = archive_directories.get(key)
+        if directory is None:
+            if archive.lower().endswith(".zip"):
+                directory = zipfile.ZipFile(archive)
+            else:
+                with tarfile.open(archive, "r:") as tar:
+                    directory = {
+                        info.name: (info.offset_data, info.size, int(info.mtime * 1e9)) for info in tar if info.isfile()
+                    }
+            archive_directories[key] = directory
+    return directory
+
+class ArchiveMemberFile(io.RawIOBase):
+    """Read-only, seekable view of the bytes of one member of an uncompressed tar archive."""
+
+    def __init__(self, archive, offset, size):
+        super().__init__()
+        self._file = open(archive, "rb")
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self._size
+        self._position = max(position, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        count = max(min(len(buffer), self._size - self._position), 0)
+        self._file.seek(self._offset + self._position)
+        count = self._file.readinto(memoryview(buffer)[:count])
+        self._position += count
+        return count
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+def open_input(path):
+    """
+    Open an input image for binary reading. path is a file path or an
+    archive_member_path; archive members are read straight from the archive.
+    """
+    member = split_archive_path(path)
+    if member is None:
+        return open(path, "rb")
+    archive, name = member
+    directory = archive_directory(archive)
+    if isinstance(directory, zipfile.ZipFile):
+        return directory.open(name)
+    offset, size, _ = directory[name]
+    return io.BufferedReader(ArchiveMemberFile(archive, offset, size))
+
+def input_source(path):
+    """Return what Image.open should get for an input: the path itself, or open_input for archive members."""
+    return path if split_archive_path(path) is None else open_input(path)
+
+def parse_shard(shard):
+    """Turn a shard spec "k/n" (the k-th of n shards, counting from 1) into (k, n)."""
+    index, separator, count = shard.partition(SHARD_SEPARATOR)
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not separator or not 1 <= index <= count:
+        raise ValueError(f"A shard must be K/N with 1 <= K <= N, e.g. 3/16; got {shard}")
+    return index, count
+
+def shard_of(base_name, count):
+    """
+    Return the shard (1 to count) a pair belongs to. It depends only on the
+    base name, with '/' as the folder separator, so every machine assigns
+    pairs alike whatever its listing order or operating system.
+    """
+    key = base_name.replace(os.sep, "/").encode("utf-8")
+    return int.from_bytes(hashlib.sha1(key).digest()[:8], "big") % count + 1
+
+def shard_file_name(name, shard):
+    """Name of the per-shard copy of an output folder file, e.g. mask_run_report.3-of-16.json."""
+    if shard is None:
+        return name
+    root, extension = os.path.splitext(name)
+    return f"{root}.{shard[0]}-of-{shard[1]}{extension}"
+
+class PairIndex:
+    """
+    Index of '_main.png' and '_mask.png' files keyed by base name, built in a
+    single os.scandir pass. Iterating yields (base_name, main_path, mask_path)
+    as soon as both files of a pair have been seen, so processing can start
+    before the listing finishes. Once iteration is done, unmatched_mains and
+    orphan_masks hold the files that never found a partner.
+    For recursive scans the base name includes the subfolder, e.g. "shot1/frame".
+    With shard=(k, n) only the pairs and unmatched files of the k-th of n
+    shards (shard_of) are reported, and pair_count counts only those.
+    """
+
+    def __init__(self, input_dir, recursive=False, shard=None):
+        self.input_dir = input_dir
+        self.recursive = recursive
+        self.shard = shard
+        self.pair_count = 0
+        self._mains = {}
+        self._masks = {}
+
+    def __iter__(self):
+        for rel_dir, name, path in self.files():
+            if name.endswith("_main.png"):
+                own, other, marker = self._mains, self._masks, "main"
+            elif name.endswith("_mask.png"):
+                own, other, marker = self._masks, self._mains, "mask"
+            else:
+                continue
+
+            base_name = os.path.join(rel_dir, extract_base_name(name, marker))
+            partner = other.pop(base_name, None)
+            if partner is None:
+                own[base_name] = path
+                continue
+            if not self.in_shard(base_name):
+                continue
+
+            self.pair_count += 1
+            if marker == "main":
+                yield base_name, path, partner
+            else:
+                yield base_name, partner, path
+
+    def files(self):
+        """Yield (folder relative to input_dir, file name, path) for every file of the scan."""
+        folders = [""]
+        while folders:
+            rel_dir = folders.pop()
+            with os.scandir(os.path.join(self.input_dir, rel_dir)) as entries:
+                for entry in entries:
+                    if self.recursive and entry.is_dir(follow_symlinks=False):
+                        folders.append(os.path.join(rel_dir, entry.name))
+                        continue
+                    yield rel_dir, entry.name, entry.path
+
+    def in_shard(self, base_name):
+        """Check whether base_name belongs to the shard of this index (always, without one)."""
+        return self.shard is None or shard_of(base_name, self.shard[1]) == self.shard[0]
+
+    @property
+    def unmatched_mains(self):
+        """Main files without a mask, sorted by path."""
+        return sorted(path for base_name, path in self._mains.items() if self.in_shard(base_name))
+
+    @property
+    def orphan_masks(self):
+        """Mask files without a main image, sorted by path."""
+        return sorted(path for base_name, path in self._masks.items() if self.in_shard(base_name))
+
+class ArchiveIndex(PairIndex):
+    """
+    PairIndex over the members of a zip or uncompressed tar archive, built
+    from the archive's directory without extracting anything. Paths are
+    archive_member_paths, which every reader of the pipeline opens with
+    open_input. Members in all folders of the archive are paired, whatever
+    recursive says. Compressed tar archives are refused: they can only be
+    read front to back, so every member would mean decompressing again from
+    the start.
+    """
+
+    def __init__(self, archive_path, recursive=True, shard=None):
+        if archive_path.lower().endswith(COMPRESSED_TAR_EXTENSIONS):
+            raise ValueError(
+                f"{archive_path} is a compressed tar archive and cannot be read in place, "
+                "use a zip or an uncompressed tar archive"
+            )
+        super().__init__(archive_path, recursive, shard)
+
+    def files(self):
+        directory = archive_directory(self.input_dir)
+        names = directory.namelist() if isinstance(directory, zipfile.ZipFile) else list(directory)
+        for member in names:
+            rel_dir, _, name = member.rpartition("/")
+            if name:
+                yield rel_dir, name, archive_member_path(self.input_dir, member)
+
+def open_pair_index(input_dir, recursive=False, shard=None):
+    """Return the ArchiveIndex or PairIndex for input_dir, which may be a folder or an archive."""
+    if is_archive(input_dir):
+        return ArchiveIndex(input_dir, recursive, shard)
+    return PairIndex(input_dir, recursive, shard)
+
+class Manifest:
+    """
+    Record of the outputs written to an output folder, kept as JSON lines in
+    MANIFEST_NAME. Each entry stores the size and mtime of both inputs and the
+    settings that produced the output, so unchanged pairs can be skipped.
+    Entries are appended and flushed as soon as a pair is saved, which lets an
+    interrupted run resume where it stopped; close() compacts the file to one
+    line per output. Shards of a run each keep their own file, named with
+    shard_file_name, because several machines cannot share one.
+    """
+
+    def __init__(self, output_dir, archive=None, shard=None):
+        self.path = os.path.join(output_dir, shard_file_name(MANIFEST_NAME, shard))
+        self.archive = archive  # ArchiveWriter holding the outputs, if they are not loose files
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as manifest_file:
+                for line in manifest_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:  # a line cut short by a crash
+                        continue
+                    self.entries[entry["output"]] = entry
+        self._journal = open(self.path, "a", encoding="utf-8")
+
+    def is_current(self, job):
+        """Check whether job's output exists and was made from the same inputs and settings."""
+        entry = self.entries.get(job["output"])
+        return (
+            entry is not None
+            and entry["main"] == job["main"]
+            and entry["mask"] == job["mask"]
+            and entry["settings"] == job["settings"]
+            and (job["output"] in self.archive.names if self.archive is not None else os.path.exists(job["output_path"]))
+        )
+
+    def record(self, job, trim=None):
+        """Append the entry for a successfully saved job, with its trim_record if it was trimmed."""
+        entry = {key: job[key] for key in MANIFEST_FIELDS}
+        if trim is not None:
+            entry["trim"] = trim
+        self.entries[entry["output"]] = entry
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+
+    def close(self):
+        """Rewrite the manifest with a single line per output."""
+        self._journal.close()
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            for entry in self.entries.values():
+                manifest_file.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, self.path)
+
+class ArchiveWriter:
+    """
+    Zip archive that takes the outputs of process_images(output_archive=...)
+    instead of loose files. Members are stored without compression, as every
+    encoder preset is compressed already. An existing archive is appended to,
+    so the outputs a run skips stay in it, and remade outputs are appended
+    again (zip readers use the newest copy). An archive left without its
+    directory by an interrupted run is started over. Only the process that
+    opened it writes to it; workers hand back their encoded bytes instead
+    (see keep_for_archive).
+    """
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.zip = None
+        if os.path.exists(path) and not fresh:
+            # Checked first: ZipFile(path, "a") would append a new archive to a damaged file
+            if zipfile.is_zipfile(path):
+                self.zip = zipfile.ZipFile(path, "a")
+            else:
+                print(f"{path} is damaged, probably by an interrupted run; writing a new archive")
+        if self.zip is None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self.zip = zipfile.ZipFile(path, "w")
+        self.names = set(self.zip.namelist())
+
+    def write(self, name, data):
+        """Add a member with the given bytes."""
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # "Duplicate name" when an output is remade
+            self.zip.writestr(info, data, zipfile.ZIP_STORED)
+        self.names.add(name)
+
+    def close(self):
+        """Write the archive's directory; the archive is unreadable until then."""
+        self.zip.close()
+
+def link_file(source, target, method="hardlink"):
+    """
+    Make target a copy of source by method, one of DEDUPE_LINKS: a hard
+    link, a reflink (a copy-on-write clone; Linux only) or a plain copy.
+    Falls back to a copy when the link cannot be made, e.g. across file
+    systems. The file is made under a temporary name and moved over target.
+    Returns the method that was used.
+    """
+    temp_path = f"{target}.tmp"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    used = "copy"
+    try:
+        if method == "hardlink":
+            os.link(source, temp_path)
+            used = method
+        elif method == "reflink":
+            import fcntl
+
+            with open(source, "rb") as source_file, open(temp_path, "wb") as temp_file:
+                fcntl.ioctl(temp_file.fileno(), FICLONE, source_file.fileno())
+            used = method
+    except (OSError, ImportError):
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+    if used == "copy":
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, target)
+    return used
+
+class OutputDeduper:
+    """
+    Content-addressed index of the outputs of a process_images run. Pairs
+    are keyed by a hash of the bytes of both input files and every output
+    by that and its job settings, so a pair that repeats another one under
+    a different base name gets the first pair's outputs through link_file
+    instead of being composited and encoded again. Everything runs in the
+    process that owns the run: claim() as pairs are queued, finished() as
+    outputs are recorded.
+    """
+
+    def __init__(self, link="hardlink"):
+        if link not in DEDUPE_LINKS:
+            raise ValueError(f"Unknown link method: {link} (expected one of {', '.join(DEDUPE_LINKS)})")
+        self.link = link
+        self._outputs = {}  # key -> (source job, its outcome, or None while it is being made)
+        self._waiting = {}  # key -> jobs waiting for their source to be made
+        self._keys = {}  # output of a source job in flight -> its key
+
+    def claim(self, jobs):
+        """
+        Split the jobs of a pair into the jobs to process and (job, outcome)
+        pairs for outputs that were made from the same content already.
+        Jobs whose source is still being made are held until finished().
+        Pairs that cannot be read are all processed, to fail with the real error.
+        """
+        try:
+            content = self.digest(jobs[0]["main_path"]) + self.digest(jobs[0]["mask_path"])
+        except OSError:
+            return jobs, []
+        to_process, ready = [], []
+        for job in jobs:
+            key = (content, json.dumps(job["settings"], sort_keys=True))
+            source = self._outputs.get(key)
+            if source is None:
+                self._outputs[key] = (job, None)
+                self._keys[job["output"]] = key
+                to_process.append(job)
+            elif source[1] is None:
+                self._waiting.setdefault(key, []).append(job)
+            else:
+                ready.append((job, self.materialise(*source, job)))
+        return to_process, ready
+
+    def finished(self, job, outcome):
+        """Record the outcome of a processed job; returns (job, outcome) for the copies that waited for it."""
+        key = self._keys.pop(job["output"], None)
+        if key is None:
+            return []
+        waiting = self._waiting.pop(key, [])
+        if outcome["error"] is not None:
+            del self._outputs[key]  # a later copy is processed again
+            error = f"same inputs as {job['output']}, which failed: {outcome['error']}"
+            return [(copy, {"error": error}) for copy in waiting]
+        self._outputs[key] = (job, outcome)
+        return [(copy, self.materialise(job, outcome, copy)) for copy in waiting]
+
+    def materialise(self, source_job, source_outcome, job):
+        """Link the output of source_job to job's output path and return job's outcome."""
+        outcome = {
+            "error": None, "stages": dict.fromkeys(STAGES, 0.0), "pixels": 0, "bytes": 0,
+            "reused_bytes": source_outcome["bytes"],
+        }
+        try:
+            outcome["link"] = link_file(source_job["output_path"], job["output_path"], self.link)
+            if "trim" in source_outcome:
+                outcome["trim"] = source_outcome["trim"]
+                write_trim_sidecar(job["output_path"], outcome["trim"])
+        except OSError as e:
+            outcome["error"] = str(e)
+            return outcome
+        print(f"Reused: {job['output_path']} ({outcome['link']} of {source_job['output']})")
+        return outcome
+
+    @staticmethod
+    def digest(path):
+        """Hash of the bytes of an input file or archive member."""
+        digest = hashlib.blake2b(digest_size=16)
+        with open_input(path) as input_file:
+            for chunk in iter(lambda: input_file.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.digest()
+
+def file_signature(path):
+    """
+    Return [size, mtime_ns] of a file, used to detect changed inputs; zip
+    members, whose time stamps are only precise to two seconds, give [size, CRC-32].
+    """
+    member = split_archive_path(path)
+    if member is not None:
+        directory = archive_directory(member[0])
+        if isinstance(directory, zipfile.ZipFile):
+            info = directory.getinfo(member[1])
+            return [info.file_size, info.CRC]
+        _, size, mtime_ns = directory[member[1]]
+        return [size, mtime_ns]
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def composite_pil(main_path, mask_path, mode, timer=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """Original Pillow compositing path: the main image is converted to RGBA before blending."""
+    timer = timer or StageTimer()
+    main_image, masks = decode_pil(main_path, mask_path, (mode,), timer, resize_filter)
+    return blend_pil(main_image, masks[mode], mode, timer)
+
+def decode_pil(main_path, mask_path, modes, timer=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Decoding half of composite_pil: return the main image in RGBA and a dict
+    with the mask at its size for each of modes. Like decode_numpy, only the
+    channels a mode needs are resized (mask_working_mode, resize_mask); the
+    channel operations get the mask in RGBA afterwards, as ImageChops needs.
+    """
+    timer = timer or StageTimer()
+    main_image = Image.open(input_source(main_path)).convert("RGBA")
+    timer.mark("decode")
+
+    def prepare(mask_image, form):
+        mode = form[1]
+        mask_image.load()
+        timer.mark("decode")
+        working_mode = mask_working_mode(mask_image, mode, mask_image.size != main_image.size)
+        if mask_image.mode != working_mode:
+            mask_image = mask_image.convert(working_mode)
+        mask_image = resize_mask(mask_image, main_image.size, resize_filter)
+        if blend_mode(mode)["operation"] != "alpha" and mask_image.mode != "RGBA":
+            mask_image = mask_image.convert("RGBA")
+        timer.mark("resize")
+        return mask_image
+
+    masks = load_masks(mask_path, main_image.size, [("pil", mode, resize_filter) for mode in modes], prepare, timer)
+    timer.mark("resize")
+    return main_image, {form[1]: mask for form, mask in masks.items()}
+
+def blend_pil(main_image, mask_image, mode, timer=None):
+    """
+    Blending half of composite_pil. A mode's mask_lut goes through
+    Image.point on the grayscale mask, or on the colour bands of an RGBA
+    mask for the channel operations.
+    """
+    timer = timer or StageTimer()
+    entry = blend_mode(mode)
+    operation, mask_lut = entry["operation"], entry["mask_lut"]
+    if operation == "alpha":
+        if mask_lut is not None:
+            mask_image = mask_image.convert("L").point(mask_lut)
+        result_image = apply_mask_and_cutout(main_image, mask_image)
+    elif operation == "darker" and mask_lut is None:
+        result_image = apply_darken_layer(main_image, mask_image)
+    else:
+        if mask_lut is not None:
+            if mask_image.mode != "RGBA":
+                mask_image = mask_image.convert("RGBA")
+            mask_image = mask_image.point(mask_lut * 3 + list(range(256)))  # R, G and B; alpha unchanged
+        result_image = BLEND_CHOPS[operation](main_image, mask_image)
+    timer.mark("composite")
+    return result_image
+
+def encode_image(image, target, encoder):
+    """Save image to a path or file object with an ENCODER_PRESETS entry; returns the time taken."""
+    preset = ENCODER_PRESETS[encoder]
+    started = time.perf_counter()
+    image.save(target, preset["format"], **preset["options"])
+    return time.perf_counter() - started
+
+def composite_image(main_path, mask_path, settings, timer=None):
+    """Composite a pair in memory with the backend named in settings."""
+    resize_filter = settings.get("resize_filter", DEFAULT_RESIZE_FILTER)
+    if settings["backend"] == "numpy":
+        return composite_numpy(main_path, mask_path, settings["mode"], timer, resize_filter)
+    return composite_pil(main_path, mask_path, settings["mode"], timer, resize_filter)
+
+def decode_pair(main_path, mask_path, backend, modes, timer=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    First half of composite_image: read and decode a pair once and bring the
+    mask to the main image's size for each of modes with resize_filter (see
+    resize_mask). Returns (main_image, masks) where masks maps every mode to
+    the mask blend_pair needs for it.
+    """
+    if backend == "numpy":
+        return decode_numpy(main_path, mask_path, modes, timer, resize_filter)
+    return decode_pil(main_path, mask_path, modes, timer, resize_filter)
+
+def blend_pair(main_image, mask, settings, timer=None):
+    """Second half of composite_image: combine what decode_pair returned into the result image."""
+    if settings["backend"] == "numpy":
+        return blend_numpy(main_image, mask, settings["mode"], timer)
+    return blend_pil(main_image, mask, settings["mode"], timer)
+
+def open_output(path):
+    """
+    Open an output file for writing. A file with other hard links (made by
+    OutputDeduper) is removed first, so rewriting it leaves the outputs it
+    was linked to alone.
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    return open(path, "wb")
+
+def save_image(image, output_path, encoder, timer=None):
+    """
+    Encode image with an ENCODER_PRESETS entry and write it to output_path.
+    The image is encoded in memory first so that encoding and the disk write
+    are timed apart.
+    """
+    timer = timer or StageTimer()
+    buffer = io.BytesIO()
+    encode_image(image, buffer, encoder)
+    timer.mark("encode")
+    with open_output(output_path) as output_file:
+        output_file.write(buffer.getbuffer())
+    timer.mark("write")
+
+def new_outcome():
+    """Return a StageTimer and the empty outcome dict that reports its stages."""
+    timer = StageTimer()
+    return timer, {"error": None, "stages": timer.seconds, "pixels": 0, "bytes": 0}
+
+def blend_job(main_image, masks, job, outcome, timer):
+    """
+    Blend the output of one job from what decode_pair returned, trimming it
+    when the job's settings ask for it; the trim is recorded in outcome.
+    """
+    settings = job["settings"]
+    result_image = blend_pair(main_image, masks[settings["mode"]], settings, timer)
+    if settings.get("trim") is not None:
+        canvas = result_image.size
+        result_image, box = trim_image(result_image, settings["trim"])
+        outcome["trim"] = trim_record(canvas, box)
+        timer.mark("composite")
+    return result_image
+
+def save_job(result_image, job, outcome, timer):
+    """Encode and write the output of one job, with its trim sidecar, and count it in outcome."""
+    if job["archive"]:
+        buffer = io.BytesIO()
+        encode_image(result_image, buffer, job["settings"]["encoder"])
+        timer.mark("encode")
+        keep_for_archive(job, outcome, buffer.getvalue())
+    else:
+        save_image(result_image, job["output_path"], job["settings"]["encoder"], timer)
+        if "trim" in outcome:
+            write_trim_sidecar(job["output_path"], outcome["trim"])
+            timer.mark("write")
+        outcome["bytes"] = os.path.getsize(job["output_path"])
+    outcome["pixels"] = result_image.width * result_image.height
+
+def keep_for_archive(job, outcome, data):
+    """
+    Put the encoded output of a job bound for an output archive, and its trim
+    sidecar, in outcome["files"]; record_pair_result adds them to the archive
+    in the process that owns it.
+    """
+    outcome["files"] = {job["output"]: data}
+    if "trim" in outcome:
+        sidecar_name = os.path.splitext(job["output"])[0] + ".json"
+        outcome["files"][sidecar_name] = trim_sidecar_text(job["output"], outcome["trim"]).encode("utf-8")
+    outcome["bytes"] = len(data)
+
+def process_pair(jobs):
+    """
+    Process one main/mask pair into the outputs described by jobs, prepare_job
+    dicts for the same inputs that differ only in their mode. The pair is
+    decoded once and the decoded and resized buffers are reused for every
+    output. Returns one outcome dict per job with the error message (None on
+    success), the seconds spent in each of STAGES and the number of pixels
+    and bytes written; decoding and this pair's mask cache hits and misses
+    are counted in the first outcome. In a pool worker of a cancelled run
+    (configure_pool_worker) the pair is not started and None is returned.
+    """
+    if pool_cancel is not None and pool_cancel.is_set():
+        return None
+    settings = jobs[0]["settings"]
+    main_path, mask_path = jobs[0]["main_path"], jobs[0]["mask_path"]
+    timers, outcomes = zip(*(new_outcome() for _ in jobs))
+    cache_hits, cache_misses = mask_cache.hits, mask_cache.misses
+    try:
+        if settings["strip_height"]:
+            modes = [job["settings"]["mode"] for job in jobs]
+            trims = {
+                mode: job["settings"]["trim"]
+                for mode, job in zip(modes, jobs) if job["settings"].get("trim") is not None
+            }
+            targets = {mode: io.BytesIO() if job["archive"] else job["output_path"] for mode, job in zip(modes, jobs)}
+            canvas, boxes = composite_streaming(
+                main_path, mask_path, targets,
+                settings["strip_height"], settings["encoder"], dict(zip(modes, timers)), trims,
+                settings.get("resize_filter", DEFAULT_RESIZE_FILTER),
+            )
+            for mode, job, outcome in zip(modes, jobs, outcomes):
+                width, height = canvas
+                if mode in boxes:
+                    outcome["trim"] = trim_record(canvas, boxes[mode])
+                    width, height = outcome["trim"]["size"]
+                outcome["pixels"] = width * height
+                if job["archive"]:
+                    keep_for_archive(job, outcome, targets[mode].getvalue())
+                    continue
+                if mode in boxes:
+                    write_trim_sidecar(job["output_path"], outcome["trim"])
+                outcome["bytes"] = os.path.getsize(job["output_path"])
+                print(f"Saved: {job['output_path']}")
+        else:
+            main_image, masks = decode_pair(
+                main_path, mask_path, settings["backend"], [job["settings"]["mode"] for job in jobs], timers[0],
+                settings.get("resize_filter", DEFAULT_RESIZE_FILTER),
+            )
+            for job, timer, outcome in zip(jobs, timers, outcomes):
+                timer.resume()
+                try:
+                    save_job(blend_job(main_image, masks, job, outcome, timer), job, outcome, timer)
+                    print(f"Saved: {job['output_path']}")
+                except Exception as e:
+                    outcome["error"] = str(e)
+    except Exception as e:
+        for outcome in outcomes:
+            outcome["error"] = str(e)
+    outcomes[0]["mask_cache_hits"] = mask_cache.hits - cache_hits
+    outcomes[0]["mask_cache_misses"] = mask_cache.misses - cache_misses
+    return list(outcomes)
+
+class PairPipeline:
+    """
+    Process pairs in one process with the stages overlapped: `io_threads`
+    threads read and decode pairs (decode_pair), one thread blends them
+    (blend_pair) and `io_threads` threads encode and write the results
+    (save_image). Pillow releases the GIL while decoding and encoding, so
+    slow storage and encoding are hidden behind compositing even on one core.
+
+    The stages are linked by queues of `queue_size` items; a full queue blocks
+    the stage before it, so at most a fixed number of decoded pairs and
+    results are held in memory whatever the speed of each stage. Once the
+    optional cancel event is set, pairs that are still waiting for a stage
+    are dropped; only those already being worked on are finished.
+    With memory_budget (bytes), a pair is only fed in while the "memory"
+    estimates (see plan_pairs) of the pairs in flight leave room for it; a
+    pair larger than the budget runs on its own.
+    """
+
+    def __init__(self, settings, io_threads=DEFAULT_IO_THREADS, queue_size=2, cancel=None, memory_budget=None):
+        self.settings = settings
+        self.cancel = cancel
+        self.memory_budget = memory_budget
+        self._decode_queue = queue.Queue(queue_size)
+        self._blend_queue = queue.Queue(queue_size)
+        self._save_queue = queue.Queue(queue_size)
+        self._done_queue = queue.Queue()
+        self._threads = (
+            [threading.Thread(target=self._decode_worker, daemon=True) for _ in range(io_threads)]
+            + [threading.Thread(target=self._blend_worker, daemon=True)]
+            + [threading.Thread(target=self._save_worker, daemon=True) for _ in range(io_threads)]
+        )
+        self._io_threads = io_threads
+
+    def run(self, pairs):
+        """
+        Feed the pairs iterable, lists of prepare_job dicts as process_pair
+        takes them, through the stages and yield (job, outcome) for every
+        output as its pair finishes, in completion order. outcome has the
+        fields of process_pair's, without mask cache counts. Pairs dropped
+        after a cancel are not yielded.
+        """
+        for thread in self._threads:
+            thread.start()
+        submitted = finished = 0
+        in_flight = {}  # id of a pair's first job -> its memory estimate
+        try:
+            for jobs in pairs:
+                memory = jobs[0].get("memory") or 0
+                while (
+                    self.memory_budget and finished < submitted
+                    and sum(in_flight.values()) + memory > self.memory_budget
+                ):
+                    results = self._done_queue.get()
+                    finished += 1
+                    if results:
+                        in_flight.pop(id(results[0][0]), None)
+                    yield from results or ()
+                in_flight[id(jobs[0])] = memory
+                self._decode_queue.put(jobs)  # blocks while the pipeline is full
+                submitted += 1
+                while True:
+                    try:
+                        results = self._done_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    finished += 1
+                    if results:
+                        in_flight.pop(id(results[0][0]), None)
+                    yield from results or ()
+            while finished < submitted:
+                results = self._done_queue.get()
+                finished += 1
+                yield from results or ()
+        finally:
+            # Let the pairs already in flight finish before stopping the threads
+            while finished < submitted:
+                self._done_queue.get()
+                finished += 1
+            for _ in range(self._io_threads):
+                self._decode_queue.put(None)
+            self._blend_queue.put(None)
+            for _ in range(self._io_threads):
+                self._save_queue.put(None)
+            for thread in self._threads:
+                thread.join()
+
+    def _cancelled(self):
+        return self.cancel is not None and self.cancel.is_set()
+
+    def _decode_worker(self):
+        while True:
+            jobs = self._decode_queue.get()
+            if jobs is None:
+                return
+            if self._cancelled():
+                self._done_queue.put(None)
+                continue
+            timers, outcomes = zip(*(new_outcome() for _ in jobs))
+            decoded = None
+            try:
+                decoded = decode_pair(
+                    jobs[0]["main_path"], jobs[0]["mask_path"], self.settings["backend"],
+                    [job["settings"]["mode"] for job in jobs], timers[0],
+                    jobs[0]["settings"].get("resize_filter", DEFAULT_RESIZE_FILTER),
+                )
+            except Exception as e:
+                for outcome in outcomes:
+                    outcome["error"] = str(e)
+            self._blend_queue.put((jobs, outcomes, timers, decoded))
+
+    def _blend_worker(self):
+        while True:
+            item = self._blend_queue.get()
+            if item is None:
+                return
+            jobs, outcomes, timers, decoded = item
+            if self._cancelled():
+                self._done_queue.put(None)
+                continue
+            result_images = []
+            for job, outcome, timer in zip(jobs, outcomes, timers):
+                result_image = None
+                if outcome["error"] is None:
+                    timer.resume()
+                    try:
+                        result_image = blend_job(*decoded, job, outcome, timer)
+                    except Exception as e:
+                        outcome["error"] = str(e)
+                result_images.append(result_image)
+            self._save_queue.put((jobs, outcomes, timers, result_images))
+
+    def _save_worker(self):
+        while True:
+            item = self._save_queue.get()
+            if item is None:
+                return
+            jobs, outcomes, timers, result_images = item
+            if self._cancelled():
+                self._done_queue.put(None)
+                continue
+            for job, outcome, timer, result_image in zip(jobs, outcomes, timers, result_images):
+                if outcome["error"] is None:
+                    timer.resume()
+                    try:
+                        save_job(result_image, job, outcome, timer)
+                    except Exception as e:
+                        outcome["error"] = str(e)
+            self._done_queue.put(list(zip(jobs, outcomes)))
+
+def compare_encoders(main_path, mask_path, mode="cutout", backend="pil", encoders=None):
+    """
+    Composite one pair and encode it in memory with every encoder preset (or
+    the given names), printing and returning the time and size of each.
+    Use it on a typical pair to pick the preset for a job.
+    """
+    result_image = composite_image(main_path, mask_path, {"mode": mode, "backend": backend})
+    rows = []
+    for encoder in encoders or ENCODER_PRESETS:
+        buffer = io.BytesIO()
+        seconds = encode_image(result_image, buffer, encoder)
+        rows.append({"encoder": encoder, "seconds": seconds, "bytes": buffer.tell()})
+        print(f"{encoder:>14}: {seconds * 1000:8.1f} ms  {buffer.tell() / 1024:10.1f} KiB")
+    return rows
+
+def load_proxy(path, max_size=DEFAULT_PREVIEW_SIZE, cache=None):
+    """
+    Return (proxy, original size) for an input image, the proxy fitting
+    within max_size. JPEG files are decoded at a reduced scale (draft);
+    other formats are decoded fully and shrunk by the largest whole factor
+    with Image.reduce before a final bilinear resize. Proxies are kept in
+    cache (a ProxyCache) when one is given.
+    """
+    key = (path, tuple(file_signature(path)), tuple(max_size))
+    proxy = cache.get(key) if cache is not None else None
+    if proxy is not None:
+        return proxy
+    image = Image.open(input_source(path))
+    original_size = image.size
+    image.draft(None, max_size)
+    if image.mode not in REDUCE_MODES:
+        image = image.convert("RGBA")
+    factor = min(image.width // max_size[0], image.height // max_size[1])
+    if factor > 1:
+        image = image.reduce(factor)
+    image.thumbnail(max_size, Image.BILINEAR)
+    proxy = (image, original_size)
+    if cache is not None:
+        cache.put(key, proxy, image.width * image.height * len(image.getbands()))
+    return proxy
+
+def render_preview(main_path, mask_path, mode, max_size=DEFAULT_PREVIEW_SIZE, cache=None):
+    """
+    Render mode for a pair from proxies of both images (load_proxy), the way
+    composite_pil renders it at full size, within max_size. Returns
+    (preview image, info), info holding the 'main_size' and 'mask_size' of
+    the originals and the preview's 'scale'. Takes a fraction of the time of
+    the full-size composite, so masks can be checked before a batch.
+    """
+    main_proxy, main_size = load_proxy(main_path, max_size, cache)
+    mask_proxy, mask_size = load_proxy(mask_path, max_size, cache)
+    main_image = main_proxy.convert("RGBA")
+    mask_image = mask_proxy.convert("RGBA").resize(main_image.size)
+    preview = blend_pil(main_image, mask_image, mode)
+    return preview, {"main_size": main_size, "mask_size": mask_size, "scale": main_image.width / main_size[0]}
+
+def process_images(input_dir, output_dir, mode, workers=None, recursive=False,
+                   progress=None, cancel=None, force=False, backend="pil", strip_height=None,
+                   encoder=DEFAULT_ENCODER, mask_cache_mb=DEFAULT_MASK_CACHE_MB,
+                   report_path=None, prometheus_path=None, io_threads=DEFAULT_IO_THREADS,
+                   trim=False, trim_padding=0, output_archive=None, plan=False, memory_budget_mb=None,
+                   shard=None, dedupe=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Find the _main/_mask pairs of input_dir (a folder, or a zip or
+    uncompressed tar archive, see open_pair_index) and make the outputs of
+    every mode for each pair; outputs the manifest in output_dir says are up
+    to date are skipped unless force=True. mode is a BLEND_MODES name or a
+    collection of them, made from a single decode of each pair.
+    Pairs go to a pool of `workers` processes (default: CPU count); workers=1
+    runs them in this process through a PairPipeline with io_threads threads.
+    The other options are those of mask_cli.py process, described in the
+    README: recursive, backend, strip_height (composite_streaming), encoder
+    (ENCODER_PRESETS), mask_cache_mb (MaskCache), trim and trim_padding
+    (trim_box), resize_filter (MASK_FILTERS), output_archive (ArchiveWriter),
+    plan and memory_budget_mb (plan_pairs), shard ("k/n", shard_of) and
+    dedupe (OutputDeduper). The run report goes to report_path (default
+    RUN_REPORT_NAME in output_dir) and, as a textfile, to prometheus_path.
+    progress(done, found, scan_complete) is called after every finished
+    output; once the cancel event is set no new pairs are started.
+    Returns a dict with the 'saved', 'skipped' and 'failed' output counts,
+    the 'unmatched' and 'orphans' file counts, 'cancelled', the 'pixels',
+    'bytes_written' and 'stage_seconds' of the saved outputs, the
+    'mask_cache_hits' and 'mask_cache_misses', the 'plan' summary (None
+    without planning), the dedupe counts 'reused', 'reused_bytes' and
+    'links', and the 'report_path'.
+    """
+    started = time.time()
+    result = new_run_result()
+    settings = run_settings(mode, backend, strip_height, encoder, trim, trim_padding, resize_filter)
+    modes = settings["modes"]
+    if output_archive is not None and not output_archive.lower().endswith(".zip"):
+        raise ValueError(f"The output archive must be a .zip file, got {output_archive}")
+    settings["output_archive"] = output_archive
+    if shard is not None:
+        shard = parse_shard(shard)
+    settings["shard"] = list(shard) if shard else None
+    if dedupe and output_archive is not None:
+        raise ValueError("dedupe links output files, it cannot be used with output_archive")
+    deduper = OutputDeduper(dedupe) if dedupe else None
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    index = open_pair_index(input_dir, recursive=recursive, shard=shard)
+    archive = ArchiveWriter(output_archive, fresh=force) if output_archive else None
+    manifest = Manifest(output_dir, archive, shard)
+    metrics = RunMetrics()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    memory_budget = memory_budget_mb << 20 if memory_budget_mb else None
+
+    scanned = False
+    pairs = ((base_name, main_path, mask_path, None) for base_name, main_path, mask_path in index)
+    if plan or memory_budget:
+        entries, result["plan"] = plan_pairs(index, settings)
+        print_plan(result["plan"], memory_budget)
+        pairs = ((entry["base_name"], entry["main_path"], entry["mask_path"], entry["memory"]) for entry in entries)
+        scanned = True
+
+    def pending_pairs():
+        """
+        Yield, for every pair with outputs to make, the jobs of those outputs;
+        outputs that are unchanged are counted as skipped.
+        """
+        for base_name, main_path, mask_path, memory in pairs:
+            if cancel is not None and cancel.is_set():
+                result["cancelled"] = True
+                return
+            jobs = []
+            for job in prepare_pair_jobs(output_dir, base_name, main_path, mask_path, settings):
+                if "error" in job:
+                    record_pair_result(result, manifest, metrics, job, {"error": job.pop("error")})
+                elif not force and manifest.is_current(job):
+                    result["skipped"] += 1
+                else:
+                    job["memory"] = memory
+                    jobs.append(job)
+            if jobs and deduper is not None:
+                jobs, reused = deduper.claim(jobs)
+                for job, outcome in reused:
+                    record_pair_result(result, manifest, metrics, job, outcome)
+            if not jobs:
+                report_progress(progress, result, index, len(modes), scanned)
+                continue
+            print(
+                f"Processing pair: {os.path.basename(main_path)} + {os.path.basename(mask_path)} "
+                f"in mode: {', '.join(job['settings']['mode'] for job in jobs)}"
+            )
+            yield jobs
+
+    try:
+        if workers <= 1 and io_threads > 0 and not strip_height:
+            configure_mask_cache(mask_cache_mb << 20)
+            pipeline = PairPipeline(settings, io_threads, cancel=cancel, memory_budget=memory_budget)
+            for job, outcome in pipeline.run(pending_pairs()):
+                if outcome["error"] is None:
+                    print(f"Saved: {job['output_path']}")
+                record_pair_result(result, manifest, metrics, job, outcome, deduper)
+                report_progress(progress, result, index, len(modes), scanned)
+            if cancel is not None and cancel.is_set():
+                result["cancelled"] = True  # the pipeline may have taken every pair before the cancel
+            result["mask_cache_hits"] += mask_cache.hits
+            result["mask_cache_misses"] += mask_cache.misses
+        elif workers <= 1:
+            configure_mask_cache(mask_cache_mb << 20)
+            for jobs in pending_pairs():
+                for job, outcome in zip(jobs, process_pair(jobs)):
+                    record_pair_result(result, manifest, metrics, job, outcome, deduper)
+                report_progress(progress, result, index, len(modes), scanned)
+        else:
+            # The pool takes a few pairs ahead of its workers, which Future.cancel cannot
+            # stop; this event tells the workers to skip them too
+            workers_cancel = multiprocessing.Event()
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=configure_pool_worker,
+                initargs=(mask_cache_mb << 20, workers_cancel),
+            ) as executor:
+                pending = {}
+                for jobs in pending_pairs():
+                    # Keep the number of queued pairs bounded while the scan is still running,
+                    # and the memory estimates of the unfinished ones within the budget
+                    while pending and (
+                        len(pending) >= workers * 4
+                        or memory_budget and sum(
+                            queued[0]["memory"] or 0 for queued in pending.values()
+                        ) + (jobs[0]["memory"] or 0) > memory_budget
+                    ):
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            collect_pair_future(result, manifest, metrics, future, pending.pop(future), deduper)
+                            report_progress(progress, result, index, len(modes), scanned)
+                    if cancel is not None and cancel.is_set():
+                        workers_cancel.set()
+                        break  # cancelled while waiting for room; this pair is not started
+                    try:
+                        future = executor.submit(process_pair, jobs)
+                    except BrokenProcessPool as e:  # a worker died; the pool takes no more pairs
+                        for job in jobs:
+                            record_pair_result(result, manifest, metrics, job, {"error": str(e)}, deduper)
+                        report_progress(progress, result, index, len(modes), scanned)
+                        continue
+                    pending[future] = jobs
+
+                for future in as_completed(pending):
+                    # pending_pairs may have seen the event (and set the flag) first,
+                    # so the queued pairs are cancelled whatever the flag says
+                    if cancel is not None and cancel.is_set():
+                        result["cancelled"] = True
+                        workers_cancel.set()
+                        for queued in pending:
+                            queued.cancel()
+                    if future.cancelled():
+                        continue
+                    collect_pair_future(result, manifest, metrics, future, pending[future], deduper)
+                    report_progress(progress, result, index, len(modes), not result["cancelled"])
+    finally:
+        if archive is not None:
+            archive.close()
+        manifest.close()
+
+    if not result["cancelled"]:
+        result["unmatched"] = len(index.unmatched_mains)
+        result["orphans"] = len(index.orphan_masks)
+    result["report_path"] = report_path or os.path.join(output_dir, shard_file_name(RUN_REPORT_NAME, shard))
+    report = build_run_report(result, metrics, settings, input_dir, output_dir, started)
+    write_run_report(result["report_path"], report)
+    if prometheus_path:
+        write_prometheus_textfile(prometheus_path, report)
+
+    stage_seconds = result["stage_seconds"]
+    if result["saved"]:
+        print(
+            f"Encoded {result['saved']} outputs with the '{encoder}' preset: "
+            f"{result['bytes_written'] / 1024 ** 2:.1f} MiB in {stage_seconds['encode']:.1f} s."
+        )
+        total = sum(stage_seconds.values()) or 1.0
+        print("Time per stage: " + ", ".join(
+            f"{stage} {seconds:.1f} s ({100 * seconds / total:.0f}%)" for stage, seconds in stage_seconds.items()
+        ) + f". Run report: {result['report_path']}")
+    lookups = result["mask_cache_hits"] + result["mask_cache_misses"]
+    if lookups:
+        print(
+            f"Mask cache: {result['mask_cache_hits']} hits, {result['mask_cache_misses']} misses "
+            f"({100 * result['mask_cache_hits'] / lookups:.0f}% hit rate)."
+        )
+    if result["reused"]:
+        print(
+            f"Reused {result['reused']} outputs of identical pairs instead of making them again "
+            f"({result['reused_bytes'] / 1024 ** 2:.1f} MiB; "
+            + ", ".join(f"{count} by {method}" for method, count in sorted(result["links"].items())) + ")."
+        )
+    if result["skipped"]:
+        print(f"Skipped {result['skipped']} unchanged outputs (see {MANIFEST_NAME}).")
+    if result["cancelled"]:
+        print("Processing cancelled.")
+        return result
+
+    if not index.pair_count:
+        print(f"No 'main' or 'mask' files found in {input_dir}.")
+    for main_path in index.unmatched_mains:
+        print(f"No matching mask found for {main_path}")
+    for mask_path in index.orphan_masks:
+        print(f"No matching main found for {mask_path}")
+    report_progress(progress, result, index, len(modes), True)
+    return result
+
+class InotifyWatcher:
+    """
+    Names of the files that were written (closed after writing) or moved
+    into a folder, from Linux inotify through ctypes. Raises OSError where
+    inotify is not available; open_watcher then falls back to PollingWatcher.
+    """
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_Q_OVERFLOW = 0x4000
+    EVENT = struct.Struct("iIII")  # watch descriptor, mask, cookie, name length
+
+    def __init__(self, folder):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f"Cannot watch {folder}")
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for events and return the set of changed
+        file names, or None when the kernel dropped events and the whole
+        folder has to be looked at again.
+        """
+        import select
+
+        names = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    InotifyWatcher's interface on top of periodic os.scandir passes, for
+    systems without inotify and network shares written by other machines
+    (inotify only sees writes made through the local kernel).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """Return the size and mtime of every file in the folder, keyed by name."""
+        snapshot = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def changes(self, timeout):
+        """Sleep for timeout seconds and return the names of new or changed files."""
+        time.sleep(timeout)
+        snapshot = self.scan()
+        names = {name for name, signature in snapshot.items() if self.snapshot.get(name) != signature}
+        self.snapshot = snapshot
+        return names
+
+    def close(self):
+        pass
+
+def open_watcher(folder, poll=False):
+    """Return an InotifyWatcher for folder, or a PollingWatcher if poll is set or inotify fails."""
+    if not poll:
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), polling {folder} instead")
+    return PollingWatcher(folder)
+
+def png_is_complete(path):
+    """Tell whether the file at path ends with a PNG IEND chunk, i.e. was written to the end."""
+    try:
+        with open(path, "rb") as png_file:
+            png_file.seek(-len(PNG_IEND), os.SEEK_END)
+            return png_file.read() == PNG_IEND
+    except OSError:  # missing, or shorter than the chunk
+        return False
+
+def pair_wait_seconds(main_path, mask_path, settle_seconds):
+    """
+    Return how long to wait before a watched pair can be read: 0 once both
+    files have been unchanged for settle_seconds and end with PNG_IEND, None
+    when one of them does not exist (yet).
+    """
+    now = time.time()
+    wait_seconds = 0.0
+    for path in (main_path, mask_path):
+        try:
+            wait_seconds = max(wait_seconds, os.stat(path).st_mtime + settle_seconds - now)
+        except FileNotFoundError:
+            return None
+    if wait_seconds <= 0 and not (png_is_complete(main_path) and png_is_complete(mask_path)):
+        # Unchanged but cut short: the writer is slow or gave up, look again later
+        wait_seconds = settle_seconds
+    return wait_seconds
+
+def watch_folder(input_dir, output_dir, mode, workers=None, force=False, backend="pil", strip_height=None,
+                 encoder=DEFAULT_ENCODER, mask_cache_mb=DEFAULT_MASK_CACHE_MB, trim=False, trim_padding=0,
+                 settle_seconds=DEFAULT_SETTLE_SECONDS, poll_interval=DEFAULT_POLL_INTERVAL, poll=False,
+                 report_path=None, prometheus_path=None, cancel=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Keep processing the pairs that appear in input_dir until cancel (a
+    threading.Event) is set or the process is interrupted. The options mean
+    the same as for process_images; subfolders are not watched.
+
+    Pairs already in the folder are looked at once on start. After that only
+    the files reported by the watcher (open_watcher: inotify, or a scan every
+    poll_interval seconds) are looked at, so there is no rescan per pair. A
+    pair is read once both files exist, have been unchanged for
+    settle_seconds and end with a complete PNG IEND chunk (pair_wait_seconds);
+    the manifest skips pairs whose outputs are up to date.
+
+    The worker processes (workers, default CPU count; 1 processes pairs in a
+    thread of this process) are started once and kept for the whole watch;
+    when one dies, the pairs it broke fail and new workers are started.
+    The run report and prometheus_path are refreshed every
+    WATCH_REPORT_INTERVAL seconds while pairs are processed and on exit.
+    Returns the same dict as process_images.
+    """
+    started = time.time()
+    result = new_run_result()
+    settings = run_settings(mode, backend, strip_height, encoder, trim, trim_padding, resize_filter)
+    result["report_path"] = report_path or os.path.join(output_dir, RUN_REPORT_NAME)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest = Manifest(output_dir)
+    metrics = RunMetrics()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def base_name_of(name):
+        for marker in ("main", "mask"):
+            if name.endswith(f"_{marker}.png"):
+                return extract_base_name(name, marker)
+        return None
+
+    def write_reports():
+        report = build_run_report(result, metrics, settings, input_dir, output_dir, started)
+        write_run_report(result["report_path"], report)
+        if prometheus_path:
+            write_prometheus_textfile(prometheus_path, report)
+
+    def start_pool():
+        nonlocal executor
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=configure_mask_cache, initargs=(mask_cache_mb << 20,)
+        )
+        # Start every worker now instead of when the first pair arrives
+        for future in [executor.submit(os.getpid) for _ in range(workers)]:
+            future.result()
+
+    def submit_pair(jobs):
+        try:
+            return executor.submit(process_pair, jobs)
+        except BrokenProcessPool:  # a worker died; the pairs it broke fail when they are collected
+            print("A worker process died, starting new workers")
+            executor.shutdown(wait=False)
+            start_pool()
+            return executor.submit(process_pair, jobs)
+
+    executor = None
+    if workers > 1:
+        start_pool()
+    else:
+        configure_mask_cache(mask_cache_mb << 20)
+        executor = ThreadPoolExecutor(max_workers=1)
+    watcher = open_watcher(input_dir, poll)
+    with os.scandir(input_dir) as entries:
+        waiting = {base_name_of(entry.name) for entry in entries} - {None}
+    in_flight = {}  # future -> (base name, jobs)
+    last_report = time.monotonic()
+    print(f"Watching {input_dir} for new pairs, results go to {output_dir}")
+
+    try:
+        while cancel is None or not cancel.is_set():
+            timeout = poll_interval
+            busy = {base_name for base_name, _ in in_flight.values()}
+            for base_name in sorted(waiting - busy):
+                main_path = os.path.join(input_dir, f"{base_name}_main.png")
+                mask_path = os.path.join(input_dir, f"{base_name}_mask.png")
+                wait_seconds = pair_wait_seconds(main_path, mask_path, settle_seconds)
+                if wait_seconds is not None and wait_seconds > 0:
+                    timeout = min(timeout, wait_seconds)
+                    continue
+                waiting.discard(base_name)
+                if wait_seconds is None:
+                    continue  # picked up again when the other file arrives
+                jobs = []
+                for job in prepare_pair_jobs(output_dir, base_name, main_path, mask_path, settings):
+                    if "error" in job:
+                        record_pair_result(result, manifest, metrics, job, {"error": job.pop("error")})
+                    elif not force and manifest.is_current(job):
+                        result["skipped"] += 1
+                    else:
+                        jobs.append(job)
+                if jobs:
+                    print(f"Processing pair: {os.path.basename(main_path)} + {os.path.basename(mask_path)}")
+                    try:
+                        in_flight[submit_pair(jobs)] = (base_name, jobs)
+                    except BrokenProcessPool as e:  # the new workers died as well
+                        for job in jobs:
+                            record_pair_result(result, manifest, metrics, job, {"error": str(e)})
+
+            for future in [future for future in in_flight if future.done()]:
+                _, jobs = in_flight.pop(future)
+                collect_pair_future(result, manifest, metrics, future, jobs)
+                if time.monotonic() - last_report >= WATCH_REPORT_INTERVAL:
+                    write_reports()
+                    last_report = time.monotonic()
+            if in_flight:
+                timeout = min(timeout, 0.1)  # come back soon to collect finished pairs
+
+            names = watcher.changes(max(timeout, 0.0))
+            if names is None:
+                with os.scandir(input_dir) as entries:
+                    names = {entry.name for entry in entries}
+            waiting |= {base_name_of(name) for name in names} - {None}
+    except KeyboardInterrupt:
+        print("Interrupted, finishing the pairs in progress...")
+    finally:
+        watcher.close()
+        executor.shutdown(wait=True)
+        for future, (_, jobs) in in_flight.items():
+            collect_pair_future(result, manifest, metrics, future, jobs)
+        manifest.close()
+
+    index = PairIndex(input_dir)
+    for _ in index:
+        pass
+    result["unmatched"] = len(index.unmatched_mains)
+    result["orphans"] = len(index.orphan_masks)
+    write_reports()
+    print(
+        f"Stopped watching: {result['saved']} saved, {result['skipped']} unchanged, {result['failed']} failed."
+    )
+    return result
+
+def new_run_result():
+    """Return the zeroed result dict of process_images and watch_folder."""
+    return {
+        "saved": 0, "skipped": 0, "failed": 0, "unmatched": 0, "orphans": 0, "cancelled": False,
+        "pixels": 0, "bytes_written": 0, "stage_seconds": dict.fromkeys(STAGES, 0.0),
+        "mask_cache_hits": 0, "mask_cache_misses": 0, "plan": None,
+        "reused": 0, "reused_bytes": 0, "links": {}, "report_path": None,
+    }
+
+def run_settings(mode, backend, strip_height, encoder, trim, trim_padding, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Check the processing options of process_images and watch_folder and
+    return them as the run settings dict stored in the run report; 'modes'
+    is the list of modes without duplicates.
+    """
+    modes = (mode,) if isinstance(mode, str) else tuple(dict.fromkeys(mode))
+    for name in modes:
+        blend_mode(name)
+    if not modes:
+        raise ValueError("No mode given")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    if encoder not in ENCODER_PRESETS:
+        raise ValueError(f"Unknown encoder: {encoder} (expected one of {', '.join(ENCODER_PRESETS)})")
+    if strip_height and ENCODER_PRESETS[encoder]["format"] != "PNG":
+        raise ValueError(f"The '{encoder}' encoder cannot be used with strip_height, use a PNG preset")
+    if trim and trim_padding < 0:
+        raise ValueError(f"trim_padding must not be negative, got {trim_padding}")
+    if resize_filter not in MASK_FILTERS:
+        raise ValueError(f"Unknown mask filter: {resize_filter} (expected one of {', '.join(MASK_FILTERS)})")
+    return {
+        "modes": list(modes), "backend": backend, "strip_height": strip_height, "encoder": encoder,
+        "trim": trim_padding if trim else None, "resize_filter": resize_filter,
+    }
+
+def prepare_pair_jobs(output_dir, base_name, main_path, mask_path, settings):
+    """Return the prepare_job result for every mode of the run settings (see run_settings)."""
+    jobs = []
+    for name in settings["modes"]:
+        job_settings = {
+            "mode": name, "backend": settings["backend"], "strip_height": settings["strip_height"],
+            "encoder": settings["encoder"],
+        }
+        # Only trimmed outputs carry the setting, so manifests of untrimmed runs stay current
+        if settings["trim"] is not None and BLEND_MODES[name]["operation"] == "alpha":
+            job_settings["trim"] = settings["trim"]
+        # Likewise for the mask filter, which only matters when it is not the default
+        if settings.get("resize_filter", DEFAULT_RESIZE_FILTER) != DEFAULT_RESIZE_FILTER:
+            job_settings["resize_filter"] = settings["resize_filter"]
+        jobs.append(prepare_job(
+            output_dir, base_name, main_path, mask_path, job_settings, settings.get("output_archive"),
+        ))
+    return jobs
+
+def read_image_header(path):
+    """
+    Return the 'size', 'mode', 'channels' and 'bit_depth' of an image from
+    its header alone. PNG headers are parsed directly; other formats go
+    through Image.open, which does not decode the pixels either.
+    """
+    with open_input(path) as image_file:
+        header = image_file.read(33)
+    if len(header) == 33 and header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR":
+        width, height, bit_depth, colour_type = struct.unpack(">IIBB", header[16:26])
+        return {
+            "size": (width, height), "mode": PNG_MODES.get(colour_type, "RGBA"),
+            "channels": PNG_CHANNELS.get(colour_type, 4), "bit_depth": bit_depth,
+        }
+    with Image.open(input_source(path)) as image:
+        return {"size": image.size, "mode": image.mode, "channels": len(image.getbands()), "bit_depth": 8}
+
+def estimate_pair_memory(main_header, mask_header, settings):
+    """
+    Rough peak memory in bytes of processing a pair with the run settings:
+    the RGBA working copies of both images, the results and an encoded copy
+    the size of a result (results are encoded one after another, so more
+    modes cost one RGBA image each, not two). Streaming holds about ten
+    strips per row band plus, when the mask has to be resized, the whole
+    mask at the size of the main image. Within about 15% of the measured
+    peak RSS of single pairs.
+    """
+    width, height = main_header["size"]
+    mask_width, mask_height = mask_header["size"]
+    decoded_mask = mask_width * mask_height * mask_header["channels"] * mask_header["bit_depth"] // 8
+    outputs = len(settings["modes"])
+    if settings["strip_height"]:
+        strip = width * min(settings["strip_height"], height) * 4
+        resized_mask = width * height if mask_header["size"] != main_header["size"] else 0
+        return strip * (6 + 2 * outputs) + decoded_mask + resized_mask
+    return decoded_mask + width * height * 4 * (3 + outputs)
+
+def plan_pairs(pairs, settings):
+    """
+    Planning pass over (base_name, main_path, mask_path) pairs that reads
+    only image headers (read_image_header). Returns (entries, summary): an
+    entry per pair with its paths, both headers, 'pixels', 'resize' (the
+    mask has another size) and 'memory' (estimate_pair_memory), largest
+    first; and their totals for the run report. Pairs whose headers cannot
+    be read are planned last and fail with the real error when processed.
+    """
+    entries = []
+    for base_name, main_path, mask_path in pairs:
+        entry = {
+            "base_name": base_name, "main_path": main_path, "mask_path": mask_path,
+            "main": None, "mask": None, "pixels": 0, "resize": False, "memory": 0,
+        }
+        try:
+            main_header, mask_header = read_image_header(main_path), read_image_header(mask_path)
+        except Exception:
+            pass
+        else:
+            width, height = main_header["size"]
+            entry.update(
+                main=main_header, mask=mask_header, pixels=width * height,
+                resize=mask_header["size"] != main_header["size"],
+                memory=estimate_pair_memory(main_header, mask_header, settings),
+            )
+        entries.append(entry)
+    # sort() keeps the listing order among equal pairs, also when reversed
+    entries.sort(key=lambda entry: (entry["memory"], entry["pixels"]), reverse=True)
+    summary = {
+        "pairs": len(entries),
+        "megapixels": sum(entry["pixels"] for entry in entries) / 1e6,
+        "resized_masks": sum(entry["resize"] for entry in entries),
+        "unreadable": sum(entry["main"] is None for entry in entries),
+        "largest_pair": entries[0]["base_name"] if entries else None,
+        "largest_pair_memory": entries[0]["memory"] if entries else 0,
+    }
+    return entries, summary
+
+def print_plan(summary, memory_budget=None):
+    """Print a plan_pairs summary, warning about pairs that need more than memory_budget bytes."""
+    print(
+        f"Planned {summary['pairs']} pairs, {summary['megapixels']:.1f} megapixels in total; "
+        f"{summary['resized_masks']} masks need resizing. The largest pair, {summary['largest_pair']}, "
+        f"needs about {summary['largest_pair_memory'] / 2 ** 20:.0f} MiB."
+    )
+    if memory_budget and summary["largest_pair_memory"] > memory_budget:
+        print(f"Pairs larger than the {memory_budget >> 20} MiB memory budget will run on their own.")
+    if summary["unreadable"]:
+        print(f"{summary['unreadable']} pairs have headers that could not be read.")
+
+def plan_images(input_dir, mode="cutout", recursive=False, strip_height=None, shard=None):
+    """
+    Run only the planning pass of process_images (plan_pairs) over input_dir,
+    a folder or an archive, or over one "k/n" shard of it, print its summary
+    and return (entries, summary).
+    """
+    settings = run_settings(mode, "pil", strip_height, DEFAULT_ENCODER, False, 0)
+    index = open_pair_index(input_dir, recursive=recursive, shard=parse_shard(shard) if shard else None)
+    entries, summary = plan_pairs(index, settings)
+    print_plan(summary)
+    return entries, summary
+
+def report_progress(progress, result, index, outputs_per_pair, scan_complete):
+    """Forward the number of finished and discovered outputs to the progress callback."""
+    if progress is not None:
+        done = result["saved"] + result["skipped"] + result["failed"]
+        progress(done, index.pair_count * outputs_per_pair, scan_complete)
+
+def prepare_job(output_dir, base_name, main_path, mask_path, settings, archive=None):
+    """
+    Describe the work for one output of a pair: input paths and signatures,
+    settings (with the output's mode) and the output path. Mirrored output
+    subfolders are created when needed. With archive (the path of an output
+    archive) the output becomes a member of it instead, named like the file
+    would be in output_dir. When an input cannot be read (it vanished, or
+    is a dangling link), the job has no signatures and carries the 'error'
+    instead; callers count it as failed without processing it.
+    """
+    extension = ENCODER_PRESETS[settings["encoder"]]["extension"]
+    output_path = os.path.join(output_dir, f"{base_name}_{settings['mode']}{extension}")
+    output = os.path.relpath(output_path, output_dir).replace(os.sep, "/")
+    output_subdir = os.path.dirname(output_path)
+    if archive is not None:
+        output_path = archive_member_path(archive, output)
+    elif output_subdir != output_dir and not os.path.exists(output_subdir):
+        os.makedirs(output_subdir, exist_ok=True)
+    job = {
+        "output": output,
+        "output_path": output_path,
+        "archive": archive,
+        "main_path": main_path,
+        "mask_path": mask_path,
+        "main": None,
+        "mask": None,
+        "settings": settings,
+    }
+    try:
+        job["main"] = file_signature(main_path)
+        job["mask"] = file_signature(mask_path)
+    except OSError as e:
+        job["error"] = str(e)
+    return job
+
+def collect_pair_future(result, manifest, metrics, future, jobs, deduper=None):
+    """Record the outcomes of a pair that was processed in a worker process."""
+    try:
+        outcomes = future.result()
+    except Exception as e:  # the worker process itself died
+        outcomes = [{"error": str(e)} for _ in jobs]
+    if outcomes is None:
+        return  # skipped by a worker after a cancel, like a cancelled future
+    for job, outcome in zip(jobs, outcomes):
+        record_pair_result(result, manifest, metrics, job, outcome, deduper)
+
+def record_pair_result(result, manifest, metrics, job, outcome, deduper=None):
+    """
+    Add the outcome of one output to the aggregated result, the run metrics
+    and the manifest. With an OutputDeduper, the copies of the output that
+    waited for it are made and recorded too. Outputs linked by the deduper
+    are counted as saved and as reused, but not in the stage timings.
+    """
+    result["mask_cache_hits"] += outcome.get("mask_cache_hits", 0)
+    result["mask_cache_misses"] += outcome.get("mask_cache_misses", 0)
+    if "link" in outcome:
+        result["reused"] += 1
+        result["reused_bytes"] += outcome["reused_bytes"]
+        result["links"][outcome["link"]] = result["links"].get(outcome["link"], 0) + 1
+    else:
+        metrics.add(job, outcome)
+    if outcome["error"] is None:
+        result["saved"] += 1
+        result["pixels"] += outcome["pixels"]
+        result["bytes_written"] += outcome["bytes"]
+        for stage, seconds in outcome["stages"].items():
+            result["stage_seconds"][stage] += seconds
+        for name, data in outcome.pop("files", {}).items():
+            manifest.archive.write(name, data)
+        manifest.record(job, outcome.get("trim"))
+    else:
+        print(f"Error processing {os.path.basename(job['main_path'])} and {os.path.basename(job['mask_path'])}: {outcome['error']}")
+        result["failed"] += 1
+    if deduper is not None:
+        for copy_job, copy_outcome in deduper.finished(job, outcome):
+            record_pair_result(result, manifest, metrics, copy_job, copy_outcome)
+
+class RunMetrics:
+    """
+    Per-pair samples of a process_images run: the seconds each saved pair
+    spent in every stage and the pairs that failed. build_run_report turns
+    them into totals and percentiles.
+    """
+
+    def __init__(self):
+        self.pair_seconds = []
+        self.stage_seconds = {stage: [] for stage in STAGES}
+        self.failures = []
+
+    def add(self, job, outcome):
+        """Record the outcome of one pair."""
+        if outcome["error"] is not None:
+            self.failures.append({
+                "output": job["output"],
+                "main_path": job["main_path"],
+                "mask_path": job["mask_path"],
+                "error": outcome["error"],
+            })
+            return
+        stages = outcome["stages"]
+        self.pair_seconds.append(sum(stages.values()))
+        for stage in STAGES:
+            self.stage_seconds[stage].append(stages[stage])
+
+def summarize_samples(samples):
+    """Return the total, count, PERCENTILES (nearest rank) and maximum of a list of seconds."""
+    ordered = sorted(samples)
+    summary = {"total": sum(ordered), "count": len(ordered)}
+    for fraction in PERCENTILES:
+        rank = max(0, math.ceil(len(ordered) * fraction) - 1)
+        summary[f"p{fraction * 100:g}"] = ordered[rank] if ordered else 0.0
+    summary["max"] = ordered[-1] if ordered else 0.0
+    return summary
+
+def build_run_report(result, metrics, settings, input_dir, output_dir, started):
+    """
+    Describe a finished run as a JSON-serialisable dict: settings, counts,
+    totals, per-stage and per-pair timing summaries, mask cache use, outputs
+    reused by dedupe and the failed pairs with their errors.
+    """
+    wall_seconds = time.time() - started
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started)),
+        "wall_seconds": wall_seconds,
+        "input_dir": input_dir,
+        "output_dir": output_dir,
+        "settings": settings,
+        "counts": {key: result[key] for key in ("saved", "skipped", "failed", "unmatched", "orphans")},
+        "cancelled": result["cancelled"],
+        "pixels": result["pixels"],
+        "bytes_written": result["bytes_written"],
+        "megapixels_per_second": result["pixels"] / 1e6 / wall_seconds if wall_seconds else 0.0,
+        "mask_cache": {"hits": result["mask_cache_hits"], "misses": result["mask_cache_misses"]},
+        "plan": result["plan"],
+        "dedupe": {"reused": result["reused"], "reused_bytes": result["reused_bytes"], "links": result["links"]},
+        "stages": {stage: summarize_samples(samples) for stage, samples in metrics.stage_seconds.items()},
+        "pair_seconds": summarize_samples(metrics.pair_seconds),
+        "failures": metrics.failures,
+    }
+
+def write_text_atomically(path, text):
+    """Write text to a temporary file next to path and move it into place."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as temp_file:
+        temp_file.write(text)
+    os.replace(temp_path, path)
+
+def write_run_report(path, report):
+    """Save a build_run_report dict as indented JSON."""
+    write_text_atomically(path, json.dumps(report, indent=2, ensure_ascii=False) + "\n")
+
+def write_prometheus_textfile(path, report):
+    """
+    Save the figures of a run report in the Prometheus text format, for the
+    node_exporter textfile collector. Stage and pair timings are exported as
+    summaries with the PERCENTILES as quantiles.
+    """
+    labels = f'mode="{",".join(report["settings"]["modes"])}",backend="{report["settings"]["backend"]}"'
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP mask_pipeline_{name} {help_text}")
+        lines.append(f"# TYPE mask_pipeline_{name} {kind}")
+        for suffix, extra_labels, value in samples:
+            lines.append(f"mask_pipeline_{name}{suffix}{{{labels}{extra_labels}}} {value}")
+
+    def summary_samples(summary, extra_labels=""):
+        samples = [
+            ("", f'{extra_labels},quantile="{fraction:g}"', summary[f"p{fraction * 100:g}"])
+            for fraction in PERCENTILES
+        ]
+        return samples + [("_sum", extra_labels, summary["total"]), ("_count", extra_labels, summary["count"])]
+
+    metric("last_run_timestamp_seconds", "gauge", "Unix time the last run finished.",
+           [("", "", time.time())])
+    metric("last_run_wall_seconds", "gauge", "Wall-clock duration of the last run.",
+           [("", "", report["wall_seconds"])])
+    metric("last_run_pairs", "gauge", "Pairs of the last run by outcome.",
+           [("", f',outcome="{outcome}"', count) for outcome, count in report["counts"].items()])
+    metric("last_run_pixels", "gauge", "Pixels written by the last run.", [("", "", report["pixels"])])
+    metric("last_run_bytes_written", "gauge", "Bytes written by the last run.",
+           [("", "", report["bytes_written"])])
+    metric("last_run_mask_cache_lookups", "gauge", "Mask cache lookups of the last run by result.",
+           [("", f',result="{key}"', count) for key, count in report["mask_cache"].items()])
+    metric("last_run_stage_seconds", "summary", "Seconds one pair spent in each stage during the last run.",
+           [sample for stage, summary in report["stages"].items()
+            for sample in summary_samples(summary, f',stage="{stage}"')])
+    metric("last_run_pair_seconds", "summary", "Seconds spent on one pair during the last run.",
+           summary_samples(report["pair_seconds"]))
+    write_text_atomically(path, "\n".join(lines) + "\n")
+
+def shard_report_paths(folder):
+    """Return the default run report paths of all shards found in an output folder, sorted."""
+    root, extension = os.path.splitext(RUN_REPORT_NAME)
+    return sorted(glob.glob(os.path.join(glob.escape(folder), f"{root}.*-of-*{extension}")))
+
+def merge_run_reports(paths):
+    """
+    Combine the run reports of the shards of one run (process_images with
+    shard) into a single report of the same layout. Counts, totals and
+    failures are added up and wall_seconds spans from the first start to the
+    last finish. Percentiles cannot be rebuilt from the shards' summaries,
+    so the merged stage and pair timings keep only total, count and max.
+    'shards' lists each report with its own counts and time, and
+    'missing_shards' the shards of which no report was given. Raises
+    ValueError if the reports are not shards of one run.
+    """
+    if not paths:
+        raise ValueError("No run reports to merge")
+    reports = []
+    for path in paths:
+        with open(path, encoding="utf-8") as report_file:
+            reports.append((path, json.load(report_file)))
+
+    def common_settings(report):
+        return {key: value for key, value in report["settings"].items() if key not in ("shard", "output_archive")}
+
+    first = reports[0][1]
+    shard_count = (first["settings"].get("shard") or [None, None])[1]
+    seen = {}
+    for path, report in reports:
+        shard = report["settings"].get("shard")
+        if shard is None:
+            raise ValueError(f"{path} is not the run report of a shard")
+        if shard[1] != shard_count:
+            raise ValueError(f"{path} is a report of {shard[1]} shards, {reports[0][0]} of {shard_count}")
+        if shard[0] in seen:
+            raise ValueError(f"{path} and {seen[shard[0]]} are both reports of shard {shard[0]}/{shard_count}")
+        if common_settings(report) != common_settings(first):
+            raise ValueError(f"{path} was made with other settings than {reports[0][0]}")
+        seen[shard[0]] = path
+
+    starts = [datetime.strptime(report["started"], "%Y-%m-%dT%H:%M:%S%z").timestamp() for _, report in reports]
+    started = min(starts)
+    wall_seconds = max(start + report["wall_seconds"] for start, (_, report) in zip(starts, reports)) - started
+    pixels = sum(report["pixels"] for _, report in reports)
+
+    def merge_summaries(summaries):
+        return {
+            "total": sum(summary["total"] for summary in summaries),
+            "count": sum(summary["count"] for summary in summaries),
+            "max": max(summary["max"] for summary in summaries),
+        }
+
+    plans = [report["plan"] for _, report in reports]
+    plan = None
+    if all(plans):
+        largest = max(plans, key=lambda shard_plan: shard_plan["largest_pair_memory"])
+        plan = {key: sum(shard_plan[key] for shard_plan in plans)
+                for key in ("pairs", "megapixels", "resized_masks", "unreadable")}
+        plan.update(largest_pair=largest["largest_pair"], largest_pair_memory=largest["largest_pair_memory"])
+    links = {}
+    for _, report in reports:
+        for method, count in report.get("dedupe", {}).get("links", {}).items():
+            links[method] = links.get(method, 0) + count
+
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started)),
+        "wall_seconds": wall_seconds,
+        "input_dir": first["input_dir"],
+        "output_dir": first["output_dir"],
+        "settings": common_settings(first),
+        "counts": {key: sum(report["counts"][key] for _, report in reports) for key in first["counts"]},
+        "cancelled": any(report["cancelled"] for _, report in reports),
+        "pixels": pixels,
+        "bytes_written": sum(report["bytes_written"] for _, report in reports),
+        "megapixels_per_second": pixels / 1e6 / wall_seconds if wall_seconds else 0.0,
+        "mask_cache": {key: sum(report["mask_cache"][key] for _, report in reports) for key in first["mask_cache"]},
+        "plan": plan,
+        "dedupe": {
+            "reused": sum(report.get("dedupe", {}).get("reused", 0) for _, report in reports),
+            "reused_bytes": sum(report.get("dedupe", {}).get("reused_bytes", 0) for _, report in reports),
+            "links": links,
+        },
+        "stages": {
+            stage: merge_summaries([report["stages"][stage] for _, report in reports]) for stage in first["stages"]
+        },
+        "pair_seconds": merge_summaries([report["pair_seconds"] for _, report in reports]),
+        "failures": sorted(
+            (failure for _, report in reports for failure in report["failures"]), key=lambda failure: failure["output"],
+        ),
+        "shards": [
+            {
+                "shard": report["settings"]["shard"], "report": path, "started": report["started"],
+                "wall_seconds": report["wall_seconds"], "counts": report["counts"], "cancelled": report["cancelled"],
+            }
+            for path, report in sorted(reports, key=lambda item: item[1]["settings"]["shard"][0])
+        ],
+        "missing_shards": [index for index in range(1, shard_count + 1) if index not in seen],
+    }
+
+def find_objects(image_path, mask_path, min_area=0):
+    """
+    Decode a pair for splitting and label the objects of its mask with one
+    cv2.connectedComponentsWithStats pass. Returns (main_image, mask, labels,
+    objects, dropped): the main image in RGBA, the mask as an array at the
+    main image's size, the label array, a (label, box) tuple for every
+    object of at least min_area pixels in label order, and the number of
+    smaller objects that were left out.
+    """
+    import cv2
+    import numpy as np
+
+    main_image = Image.open(input_source(image_path)).convert("RGBA")
+    mask_image = Image.open(input_source(mask_path))
+    if mask_image.size != main_image.size:
+        # Same conversion and resize as decode_pil, so objects match the cutout
+        mask_image = resize_mask(mask_image.convert(mask_working_mode(mask_image, "cutout", True)), main_image.size)
+    mask = np.asarray(mask_image.convert("L"))
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    objects = []
+    for label in range(1, count):
+        x, y, w, h, area = (int(value) for value in stats[label])
+        if area >= min_area:
+            objects.append((label, (x, y, x + w, y + h)))
+    return main_image, mask, labels, objects, count - 1 - len(objects)
+
+def crop_object(main_image, mask, labels, label, box):
+    """
+    Cut one object found by find_objects out of the main image as RGBA.
+    Pixels of other objects inside the box are made transparent.
+    """
+    import numpy as np
+
+    left, top, right, bottom = box
+    alpha = np.where(labels[top:bottom, left:right] == label, mask[top:bottom, left:right], 0).astype(np.uint8)
+    cropped = main_image.crop(box)
+    cropped.putalpha(Image.fromarray(alpha, "L"))
+    return cropped
+
+def save_object(main_image, mask, labels, label, box, output_path, encoder=DEFAULT_ENCODER):
+    """Crop one object (crop_object) and save it with an ENCODER_PRESETS entry."""
+    save_image(crop_object(main_image, mask, labels, label, box), output_path, encoder)
+    return output_path
+
+def pack_shelves(sizes, max_size=DEFAULT_ATLAS_SIZE, padding=ATLAS_PADDING):
+    """
+    Pack (width, height) rectangles into pages of at most max_size pixels a
+    side with a first-fit shelf packer: rectangles are placed tallest first,
+    left to right on horizontal shelves, and a new shelf or page is opened
+    when none of the existing ones has room. A rectangle larger than max_size
+    gets a page of its own. Returns (placements, page_sizes): a (page, x, y)
+    tuple per rectangle in the order of sizes, and the used size of each page.
+    """
+    placements = [None] * len(sizes)
+    pages = []  # [width, height, shelves], each shelf is [y, height, next x]
+    for index in sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0])):
+        width, height = sizes[index]
+        if width > max_size or height > max_size:
+            pages.append([width, height, []])
+            placements[index] = (len(pages) - 1, 0, 0)
+            continue
+        for page_index, page in enumerate(pages):
+            shelf = next((shelf for shelf in page[2] if shelf[1] >= height and shelf[2] + width <= max_size), None)
+            if shelf is None and page[2] and page[1] + padding + height <= max_size:
+                shelf = [page[1] + padding, height, 0]
+                page[2].append(shelf)
+            if shelf is not None:
+                break
+        else:
+            shelf = [0, height, 0]
+            pages.append([0, 0, [shelf]])
+            page_index, page = len(pages) - 1, pages[-1]
+        placements[index] = (page_index, shelf[2], shelf[0])
+        page[0] = max(page[0], shelf[2] + width)
+        page[1] = max(page[1], shelf[0] + height)
+        shelf[2] += width + padding
+    return placements, [(page[0], page[1]) for page in pages]
+
+def render_atlas_page(main_image, mask, labels, entries, size, output_path, encoder=DEFAULT_ENCODER):
+    """Paste the (label, box, position) entries of one atlas page onto a transparent page and save it."""
+    page = Image.new("RGBA", size, (0, 0, 0, 0))
+    for label, box, position in entries:
+        page.paste(crop_object(main_image, mask, labels, label, box), position)
+    save_image(page, output_path, encoder)
+    return output_path
+
+def submit_objects(executor, found, output_dir, encoder=DEFAULT_ENCODER, atlas_size=None):
+    """
+    Submit the writes for the objects of find_objects' result and return a
+    (future, object count) tuple for each. Without atlas_size every object
+    becomes object_N; with it the objects are packed (pack_shelves) into
+    atlas_N pages, and ATLAS_INDEX_NAME records for object N its page, its
+    rectangle [x, y, width, height] on that page and its offset in the main
+    image.
+    """
+    main_image, mask, labels, objects, _ = found
+    extension = ENCODER_PRESETS[encoder]["extension"]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+    if not atlas_size:
+        return [
+            (executor.submit(
+                save_object, main_image, mask, labels, label, box,
+                os.path.join(output_dir, f"object_{number}{extension}"), encoder,
+            ), 1)
+            for number, (label, box) in enumerate(objects, 1)
+        ]
+
+    sizes = [(right - left, bottom - top) for _, (left, top, right, bottom) in objects]
+    placements, page_sizes = pack_shelves(sizes, atlas_size)
+    index = {
+        "canvas": list(main_image.size),
+        "pages": [
+            {"image": f"atlas_{number}{extension}", "size": list(size)}
+            for number, size in enumerate(page_sizes, 1)
+        ],
+        "objects": [],
+    }
+    entries = [[] for _ in page_sizes]
+    for number, ((label, box), (page, x, y), (width, height)) in enumerate(zip(objects, placements, sizes), 1):
+        entries[page].append((label, box, (x, y)))
+        index["objects"].append({"id": number, "page": page, "rect": [x, y, width, height], "offset": list(box[:2])})
+    write_text_atomically(os.path.join(output_dir, ATLAS_INDEX_NAME), json.dumps(index) + "\n")
+    return [
+        (executor.submit(
+            render_atlas_page, main_image, mask, labels, page_entries, size,
+            os.path.join(output_dir, page["image"]), encoder,
+        ), len(page_entries))
+        for page_entries, size, page in zip(entries, page_sizes, index["pages"])
+    ]
+
+def split_objects_by_mask(image_path, mask_path, output_dir, min_area=0, threads=None, encoder=DEFAULT_ENCODER,
+                          atlas_size=None):
+    """
+    Разделяет объекты из основного изображения по маске и сохраняет их отдельно
+    (object_1.png, object_2.png, ...). Объекты меньше min_area пикселей
+    пропускаются, а кадры кодируются и пишутся в threads потоках.
+    С atlas_size объекты вместо отдельных файлов упаковываются в атласы
+    atlas_N.png со стороной не больше atlas_size и индексом atlas.json
+    (см. submit_objects).
+    cv2 импортируется только при вызове, остальной модуль работает без него.
+    Возвращает список сохранённых файлов.
+    """
+    found = find_objects(image_path, mask_path, min_area)
+    print(f"Найдено {len(found[3])} объектов, пропущено мелких: {found[4]}.")
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+        futures = submit_objects(executor, found, output_dir, encoder, atlas_size)
+        return [future.result() for future, _ in futures]
+
+def split_images(input_dir, output_dir, min_area=0, recursive=False, threads=None,
+                 encoder=DEFAULT_ENCODER, atlas_size=None, cancel=None):
+    """
+    Run split_objects_by_mask over every _main/_mask pair of input_dir, a
+    folder or an archive (see open_pair_index); the objects of base_main.png
+    go to output_dir/base/. While the crops of one pair are encoded and
+    written by a pool of threads (default: CPU count), the next pair is
+    already being decoded and labelled.
+    atlas_size packs each pair's objects into atlas pages (see submit_objects).
+    cancel is an optional threading.Event checked between pairs.
+    Returns a dict with the 'pairs' split, the 'objects' saved, the objects
+    'dropped' for being too small, the pairs and files that 'failed', the
+    'unmatched' and 'orphans' file counts and a 'cancelled' flag.
+    """
+    if encoder not in ENCODER_PRESETS:
+        raise ValueError(f"Unknown encoder: {encoder} (expected one of {', '.join(ENCODER_PRESETS)})")
+    threads = threads or os.cpu_count() or 1
+    result = {"pairs": 0, "objects": 0, "dropped": 0, "failed": 0, "unmatched": 0, "orphans": 0, "cancelled": False}
+    index = open_pair_index(input_dir, recursive=recursive)
+    pending = {}
+
+    def collect(future):
+        main_path, mask_path, count = pending.pop(future)
+        try:
+            future.result()
+            result["objects"] += count
+        except Exception as e:
+            print(f"Error splitting {os.path.basename(main_path)} and {os.path.basename(mask_path)}: {e}")
+            result["failed"] += 1
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for base_name, main_path, mask_path in index:
+            if cancel is not None and cancel.is_set():
+                result["cancelled"] = True
+                break
+            try:
+                found = find_objects(main_path, mask_path, min_area)
+            except Exception as e:
+                print(f"Error splitting {os.path.basename(main_path)} and {os.path.basename(mask_path)}: {e}")
+                result["failed"] += 1
+                continue
+            print(f"Splitting {os.path.basename(main_path)}: {len(found[3])} objects, {found[4]} below min_area")
+            result["pairs"] += 1
+            result["dropped"] += found[4]
+            # Keep the number of queued crops bounded so decoded pairs do not pile up
+            while len(pending) > threads * 16:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+            futures = submit_objects(executor, found, os.path.join(output_dir, base_name), encoder, atlas_size)
+            for future, count in futures:
+                pending[future] = (main_path, mask_path, count)
+        for future in list(pending):
+            collect(future)
+
+    if not result["cancelled"]:
+        result["unmatched"] = len(index.unmatched_mains)
+        result["orphans"] = len(index.orphan_masks)
+    return result
+
+def stack_file_name(mode, size):
+    """Name of the stack_images stack holding the mode's results of one image size."""
+    return f"{mode}_{size[0]}x{size[1]}.npy"
+
+def stack_pair(main_path, mask_path, backend, targets, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Decode a pair once and write the RGBA result of every (mode, stack_path,
+    slot) in targets straight into that slot of the memory-mapped stack.
+    The numpy backend composites in place (composite_arrays(out=...)); the
+    pil backend copies its result image in. Masks are resized with
+    resize_filter, as in process_images. Returns the error text, or None.
+    """
+    import numpy as np
+
+    try:
+        main_image, masks = decode_pair(
+            main_path, mask_path, backend, [mode for mode, _, _ in targets], resize_filter=resize_filter,
+        )
+        for mode, stack_path, slot in targets:
+            stack = np.load(stack_path, mmap_mode="r+")
+            if stack.shape[1:3] != (main_image.height, main_image.width):
+                raise ValueError(f"{os.path.basename(main_path)} changed size while the stacks were being written")
+            if backend == "numpy":
+                composite_arrays(np.asarray(main_image), masks[mode], mode, out=stack[slot])
+            else:
+                stack[slot] = np.asarray(blend_pil(main_image, masks[mode], mode).convert("RGBA"))
+            del stack  # unmaps; the pages are already shared with every reader of the file
+    except Exception as e:
+        return str(e)
+    return None
+
+def stack_images(input_dir, output_dir, mode="cutout", workers=None, recursive=False, backend="numpy",
+                 mask_cache_mb=DEFAULT_MASK_CACHE_MB, cancel=None, resize_filter=DEFAULT_RESIZE_FILTER):
+    """
+    Write the composited results of the pairs of input_dir (a folder or an
+    archive) as memory-mapped arrays instead of image files, for consumers
+    such as training jobs that would only decode the PNGs again.
+
+    The image sizes come from a header-only pass (plan_pairs). Pairs are
+    grouped by main image size, and each size and mode gets a preallocated
+    .npy file (stack_file_name) of shape (pairs, height, width, 4), uint8
+    RGBA, in output_dir. Workers (a pool of `workers` processes, default
+    CPU count; 1 = this process) map the file and write their pair into its
+    slot (stack_pair), so nothing is encoded or copied through the parent.
+    STACK_INDEX_NAME lists every stack with its 'file', 'mode', 'shape' and
+    the 'base_names' of its slots in order, the 'empty_slots' left zero by
+    failed or cancelled pairs, and the failures with their errors. Read it
+    with load_stacks. Stacks are rewritten on every run. resize_filter is
+    the mask filter of process_images (MASK_FILTERS).
+
+    Returns a dict with the 'pairs' written, the 'stacks' count, the pairs
+    that 'failed', the 'unmatched' and 'orphans' file counts, a
+    'cancelled' flag and the 'index_path'.
+    """
+    import numpy as np
+
+    settings = run_settings(mode, backend, None, DEFAULT_ENCODER, False, 0, resize_filter)
+    modes = settings["modes"]
+    workers = workers or os.cpu_count() or 1
+    result = {"pairs": 0, "stacks": 0, "failed": 0, "unmatched": 0, "orphans": 0, "cancelled": False,
+              "index_path": os.path.join(output_dir, STACK_INDEX_NAME)}
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    index = open_pair_index(input_dir, recursive=recursive)
+    entries, _ = plan_pairs(index, settings)
+    failures = []
+    groups = {}
+    for entry in sorted(entries, key=lambda entry: entry["base_name"]):
+        if entry["main"] is None:
+            failures.append({"base_name": entry["base_name"], "main_path": entry["main_path"],
+                             "mask_path": entry["mask_path"], "error": "cannot read the image headers"})
+        else:
+            groups.setdefault(tuple(entry["main"]["size"]), []).append(entry)
+
+    stacks = []
+    tasks = []
+    for size, group in sorted(groups.items()):
+        stack_paths = {}
+        for name in modes:
+            stack_paths[name] = os.path.join(output_dir, stack_file_name(name, size))
+            shape = (len(group), size[1], size[0], 4)
+            # Creates the file at its full size; the map itself is dropped right away
+            np.lib.format.open_memmap(stack_paths[name], mode="w+", dtype=np.uint8, shape=shape)
+            stacks.append({
+                "file": stack_file_name(name, size), "mode": name, "shape": list(shape), "dtype": "uint8",
+                "base_names": [entry["base_name"].replace(os.sep, "/") for entry in group], "empty_slots": [],
+            })
+        for slot, entry in enumerate(group):
+            targets = [(name, stack_paths[name], slot) for name in modes]
+            tasks.append((entry, targets, stacks[-len(modes):]))
+    print(f"Writing {len(tasks)} pairs into {len(stacks)} stacks in {output_dir}")
+
+    def leave_empty(task):
+        for (_, _, slot), stack in zip(task[1], task[2]):
+            stack["empty_slots"].append(slot)
+
+    def record(task, error):
+        entry = task[0]
+        if error is None:
+            result["pairs"] += 1
+            return
+        leave_empty(task)
+        print(f"Error stacking {os.path.basename(entry['main_path'])} and "
+              f"{os.path.basename(entry['mask_path'])}: {error}")
+        failures.append({"base_name": entry["base_name"], "main_path": entry["main_path"],
+                         "mask_path": entry["mask_path"], "error": error})
+
+    def future_error(future):
+        try:
+            return future.result()
+        except Exception as e:  # the worker process itself died
+            return str(e)
+
+    if workers <= 1:
+        configure_mask_cache(mask_cache_mb << 20)
+        for task in tasks:
+            if cancel is not None and cancel.is_set():
+                result["cancelled"] = True
+                leave_empty(task)
+                continue
+            record(task, stack_pair(task[0]["main_path"], task[0]["mask_path"], backend, task[1], resize_filter))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=configure_mask_cache, initargs=(mask_cache_mb << 20,)
+        ) as executor:
+            pending = {}
+            for task in tasks:
+                if cancel is not None and cancel.is_set():
+                    result["cancelled"] = True
+                    leave_empty(task)
+                    continue
+                # Keep the number of queued pairs bounded, as in process_images
+                while len(pending) >= workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record(pending.pop(future), future_error(future))
+                try:
+                    future = executor.submit(
+                        stack_pair, task[0]["main_path"], task[0]["mask_path"], backend, task[1], resize_filter,
+                    )
+                except Exception as e:  # a worker died and broke the pool
+                    record(task, str(e))
+                    continue
+                pending[future] = task
+            for future in as_completed(pending):
+                record(pending[future], future_error(future))
+
+    for stack in stacks:
+        stack["empty_slots"].sort()
+    result["stacks"] = len(stacks)
+    result["failed"] = len(failures)
+    if not result["cancelled"]:
+        result["unmatched"] = len(index.unmatched_mains)
+        result["orphans"] = len(index.orphan_masks)
+    write_text_atomically(result["index_path"], json.dumps({
+        "input_dir": input_dir,
+        "settings": {"modes": modes, "backend": backend, "resize_filter": resize_filter},
+        "stacks": stacks,
+        "failures": failures,
+        "cancelled": result["cancelled"],
+    }, indent=2, ensure_ascii=False) + "\n")
+    return result
+
+def load_stacks(output_dir):
+    """
+    Open the stacks of a stack_images run read-only and without copying:
+    returns (index entry, array) pairs in the order of STACK_INDEX_NAME,
+    where array is np.load(mmap_mode="r") and array[i] is the (h, w, 4)
+    result of entry['base_names'][i].
+    """
+    import numpy as np
+
+    with open(os.path.join(output_dir, STACK_INDEX_NAME), encoding="utf-8") as index_file:
+        stack_index = json.load(index_file)
+    return [
+        (stack, np.load(os.path.join(output_dir, stack["file"]), mmap_mode="r")) for stack in stack_index["stacks"]
+    ]
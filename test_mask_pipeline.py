@@ -0,0 +1,267 @@
+"""
+Tests for mask_pipeline.
+
+    python -m pytest -q
+"""
+import numpy as np
+import pytest
+from PIL import Image
+
+import mask_pipeline
+
+MAIN_SIZE = (97, 61)
+MASK_SIZES = ((97, 61), (40, 30), (200, 150), (194, 122))  # same, up, down, down by a whole factor
+MAIN_MODES = ("RGB", "RGBA", "L", "P", "LA")
+MASK_MODES = ("L", "RGB", "RGBA", "1", "P", "P-transparency", "LA")
+
+def noise_image(size, seed):
+    """An RGBA image with independent noise in every band, so colour masks are not gray."""
+    return Image.merge("RGBA", [Image.effect_noise(size, 60 + 20 * band + seed) for band in range(4)])
+
+def save_image_as(image, mode, path):
+    """Save image converted to mode; 'P-transparency' is a palette image with a transparent index."""
+    if mode == "P-transparency":
+        image = image.convert("RGB").convert("P")
+        image.info["transparency"] = 0
+        image.save(path, transparency=0)
+    else:
+        image.convert(mode).save(path)
+    return str(path)
+
+def reference_composite(main_path, mask_path, mode):
+    """The original Pillow path: both images in RGBA, the whole RGBA mask resized."""
+    main_image = Image.open(main_path).convert("RGBA")
+    mask_image = Image.open(mask_path).convert("RGBA").resize(main_image.size)
+    return mask_pipeline.blend_pil(main_image, mask_image, mode)
+
+@pytest.mark.parametrize("main_mode", MAIN_MODES)
+@pytest.mark.parametrize("mask_mode", MASK_MODES)
+def test_backends_match_original_path(tmp_path, main_mode, mask_mode):
+    """composite_pil and composite_numpy give the pixels of the original path for every mode and mask size."""
+    mask_pipeline.configure_mask_cache(0)
+    main_path = save_image_as(noise_image(MAIN_SIZE, 0), main_mode, tmp_path / "main.png")
+    for index, mask_size in enumerate(MASK_SIZES):
+        mask_path = save_image_as(noise_image(mask_size, index + 1), mask_mode, tmp_path / f"mask{index}.png")
+        for mode in mask_pipeline.BLEND_MODES:
+            expected = np.asarray(reference_composite(main_path, mask_path, mode))
+            for composite in (mask_pipeline.composite_pil, mask_pipeline.composite_numpy):
+                result = np.asarray(composite(main_path, mask_path, mode))
+                assert np.array_equal(result, expected), (composite.__name__, mode, mask_size)
+
+@pytest.mark.parametrize("main_mode", ("RGB", "P", "LA"))
+@pytest.mark.parametrize("mask_mode", MASK_MODES)
+def test_streaming_matches_pil(tmp_path, main_mode, mask_mode):
+    """composite_streaming writes the pixels of composite_pil, whether or not the strips divide the height."""
+    mask_pipeline.configure_mask_cache(0)
+    main_path = save_image_as(noise_image(MAIN_SIZE, 0), main_mode, tmp_path / "main.png")
+    for index, mask_size in enumerate(MASK_SIZES):
+        mask_path = save_image_as(noise_image(mask_size, index + 1), mask_mode, tmp_path / f"mask{index}.png")
+        for strip_height in (1, 16, MAIN_SIZE[1]):
+            outputs = {mode: str(tmp_path / f"{mode}.png") for mode in mask_pipeline.BLEND_MODES}
+            mask_pipeline.composite_streaming(main_path, mask_path, outputs, strip_height)
+            for mode, output_path in outputs.items():
+                expected = np.asarray(mask_pipeline.composite_pil(main_path, mask_path, mode))
+                with Image.open(output_path) as streamed:
+                    assert np.array_equal(np.asarray(streamed), expected), (mode, mask_size, strip_height)
+
+@pytest.mark.parametrize("mask_mode", MASK_MODES)
+def test_default_filter_keeps_streamed_trim_box(tmp_path, mask_mode):
+    """The streamed trim box of a resized mask is the box of the in-memory cutout with the default filter."""
+    mask_pipeline.configure_mask_cache(0)
+    main_path = save_image_as(noise_image(MAIN_SIZE, 0), "RGB", tmp_path / "main.png")
+    mask_image = Image.new("L", (40, 30), 0)
+    mask_image.paste(255, (10, 5, 30, 20))
+    mask_path = save_image_as(mask_image, mask_mode, tmp_path / "mask.png")
+    result = mask_pipeline.composite_pil(main_path, mask_path, "cutout")
+    box = mask_pipeline.streaming_trim_box(mask_path, MAIN_SIZE, 16)
+    assert box == result.getchannel("A").getbbox()
+
+def test_resize_mask_strategies():
+    """Masks at size are not copied, whole-factor box downscales match the box filter within a level."""
+    mask_image = Image.effect_noise((200, 150), 80)
+    assert mask_pipeline.resize_mask(mask_image, (200, 150)) is mask_image
+    reduced = np.asarray(mask_pipeline.resize_mask(mask_image, (100, 75), "box"), dtype=int)
+    boxed = np.asarray(mask_image.resize((100, 75), Image.BOX), dtype=int)
+    assert np.abs(reduced - boxed).max() <= 1
+    hard = mask_image.point(lambda value: 255 if value >= 128 else 0)
+    assert mask_pipeline.choose_resize_filter(hard, (300, 200), "auto") == "nearest"
+    assert mask_pipeline.choose_resize_filter(mask_image, (100, 75), "auto") == "box"
+    assert mask_pipeline.choose_resize_filter(mask_image, (300, 200), "auto") == "bilinear"
+
+def write_pairs(folder, count):
+    """Write count small main/mask pairs into folder."""
+    folder.mkdir(exist_ok=True)
+    for index in range(count):
+        noise_image(MAIN_SIZE, index).convert("RGB").save(folder / f"pair{index}_main.png")
+        Image.effect_noise(MAIN_SIZE, 90).save(folder / f"pair{index}_mask.png")
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_unreadable_pair_fails_alone(tmp_path, workers):
+    """A pair whose main image is a dangling link is counted as failed; the other pairs are still made."""
+    write_pairs(tmp_path / "input", 3)
+    (tmp_path / "input" / "broken_main.png").symlink_to(tmp_path / "missing.png")
+    Image.effect_noise(MAIN_SIZE, 90).save(tmp_path / "input" / "broken_mask.png")
+    result = mask_pipeline.process_images(str(tmp_path / "input"), str(tmp_path / "output"), "cutout", workers=workers)
+    assert (result["saved"], result["failed"]) == (3, 1)
+
+original_process_pair = mask_pipeline.process_pair
+
+def dying_process_pair(jobs):
+    """process_pair that kills its worker process on the first pair."""
+    import os
+
+    if jobs[0]["main_path"].endswith("pair0_main.png"):
+        os._exit(1)
+    return original_process_pair(jobs)
+
+def test_dead_worker_fails_its_pairs(tmp_path, monkeypatch):
+    """A worker process that dies fails the pairs it broke; the run still finishes and writes its report."""
+    import multiprocessing
+
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the patched process_pair only reaches forked workers")
+    write_pairs(tmp_path / "input", 40)
+    monkeypatch.setattr(mask_pipeline, "process_pair", dying_process_pair)
+    result = mask_pipeline.process_images(str(tmp_path / "input"), str(tmp_path / "output"), "cutout", workers=2)
+    assert result["failed"] >= 1
+    assert result["saved"] + result["failed"] == 40
+    assert (tmp_path / "output" / mask_pipeline.RUN_REPORT_NAME).exists()
+
+def test_watch_replaces_dead_workers(tmp_path, monkeypatch):
+    """watch_folder fails the pairs of a dead worker and keeps processing new pairs with new workers."""
+    import multiprocessing
+    import threading
+    import time
+
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the patched process_pair only reaches forked workers")
+    write_pairs(tmp_path / "staging", 8)
+    (tmp_path / "input").mkdir()
+    monkeypatch.setattr(mask_pipeline, "process_pair", dying_process_pair)
+    recorded = []
+    original_record = mask_pipeline.record_pair_result
+
+    def record_pair_result(*args, **kwargs):
+        recorded.append(args[4])
+        return original_record(*args, **kwargs)
+
+    monkeypatch.setattr(mask_pipeline, "record_pair_result", record_pair_result)
+
+    def add_pairs(indices):
+        for index in indices:
+            for part in ("main", "mask"):
+                name = f"pair{index}_{part}.png"
+                (tmp_path / "staging" / name).rename(tmp_path / "input" / name)
+        deadline = time.monotonic() + 60
+        while len(recorded) < indices[-1] + 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    cancel = threading.Event()
+    results = []
+    watch = threading.Thread(target=lambda: results.append(mask_pipeline.watch_folder(
+        str(tmp_path / "input"), str(tmp_path / "output"), "cutout", workers=2,
+        settle_seconds=0, poll_interval=0.05, poll=True, cancel=cancel,
+    )))
+    watch.start()
+    try:
+        add_pairs(range(4))  # pair0 kills its worker
+        add_pairs(range(4, 8))
+    finally:
+        cancel.set()
+        watch.join()
+    assert any(outcome.get("error") for outcome in recorded[:4])
+    assert not any(outcome.get("error") for outcome in recorded[4:])
+    assert results[0]["saved"] + results[0]["failed"] == 8
+    assert all((tmp_path / "output" / f"pair{index}_cutout.png").exists() for index in range(4, 8))
+
+@pytest.mark.parametrize("workers", (1, 2))
+def test_cancel_stops_queued_pairs(tmp_path, workers):
+    """Once cancel is set, only the pairs already being worked on are finished."""
+    import threading
+
+    write_pairs(tmp_path / "input", 12)
+    outputs = tmp_path / "output"
+    cancel = threading.Event()
+    written = []
+
+    def progress(done, found, scan_complete):
+        if done and not cancel.is_set():
+            written.append(len(list(outputs.glob("*_cutout.png"))))  # finished before the cancel
+            cancel.set()
+
+    result = mask_pipeline.process_images(
+        str(tmp_path / "input"), str(outputs), "cutout", workers=workers, cancel=cancel, progress=progress,
+    )
+    assert result["cancelled"]
+    assert len(list(outputs.glob("*_cutout.png"))) <= written[0] + 2 * workers
+
+def test_stack_uses_mask_filter(tmp_path):
+    """Stacked results are resized with the requested mask filter, like the per-file results."""
+    mask_pipeline.configure_mask_cache(0)
+    write_pairs(tmp_path / "input", 2)
+    for index in range(2):
+        Image.effect_noise((40, 30), 90 + index).save(tmp_path / "input" / f"pair{index}_mask.png")
+    mask_pipeline.stack_images(str(tmp_path / "input"), str(tmp_path / "output"), "cutout", workers=1,
+                               resize_filter="nearest")
+    (stack, array), = mask_pipeline.load_stacks(str(tmp_path / "output"))
+    for slot, base_name in enumerate(stack["base_names"]):
+        expected = mask_pipeline.composite_numpy(str(tmp_path / "input" / f"{base_name}_main.png"),
+                                                 str(tmp_path / "input" / f"{base_name}_mask.png"), "cutout",
+                                                 resize_filter="nearest")
+        assert np.array_equal(array[slot], np.asarray(expected)), base_name
+
+original_stack_pair = mask_pipeline.stack_pair
+
+def dying_stack_pair(main_path, *args):
+    """stack_pair that kills its worker process on the first pair."""
+    import os
+
+    if main_path.endswith("pair0_main.png"):
+        os._exit(1)
+    return original_stack_pair(main_path, *args)
+
+def test_stack_survives_dead_worker(tmp_path, monkeypatch):
+    """A worker process that dies fails its pairs instead of raising out of stack_images."""
+    import multiprocessing
+
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the patched stack_pair only reaches forked workers")
+    write_pairs(tmp_path / "input", 4)
+    monkeypatch.setattr(mask_pipeline, "stack_pair", dying_stack_pair)
+    result = mask_pipeline.stack_images(str(tmp_path / "input"), str(tmp_path / "output"), "cutout", workers=2)
+    assert result["failed"] >= 1
+    assert result["pairs"] + result["failed"] == 4
+
+def test_compare_encoders_lists_every_preset(tmp_path):
+    """compare_encoders reports a time and a size for every preset, or for the presets it is given."""
+    write_pairs(tmp_path, 1)
+    main_path, mask_path = str(tmp_path / "pair0_main.png"), str(tmp_path / "pair0_mask.png")
+    rows = mask_pipeline.compare_encoders(main_path, mask_path)
+    assert [row["encoder"] for row in rows] == list(mask_pipeline.ENCODER_PRESETS)
+    assert all(row["seconds"] >= 0 and row["bytes"] > 0 for row in rows)
+    rows = mask_pipeline.compare_encoders(main_path, mask_path, "darken", "numpy", ["fast"])
+    assert [row["encoder"] for row in rows] == ["fast"]
+
+@pytest.mark.parametrize("option, value", (
+    ("--mode", "sepia"), ("--encoder", "nope"), ("--mask-filter", "blur"), ("--backend", "gpu"),
+))
+def test_cli_rejects_unknown_choices(tmp_path, capsys, option, value):
+    """mask_cli checks options against the mask_pipeline registries and stops before processing anything."""
+    import mask_cli
+
+    with pytest.raises(SystemExit) as stopped:
+        mask_cli.main(["process", str(tmp_path / "input"), str(tmp_path / "output"), option, value])
+    assert stopped.value.code == 2
+    assert f"invalid choice: '{value}'" in capsys.readouterr().err
+    assert not (tmp_path / "output").exists()
+
+def test_cli_accepts_registered_modes(tmp_path, monkeypatch):
+    """A mode added with register_blend_mode can be given to mask_cli like the built-in ones."""
+    import mask_cli
+
+    monkeypatch.setattr(mask_pipeline, "BLEND_MODES", dict(mask_pipeline.BLEND_MODES))
+    mask_pipeline.register_blend_mode("hard-cutout", "alpha", mask_pipeline.threshold_lut(128))
+    write_pairs(tmp_path / "input", 1)
+    argv = ["process", str(tmp_path / "input"), str(tmp_path / "output"), "--mode", "hard-cutout", "--workers", "1"]
+    assert mask_cli.main(argv) == 0
+    assert (tmp_path / "output" / "pair0_hard-cutout.png").exists()